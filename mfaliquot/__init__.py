@@ -21,12 +21,32 @@
 import logging
 _logger = logging.getLogger(__name__)
 
+import codecs, gzip, json, threading
+from collections import deque
+from time import perf_counter, sleep
 from urllib import request, parse, error
 #from http.cookiejar import CookieJar
 #def add_cookies():
 #     request.install_opener(request.build_opener(request.HTTPCookieProcessor(CookieJar())))
 
-def blogotubes(url, encoding='utf-8', hdrs=None, data=None):
+# An optional BlogotubesTape, see below. Set it with set_tape() (config_boilerplate
+# does so according to the config file).
+_tape = None
+
+def set_tape(tape):
+     global _tape
+     _tape = tape
+
+
+def blogotubes(url, encoding='utf-8', hdrs=None, data=None, until=None):
+     '''Returns the decoded response body, or None on any error. `until`, if
+     given, is called with each newly read piece of the body, in order; once it
+     returns True, the rest of the response is abandoned and the body so far is
+     returned. Use it when only the start of a big page is needed.'''
+     method = 'GET' if data is None else 'POST'
+     if _tape is not None and _tape.replaying:
+          return _tape.replay(method, url)
+
      if hdrs is None:
           hdrs = {}
      if data is not None:
@@ -35,21 +55,204 @@ def blogotubes(url, encoding='utf-8', hdrs=None, data=None):
           #hdrs['Content-Type'] = 'application/x-www-form-urlencoded;charset='+encoding
      #req = request.Request(parse.quote(url, safe='/:'), headers=hdrs)
      req = request.Request(url, headers=hdrs)
+     start = perf_counter()
      try:
-          page = request.urlopen(req, data, timeout=300).read().decode(encoding) # 5 min timeout
+          with request.urlopen(req, data, timeout=300) as response: # 5 min timeout
+               if until is None:
+                    page = response.read().decode(encoding)
+               else:
+                    page = _read_until(response, encoding, until)
      except error.HTTPError as e:
           _logger.exception(f'{type(e).__name__}: {str(e)}', exc_info=e)
+          page = None
+     except Exception as e:
+          _logger.exception(f'{type(e).__name__}: {str(e)}', exc_info=e)
+          page = None
+
+     if _tape is not None:
+          _tape.record(method, url, hdrs, page, perf_counter() - start)
+     return page
+
+
+NOT_MODIFIED = object() # see blogotubes_conditional
+
+def blogotubes_conditional(url, validators=None, encoding='utf-8'):
+     '''A conditional GET: `validators` is the dict this returned last time for the
+     url, {"etag": ..., "last_modified": ...} (either may be missing). Returns
+     (body, validators), where the body is NOT_MODIFIED if the server says it
+     hasn't changed since, or None on any error.'''
+     method = 'CONDITIONAL' # as far as the tape is concerned
+     if _tape is not None and _tape.replaying:
+          response = _tape.replay(method, url)
+          if response is None:
+               return None, validators
+          return (NOT_MODIFIED if response['status'] == 304 else response['body']), response['validators']
+
+     validators = dict(validators or ())
+     hdrs = {}
+     if validators.get('etag'):
+          hdrs['If-None-Match'] = validators['etag']
+     if validators.get('last_modified'):
+          hdrs['If-Modified-Since'] = validators['last_modified']
+     req = request.Request(url, headers=hdrs)
+     start = perf_counter()
+     status = body = None
+     try:
+          with request.urlopen(req, timeout=300) as response:
+               body = response.read().decode(encoding)
+               status = response.status
+               validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+     except error.HTTPError as e:
+          if e.code == 304:
+               status = 304
+          else:
+               _logger.exception(f'{type(e).__name__}: {str(e)}', exc_info=e)
+     except Exception as e:
+          _logger.exception(f'{type(e).__name__}: {str(e)}', exc_info=e)
+
+     if _tape is not None:
+          _tape.record(method, url, hdrs, status and {'status': status, 'body': body, 'validators': validators},
+                       perf_counter() - start)
+     if status == 304:
+          return NOT_MODIFIED, validators
+     return body, validators
+
+
+class _NoRedirect(request.HTTPRedirectHandler):
+     # Makes a redirect response raise HTTPError, rather than being followed
+     def redirect_request(self, req, fp, code, msg, headers, newurl):
           return None
+
+_no_redirect_opener = request.build_opener(_NoRedirect)
+
+
+def blogotubes_redirect(url, hdrs=None):
+     '''Returns the url that `url` redirects to (itself if it doesn't redirect),
+     or None on any error. The redirect isn't followed and no body is read, so
+     this is a cheap way to ask e.g. the forum where its "last post" link points.'''
+     method = 'REDIRECT' # as far as the tape is concerned
+     if _tape is not None and _tape.replaying:
+          return _tape.replay(method, url)
+
+     if hdrs is None:
+          hdrs = {}
+     req = request.Request(url, headers=hdrs)
+     start = perf_counter()
+     try:
+          with _no_redirect_opener.open(req, timeout=300) as response:
+               final = response.geturl()
+     except error.HTTPError as e:
+          location = e.headers.get('Location') if 300 <= e.code < 400 else None
+          if location:
+               final = parse.urljoin(url, location)
+          else:
+               _logger.exception(f'{type(e).__name__}: {str(e)}', exc_info=e)
+               final = None
+          e.close()
      except Exception as e:
           _logger.exception(f'{type(e).__name__}: {str(e)}', exc_info=e)
+          final = None
+
+     if _tape is not None:
+          _tape.record(method, url, hdrs, final, perf_counter() - start)
+     return final
+
+
+_CHUNKSIZE = 2048
+
+def _read_until(response, encoding, until):
+     decoder = codecs.getincrementaldecoder(encoding)()
+     pieces, nbytes = [], 0
+     while True:
+          chunk = response.read1(_CHUNKSIZE)
+          nbytes += len(chunk)
+          if not chunk: # EOF
+               pieces.append(decoder.decode(b'', final=True))
+               return ''.join(pieces)
+          text = decoder.decode(chunk)
+          pieces.append(text)
+          if until(text):
+               _logger.debug(f"{response.geturl()}: stopped reading after {nbytes} bytes")
+               return ''.join(pieces)
+
+
+def network_sleep(seconds):
+     '''Sleep between requests to be nice to the servers, unless replaying a
+     tape, when there's no server to be nice to'''
+     if _tape is None or not _tape.replaying:
+          sleep(seconds)
+
+
+class BlogotubesTape:
+     '''Records every blogotubes request to, or replays them from, a gzipped file
+     of JSON lines, one per request: url, method, request headers, response (null
+     for network errors) and latency in seconds. In replay mode, the n-th request
+     for a given url gets the n-th response recorded for it, so a whole script run
+     can be replayed deterministically and offline; running out of recorded
+     responses is a network error. Request bodies are never recorded, since the
+     forum ones include the login password. blogotubes_redirect() requests are
+     recorded with the method "REDIRECT", and the redirect url as the response;
+     blogotubes_conditional() ones with "CONDITIONAL", and the response is a dict
+     of the status, body and validators.
+
+     Each request is appended to the file as its own gzip member, so like the
+     FDBFactStore, a crash can at worst truncate the last record. Requests may be
+     made from several threads at once.'''
+
+     MODES = ('record', 'replay')
+
+     def __init__(self, file, mode):
+          if mode not in self.MODES:
+               raise ValueError(f"unknown tape mode {mode!r} (must be one of {', '.join(self.MODES)})")
+          self._file = file
+          self._mode = mode
+          self._responses = {}
+          self._lock = threading.Lock()
+          if mode == 'replay':
+               self._read_tape()
+
+     file = property(lambda self: self._file)
+     mode = property(lambda self: self._mode)
+     recording = property(lambda self: self._mode == 'record')
+     replaying = property(lambda self: self._mode == 'replay')
+
+
+     def _read_tape(self):
+          count = 0
+          with gzip.open(self._file, 'rt', encoding='utf-8') as f:
+               try:
+                    for line in f:
+                         try:
+                              entry = json.loads(line)
+                              key = entry['method'], entry['url']
+                         except (ValueError, KeyError):
+                              _logger.warning(f"{self._file}: ignoring malformed record {line[:80]!r}")
+                              continue
+                         self._responses.setdefault(key, deque()).append(entry['response'])
+                         count += 1
+               except EOFError: # crashed mid-write
+                    _logger.warning(f"{self._file}: truncated, ignoring the last record")
+          _logger.info(f"Replaying {count} responses from {self._file}")
+
+
+     def replay(self, method, url):
+          with self._lock:
+               responses = self._responses.get((method, url))
+               if responses:
+                    return responses.popleft()
+          _logger.error(f"tape has no (more) responses for {method} {url}")
           return None
-     else:
-          return page
+
+
+     def record(self, method, url, hdrs, response, latency):
+          line = json.dumps({'url': url, 'method': method, 'hdrs': hdrs, 'response': response,
+                             'latency': round(latency, 6)}, ensure_ascii=False) + '\n'
+          with self._lock, gzip.open(self._file, 'at', encoding='utf-8') as f:
+               f.write(line)
 
 
 from collections import OrderedDict
 from collections.abc import MutableMapping
-import json
 
 class InterpolatedJSONConfig(OrderedDict):
      '''A class to allow human-readable text configuration, without the complicated and
@@ -112,6 +315,13 @@ def config_boilerplate(CONFIGFILE, SCRIPTNAME):
      dictConfig(logconf)
      LOGGER = logging.getLogger()
      LOGGER.info(strftime('%Y-%m-%d %H:%M:%S'))
+
+     tapeconf = CONFIG.get('blogotubes_tape')
+     if tapeconf and tapeconf['mode']:
+          tapefile = tapeconf['file'].format(SCRIPTNAME)
+          LOGGER.info(f"blogotubes: {tapeconf['mode']} mode, tape {tapefile}")
+          set_tape(BlogotubesTape(tapefile, tapeconf['mode']))
+
      return CONFIG, LOGGER
 
 
@@ -41,9 +41,12 @@
 
 import json, logging
 from .sequence import SequenceInfo
+from .website import ArtifactWriter, write_shards, write_facets, write_details
+from . import columnar
 from collections import defaultdict, Counter
 from time import sleep
-from os import remove as rm
+from os import remove as rm, stat, fsync
+from os.path import exists
 from contextlib import contextmanager
 from math import inf as _Inf, isfinite
 
@@ -175,11 +178,29 @@ class _SequencesData:
           self._jsonfile = config['jsonfile']
           self._lockfile = config['lockfile']
           self._txtfile  = config['txtfile']
+          self._journalfile = config.get('journalfile') # None to disable checkpoint()
+          self._json_format = config.get('json_format', 'rows') # or 'columns', see columnar.py
+          if self._json_format not in ('rows', columnar.FORMAT):
+               raise ValueError(f"unknown json_format {self._json_format!r} (must be 'rows' or '{columnar.FORMAT}')")
+          self._artifacts = ArtifactWriter(config.get('manifest')) # no manifest: compare with the file on disk
+          self._deltafile = config.get('deltafile') # None for no delta feed
+          self._delta_generations = config.get('delta_generations', 96)
+          self._sharddir = config.get('sharddir') # None for no pre-sorted pages of the table
+          self._shard_rows = config.get('shard_rows', 500)
+          self._facetfile = config.get('facetfile') # None for no precomputed filters
+          self._detaildir = config.get('detaildir') # None for no per sequence documents
           self._sequence_class = _sequence_class
           # For priority purposes, we keep the jsonlist in minheap form ordered
           # by priority. The dict is an access convenience for most purposes.
           self._data = None # Will cause errors if you try and use this class
           self._heap = None # before actually reading data
+          self._signature = None # of the file as of our last read or write
+          self._journal_signature = None # of the journal as of our last read, write or checkpoint
+          self._dirty = set() # seqs pushed or dropped since the last write or checkpoint
+          self._generation = 0 # incremented by each write() that changes any record
+          self._snapshot = {} # seq -> record list, as of the last read or write
+          self._derived = None # what write_derived() has yet to do for the writes so far
+          self._res_index = None # name -> set of seqs reserved, built on first use after each read
 
      # See heap_impl_details.txt for a detailed rationale for the heap design.
      # The gist is we just use standard heap methods for everything; dropping
@@ -199,6 +220,15 @@ class _SequencesData:
           self._have_lock = True
 
 
+     def _file_signature(self, file=None):
+          # rewritten in place, so the inode doesn't change
+          try:
+               st = stat(file or self._jsonfile)
+          except FileNotFoundError:
+               return None
+          return st.st_mtime_ns, st.st_size
+
+
      def _unlock(self):
           self._have_lock = False
           rm(self._lockfile) # Should we test for problems or just let exceptions propgate?
@@ -209,15 +239,21 @@ class _SequencesData:
           self._lock()
           self._data = dict()
           self._heap = _Heap()
+          self._generation = 0
+          self._snapshot = {}
+          self._res_index = None
 
 
      def _read_init(self):
           with open(self.file, 'r') as f:
                data = json.load(f)
 
-          tmpheap = data['aaData']
+          # Either format is read, whatever json_format is
+          tmpheap = columnar.decode(data) if data.get('format') == columnar.FORMAT else data['aaData']
           if 'resdatetime' in data:
                self.resdatetime = data['resdatetime']
+          self._generation = data.get('generation', 0)
+          self._snapshot = {dat[0]: dat for dat in tmpheap} # SequenceInfo copies them
 
           self._data = dict()
           self._heap = _Heap([None])
@@ -230,6 +266,11 @@ class _SequencesData:
                self._data[ali.seq] = ali
 
           self._heap.heapify()
+          self._signature = self._file_signature()
+          self._dirty = set()
+          self._res_index = None
+          self._replay_journal()
+          self._journal_signature = self._file_signature(self._journalfile) if self._journalfile else None
 
 
      def readonly_init(self):
@@ -237,9 +278,16 @@ class _SequencesData:
           self._read_init()
 
 
-     def lock_read_init(self):
-          '''Initialize self from the (immutable attribute) `file` passed to the constructor.'''
+     def lock_read_init(self, cached=False):
+          '''Initialize self from the (immutable attribute) `file` passed to the constructor.
+          With `cached`, a long lived object skips re-reading the file if nothing
+          else has written it (or its journal) since this object last read, wrote
+          or checkpointed it.'''
           self._lock()
+          if (cached and self._data is not None and self._signature == self._file_signature()
+                     and self._journal_signature == (self._file_signature(self._journalfile) if self._journalfile else None)):
+               _logger.info("Lock acquired, {} unchanged, reusing data in memory".format(self.file))
+               return
           _logger.info("Lock acquired, reading {}".format(self.file))
           try:
                self._read_init()
@@ -249,26 +297,31 @@ class _SequencesData:
 
 
      @contextmanager
-     def acquire_lock(self, block_minutes=0):
-          '''Use this to begin a `with` statement'''
+     def acquire_lock(self, block_minutes=0, cached=False, checkpoint=False):
+          '''Use this to begin a `with` statement. See lock_read_init for `cached`.
+          With `checkpoint`, the changes are only journaled on release (see
+          checkpoint_unlock), rather than the whole file rewritten.'''
           # seems better to *not* define self as a context manager, I don't think
           # `self` will ever have a name suitable for reading a with statement,
           # i.e. "with seqinfo.acquire_lock():" is much clearer than "with seqinfo:"
-          self._blocking_lock_read_init(block_minutes)
+          self._blocking_lock_read_init(block_minutes, cached)
           try:
                yield # Exceptions in the body of `with` are reraised here
           finally: # Unhandled except to guarantee cleanup
-               self.write_unlock()
+               if checkpoint:
+                    self.checkpoint_unlock()
+               else:
+                    self.write_unlock()
 
 
-     def _blocking_lock_read_init(self, block_minutes):
+     def _blocking_lock_read_init(self, block_minutes, cached=False):
           # Thin wrapper around lock_read_init, only difference is artifical blocking
           seconds = block_minutes*60
           period = 5 # No idea if this is sane or not
           count = seconds // period
 
           try:
-               self.lock_read_init()
+               self.lock_read_init(cached)
           except LockError as e:
                f = e
                _logger.error("Failed to acquire lock for {}, retrying in {} seconds".format(self.file, period))
@@ -278,7 +331,7 @@ class _SequencesData:
           for i in range(count):
                sleep(period)
                try:
-                    self.lock_read_init()
+                    self.lock_read_init(cached)
                except LockError as e:
                     f = e # rebind the exception to the local scope
                     _logger.error("Failed to acquire lock for {}, retrying in {} seconds".format(self.file, period))
@@ -303,25 +356,138 @@ class _SequencesData:
           # TODO: This is effectively cleaning the heap. Should we actually save the cleaned heap?
           # self._heap = _Heap(out) #(copies entire list)
 
-          outdict = {"aaData": out}
+          # Records aren't only changed by push_new_info (e.g. reservations are
+          # set in place), so compare against the last read or written data
+          touched = [seq for seq, ali in self._data.items() if self._snapshot.get(seq) != ali]
+          touched.extend(seq for seq in self._snapshot if seq not in self._data)
+          before = self._generation
+          if touched:
+               self._generation += 1
+
+          outdict = columnar.encode(out) if self._json_format == columnar.FORMAT else {"aaData": out}
           try:
                outdict['resdatetime'] = self.resdatetime
           except Exception:
                pass
+          if self._generation:
+               outdict['generation'] = self._generation
           json_string = json.dumps(outdict, ensure_ascii=False, sort_keys=True).replace('],', '],\n') + '\n'
           # sort_keys to get reproducible output for testing, ensure_ascii=False to allow fancy names
-          with open(self._jsonfile, 'w') as f:
-               f.write(json_string)
+          self._artifacts.write(self._jsonfile, json_string, compress=True)
           del json_string # Both outstrings generated here can be multiple megabytes each
 
           if self._txtfile:
                txt_string = ''.join(str(ali)+'\n' for ali in sorted(out, key=lambda ali: ali.seq) if ali.is_minimally_valid())
                # we want to go easy on newly added seqs with invalid data
-               with open(self._txtfile, 'w') as f:
-                    f.write(txt_string)
+               self._artifacts.write(self._txtfile, txt_string, hashed=False, compress=True)
                del txt_string
 
+          if self._deltafile:
+               self._write_delta(sorted(touched))
+          info = {'generation': self._generation}
+          if hasattr(self, 'resdatetime'):
+               info['resdatetime'] = self.resdatetime
+
           del out
+          self._snapshot = {seq: list(ali) for seq, ali in self._data.items()}
+          self._signature = self._file_signature()
+          if self._sharddir or self._facetfile or self._detaildir:
+               previous = self._derived or {'touched': set(), 'since': before}
+               self._derived = {'rows': self._snapshot, 'info': info, 'signature': self._signature,
+                                'touched': previous['touched'].union(touched), 'since': previous['since']}
+          self._dirty = set()
+          if self._journalfile and exists(self._journalfile): # now redundant
+               rm(self._journalfile)
+          self._journal_signature = None
+
+
+     # The delta feed lets returning website visitors patch their cached copy of
+     # the json file rather than download the whole thing again. It holds the seqs
+     # touched by each of the last `delta_generations` generations, ["changes":
+     # [[generation, [seqs]], ...]], and the current records of all of those seqs
+     # ("aaData"); a touched seq without a record was dropped.
+
+     def _write_delta(self, touched):
+          try:
+               with open(self._deltafile, 'r') as f:
+                    changes = json.load(f)['changes']
+          except (FileNotFoundError, ValueError, KeyError):
+               changes = []
+          if changes and changes[-1][0] not in (self._generation, self._generation - 1):
+               _logger.warning(f"{self._deltafile} is out of sync (generation {changes[-1][0]}, now {self._generation}), restarting it")
+               changes = []
+          if touched:
+               changes.append([self._generation, touched])
+          changes = [change for change in changes if change[0] > self._generation - self._delta_generations]
+
+          seqs = set(seq for generation, seqs in changes for seq in seqs)
+          delta = {'generation': self._generation, 'changes': changes,
+                   'aaData': [self._data[seq] for seq in sorted(seqs) if seq in self._data]}
+          try:
+               delta['resdatetime'] = self.resdatetime
+          except AttributeError:
+               pass
+          self._artifacts.write(self._deltafile, json.dumps(delta, ensure_ascii=False, sort_keys=True).replace('],', '],\n') + '\n',
+                                hashed=False, compress=True)
+
+
+     # The journal makes progress durable between full writes, at a cost proportional
+     # to what changed rather than to the whole file. Each checkpoint() appends one
+     # line per changed seq: ["push", <SequenceInfo list>] or ["drop", <seq>]. The
+     # next read (by any script) replays it over the main file, and the next full
+     # write makes it redundant and deletes it.
+
+     def checkpoint(self):
+          '''Append the seqs changed since the last write or checkpoint to the
+          journal, and flush it to disk. Returns the count of records written.'''
+          if not self._have_lock: raise LockError("Can't use SequencesManager.checkpoint() without lock!")
+          if not self._journalfile or not self._dirty:
+               return 0
+          lines = []
+          for seq in self._dirty:
+               if seq in self._data:
+                    lines.append(json.dumps(["push", self._data[seq]], ensure_ascii=False))
+               else:
+                    lines.append(json.dumps(["drop", seq]))
+          with open(self._journalfile, 'a') as f:
+               f.write('\n'.join(lines) + '\n')
+               f.flush()
+               fsync(f.fileno())
+          _logger.debug(f"checkpointed {len(lines)} seqs to {self._journalfile}")
+          self._dirty = set()
+          self._journal_signature = self._file_signature(self._journalfile)
+          return len(lines)
+
+
+     def _replay_journal(self):
+          if not self._journalfile:
+               return
+          try:
+               f = open(self._journalfile, 'r')
+          except FileNotFoundError:
+               return
+          count = 0
+          with f:
+               for n, line in enumerate(f, 1):
+                    try:
+                         op, arg = json.loads(line)
+                         if op == 'push':
+                              ali = self._sequence_class(lst=arg)
+                         elif op != 'drop':
+                              raise ValueError(op)
+                    except ValueError: # most likely a line truncated by a crash
+                         _logger.warning(f"{self._journalfile}:{n}: ignoring malformed journal entry {line[:80]!r}")
+                         continue
+                    if op == 'push':
+                         if ali.seq in self._data:
+                              self._sabotage_heap_entry(self._data[ali.seq])
+                         self._data[ali.seq] = ali
+                         self._heap.push(self._make_heap_entry(ali))
+                    elif arg in self._data:
+                         self._sabotage_heap_entry(self._data.pop(arg))
+                    self._dirty.add(ali.seq if op == 'push' else arg)
+                    count += 1
+          _logger.info(f"Replayed {count} journal entries from {self._journalfile}")
 
 
      def write_unlock(self):
@@ -333,6 +499,47 @@ class _SequencesData:
           finally:
                self._unlock()
           _logger.info("seqinfo written, lock released")
+          self.write_derived()
+
+
+     def write_derived(self):
+          '''Generate the documents derived from the table (shards, facets, details), as of the
+          last write(). They're made from the copy of the records it wrote, so
+          this needn't hold the lock, and write_unlock and checkpoint_unlock call
+          it only once the lock is released. Skipped if someone else has written
+          the file since, as they'll do it themselves.'''
+          derived, self._derived = self._derived, None
+          if not derived:
+               return
+          if self._file_signature() != derived['signature']:
+               _logger.info(f"{self.file} was written by someone else since, leaving its documents to them")
+               return
+          rows = list(derived['rows'].values())
+          if self._sharddir:
+               write_shards(self._artifacts, self._sharddir, rows, self._shard_rows, **derived['info'])
+          if self._facetfile:
+               write_facets(self._artifacts, self._facetfile, rows, **derived['info'])
+          if self._detaildir: # every seq touched by any write since the last write_derived()
+               write_details(self._detaildir, derived['rows'], sorted(derived['touched']),
+                             derived['info']['generation'], derived['since'])
+
+
+     def checkpoint_unlock(self):
+          '''Like write_unlock, but only journals the changes. Anything else that
+          changed (e.g. resdatetime) waits for the next full write, so this is for
+          a long lived object that makes one now and then. Without a journal, this
+          is just write_unlock.'''
+          if not self._journalfile:
+               return self.write_unlock()
+          try:
+               count = self.checkpoint()
+          except BaseException as e:
+               _logger.exception(f"seqinfo failed to checkpoint!", exc_info=e)
+               raise
+          finally:
+               self._unlock()
+          _logger.info(f"seqinfo checkpointed ({count} seqs), lock released")
+          self.write_derived() # for any write() made under the lock
 
 
      @staticmethod
@@ -365,6 +572,12 @@ class _SequencesData:
                self._sabotage_heap_entry(self._data[seq])
 
 
+     def unpop(self, seq):
+          '''Put a seq popped by pop_n_todo back on the heap, unchanged. Unlike
+          push_new_info, this doesn't mark it as changed.'''
+          self._heap.push(self._make_heap_entry(self._data[seq]))
+
+
      def drop(self, seqs):
           '''Drop the given sequences from the dictionary.'''
           if not self._have_lock: raise LockError("Can't use SequencesManager.drop() without lock!")
@@ -376,8 +589,11 @@ class _SequencesData:
                     continue
                ali = self._data[seq]
                self._sabotage_heap_entry(ali)
+               if self._res_index is not None and ali.res:
+                    self._res_index[ali.res].discard(seq)
                del self._data[seq]
                del ali
+               self._dirty.add(seq)
 
 
      def push_new_info(self, ali):
@@ -385,10 +601,40 @@ class _SequencesData:
           into the underlying datastructures. Any previous such object is
           silently overwritten.'''
           if not self._have_lock: raise LockError("Can't use SequencesManager.push_new_info() without lock!")
-          if ali.seq in self._data:
-               self._sabotage_heap_entry(self._data[ali.seq])
+          old = self._data.get(ali.seq)
+          if old is not None:
+               self._sabotage_heap_entry(old)
+          if self._res_index is not None and (old.res if old else '') != ali.res:
+               if old and old.res:
+                    self._res_index[old.res].discard(ali.seq)
+               if ali.res:
+                    self._res_index[ali.res].add(ali.seq)
           self._data[ali.seq] = ali
           self._heap.push(self._make_heap_entry(ali))
+          self._dirty.add(ali.seq)
+
+
+     def _reserved_by(self, name):
+          '''The (live) set of seqs reserved by `name`, from an index of every
+          reservation, built on first use and then kept up to date by everything
+          here that changes a res. Setting ali.res directly bypasses it; the
+          index may then be stale, so check each seq's actual res before use.'''
+          if self._res_index is None:
+               self._res_index = defaultdict(set)
+               for ali in self._data.values():
+                    if ali.res:
+                         self._res_index[ali.res].add(ali.seq)
+          return self._res_index[name]
+
+
+     def _set_res(self, ali, name):
+          '''Set the res of `ali` to `name` ('' to unreserve), keeping the index'''
+          if self._res_index is not None:
+               if ali.res:
+                    self._res_index[ali.res].discard(ali.seq)
+               if name:
+                    self._res_index[name].add(ali.seq)
+          ali.res = name
 
 #
 #
@@ -447,7 +693,7 @@ class SequencesManager(_SequencesData):
                other = self[seq].res
 
                if not other:
-                    self[seq].res = name
+                    self._set_res(self[seq], name)
                     success.append(seq)
                elif name == other:
                     already_owns.append(seq)
@@ -477,7 +723,7 @@ class SequencesManager(_SequencesData):
                if not current:
                     not_reserveds.append(seq)
                elif name == current:
-                    self[seq].res = ''
+                    self._set_res(self[seq], '')
                     success.append(seq)
                else:
                     wrong_reserveds.append((seq, current))
@@ -490,6 +736,61 @@ class SequencesManager(_SequencesData):
           return success, DNEs, not_reserveds, wrong_reserveds
 
 
+     def apply_reservation_snapshot(self, name, seqs, drop=True, add=True):
+          '''Make `name`'s reservations exactly the `seqs`, as for a mass reservation
+          file: the new ones are reserved and the ones no longer listed are dropped,
+          found by set difference against the reservations index, so that the work
+          (and logging) is in the number of changes, not of seqs. With `drop` or
+          `add` False, that half is skipped, so that the drops and adds may be
+          done at different times. Returns (addres, dropres), shaped like the
+          returns of reserve_seqs and unreserve_seqs.'''
+          if not self._have_lock: raise LockError("Can't use SequencesManager.apply_reservation_snapshot() without lock!")
+          seqs = set(seqs)
+          held = self._reserved_by(name)
+
+          # A res changed directly (even on an ali then pushed as is) bypasses the
+          # index, so check the seqs it claims are already as they should be
+          unheld = [seq for seq in seqs & held if seq not in self._data or self._data[seq].res != name]
+          held.difference_update(unheld)
+          adds, drops = sorted(seqs - held), sorted(held - seqs)
+
+          dropped, not_reserveds, wrong_reserveds = [], [], []
+          for seq in (drops if drop else ()):
+               ali = self._data.get(seq)
+               if ali is not None and ali.res == name:
+                    self._set_res(ali, '')
+                    dropped.append(seq)
+                    continue
+               held.discard(seq) # the index was stale
+               if ali is not None and ali.res:
+                    wrong_reserveds.append((seq, ali.res))
+               else:
+                    not_reserveds.append(seq)
+
+          added, DNEs, already_owns, other_owns = [], [], [], []
+          for seq in (adds if add else ()):
+               ali = self._data.get(seq)
+               if ali is None:
+                    DNEs.append(seq)
+               elif not ali.res:
+                    self._set_res(ali, name)
+                    added.append(seq)
+               elif ali.res == name: # the index was stale
+                    held.add(seq)
+                    already_owns.append(seq)
+               else:
+                    other_owns.append((seq, ali.res))
+
+          _logger.info(f"apply_reservation_snapshot ({name}): {len(seqs)} seqs, added {len(added)}, dropped {len(dropped)}")
+          if DNEs: _logger.error(f"apply_reservation_snapshot ({name}): {len(DNEs)} seqs don't exist: {DNEs}")
+          if other_owns: _logger.error(f"apply_reservation_snapshot ({name}): {len(other_owns)} seqs are reserved by someone else: {other_owns}")
+          stale = sorted(unheld) + already_owns + not_reserveds + [seq for seq, other in wrong_reserveds]
+          if stale:
+               _logger.warning(f"apply_reservation_snapshot ({name}): index was stale for {stale}")
+
+          return (added, DNEs, already_owns, other_owns), (dropped, [], not_reserveds, wrong_reserveds)
+
+
      def update_seqs(self, name, seqs):
           '''Validate sequences to be updated. (Caller is responsible for actual updating.)
           Returns (successes, DNEs) '''
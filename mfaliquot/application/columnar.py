@@ -0,0 +1,80 @@
+# This is written to Python 3.6 standards
+# indentation: 5 spaces (eccentric personal preference)
+# when making large backwards scope switches (e.g. leaving def or class blocks),
+# use two blank lines for clearer visual separation
+
+#    Copyright (C) 2014-2017 Bill Winslow
+#
+#    This module is a part of the mfaliquot package.
+#
+#    This program is libre software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+#    See the LICENSE file for more details.
+
+'''A column oriented encoding of the sequence table, the alternative to the
+"aaData" list of SequenceInfo lists. It's one list per SequenceInfo field:
+
+{"format": "columns", "count": <rows>, "columns": {"seq": [...], "index": [...], ...}}
+
+The rows are sorted by seq, and the seq column holds the differences between
+consecutive seqs (the first relative to 0). The res and guide columns, which
+have only a few dozen distinct values, are {"dict": [values], "codes": [index
+into dict per row]}. The time column is the same for the dates, plus "clock":
+[the rest of each time string]. Every other column is as is.
+
+website/templates/template.html has the javascript equivalent of decode().'''
+
+from itertools import accumulate
+from .sequence import SequenceInfo
+
+FORMAT = 'columns'
+FIELDS = sorted(SequenceInfo._map, key=lambda field: SequenceInfo._map[field][0])
+DICTIONARY = ('res', 'guide')
+
+
+def _dict_encode(values):
+     table = {}
+     codes = [table.setdefault(value, len(table)) for value in values]
+     return {'dict': list(table), 'codes': codes}
+
+
+def encode(rows):
+     '''Returns the columnar dict for `rows`, any lists in SequenceInfo layout'''
+     rows = sorted(rows, key=lambda row: row[0])
+     columns = {}
+     for i, field in enumerate(FIELDS):
+          column = [row[i] for row in rows]
+          if field == 'seq':
+               column = [seq - prev for prev, seq in zip([0] + column, column)]
+          elif field in DICTIONARY:
+               column = _dict_encode(column)
+          elif field == 'time':
+               split = [(time or '').partition(' ') for time in column]
+               column = _dict_encode(date for date, sep, clock in split)
+               column['clock'] = [clock for date, sep, clock in split]
+          columns[field] = column
+     return {'format': FORMAT, 'count': len(rows), 'columns': columns}
+
+
+def decode(data):
+     '''The inverse of encode(): returns the list of row lists (sorted by seq)'''
+     columns = data['columns']
+     out = []
+     for field in FIELDS:
+          column = columns[field]
+          if field == 'seq':
+               column = accumulate(column)
+          elif field in DICTIONARY:
+               column = map(column['dict'].__getitem__, column['codes'])
+          elif field == 'time':
+               dates = column['dict']
+               column = [f'{dates[code]} {clock}' if clock else dates[code] for code, clock in zip(column['codes'], column['clock'])]
+          out.append(column)
+     return list(map(list, zip(*out)))
@@ -0,0 +1,124 @@
+# This is written to Python 3.6 standards
+# indentation: 5 spaces (eccentric personal preference)
+# when making large backwards scope switches (e.g. leaving def or class blocks),
+# use two blank lines for clearer visual separation
+
+#    Copyright (C) 2014-2017 Bill Winslow
+#
+#    This module is a part of the mfaliquot package.
+#
+#    This program is libre software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+#    See the LICENSE file for more details.
+
+'''A permanent local store for those FDB facts which can never change: the
+creation date of an id, the decimal value of an id, and the status of an id
+which is fully factored (or prime). The fdb module consults the store before
+going to the network, and records whatever it learns afterwards.
+
+The file format is trivially simple, one fact per line: "<id> <kind> <value>".
+The file is only ever appended to, so a crash can at worst leave one truncated
+line at the end, which is ignored on the next read.'''
+
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class FDBFactStore:
+     '''An append-only file of immutable FDB facts, indexed in memory by
+     (id, kind). The `file` constructor argument is immutable for the lifetime
+     of the object.'''
+
+     KINDS = ('created', 'value', 'status')
+
+     def __init__(self, file):
+          self._file = file
+          self._index = {}
+          try:
+               self._index.update(self._read_facts(file))
+          except FileNotFoundError:
+               pass
+
+     @property
+     def file(self):
+          return self._file
+
+
+     @classmethod
+     def _read_facts(klass, file):
+          '''Lazily yields ((id, kind), value) for each valid line in the file'''
+          with open(file, 'r') as f:
+               for n, line in enumerate(f, 1):
+                    if not line.endswith('\n'): # truncated by a crash: the value may be cut short
+                         _logger.warning(f"{file}:{n}: ignoring truncated fact {line!r}")
+                         continue
+                    try:
+                         fdb_id, kind, value = line.split()
+                         fdb_id = int(fdb_id)
+                    except ValueError:
+                         _logger.warning(f"{file}:{n}: ignoring malformed fact {line!r}")
+                         continue
+                    if kind not in klass.KINDS:
+                         _logger.warning(f"{file}:{n}: ignoring unknown fact kind {kind!r}")
+                         continue
+                    yield (fdb_id, kind), value
+
+
+     def __len__(self):
+          return len(self._index)
+
+
+     def __contains__(self, key):
+          return key in self._index
+
+
+     def get(self, fdb_id, kind, default=None):
+          return self._index.get((int(fdb_id), kind), default)
+
+
+     def put(self, fdb_id, kind, value):
+          '''Record a fact. Facts are immutable, so re-recording a known fact is
+          a no-op, while trying to change one is an error.'''
+          self._put_many([(fdb_id, kind, value)])
+
+
+     def _put_many(self, facts):
+          lines = []
+          for fdb_id, kind, value in facts:
+               if kind not in self.KINDS:
+                    raise ValueError(f"unknown fact kind {kind!r}")
+               key, value = (int(fdb_id), kind), str(value)
+               if not value or any(c.isspace() for c in value):
+                    raise ValueError(f"invalid fact value {value!r} for id {fdb_id}")
+               old = self._index.get(key)
+               if old == value:
+                    continue
+               if old is not None:
+                    _logger.error(f"fdb id {fdb_id}: immutable fact {kind} changed from {old} to {value}?? ignoring")
+                    continue
+               self._index[key] = value
+               lines.append(f"{key[0]} {kind} {value}\n")
+
+          if lines:
+               with open(self._file, 'ab+') as f:
+                    if f.tell(): # don't append to a line truncated by a crash
+                         f.seek(-1, 2)
+                         if f.read(1) != b'\n':
+                              lines.insert(0, '\n')
+                    f.write(''.join(lines).encode('utf-8'))
+          return len(lines)
+
+
+     def bulk_load(self, file):
+          '''Warm up the store from another file of the same format, e.g. one
+          copied from another machine. Returns the count of new facts.'''
+          count = self._put_many((fdb_id, kind, value) for (fdb_id, kind), value in self._read_facts(file))
+          _logger.info(f"loaded {count} new facts from {file} into {self.file}")
+          return count
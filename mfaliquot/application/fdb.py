@@ -23,15 +23,20 @@
 # The goal is to completely remove any reference to fdb html layout from allseq.py
 
 '''A module to query information from the FactorDatabase, factordb.com.
-All functions provided have automatic retries. They return None if there is a
-network error of some sort, or raise an FDBDataError for bad data.'''
+All functions provided have automatic retries, according to `retry_policy`.
+Once out of tries, they raise FDBNetworkError if the FDB couldn't be reached,
+or FDBDataError for bad data. FDBResourceLimitReached and FDBLayoutError are
+never retried, and all calls share one circuit breaker, which raises
+CircuitOpenError when the FDB has been unreachable for a while.'''
 
 
-import logging, re
+import json, logging, re
 from .. import blogotubes
+from ..theory.numtheory import prp
+from .retry import RetryPolicy, CircuitBreaker, CircuitOpenError
 from .sequence import SequenceInfo, DATETIMEFMT
 from enum import Enum, auto
-from time import gmtime, sleep, strftime, strptime
+from time import gmtime, strftime, strptime
 from math import log10
 
 def _blogotubes_with_fdb_useragent(*args, **kwargs):
@@ -40,6 +45,17 @@ def _blogotubes_with_fdb_useragent(*args, **kwargs):
 
 _logger = logging.getLogger(__name__)
 
+# May be pointed elsewhere, e.g. at a local stand-in (see fdb_standin.py)
+FDBURL = 'http://factordb.com/'
+
+# An optional FDBFactStore (see factstore.py) of immutable facts, consulted before
+# and updated after network queries. None means every query hits the network.
+_factstore = None
+
+def set_fact_store(store):
+     global _factstore
+     _factstore = store
+
 COMPOSITEREGEX = re.compile(r'= <a.+<font color="#002099">[0-9.]+</font></a><sub>&lt;(?P<C>[0-9]+)')
 SMALLFACTREGEX = re.compile(r'(?:<font color="#000000">)([0-9^]+)(?:</font></a>)(?!<sub>)')
 LARGEFACTREGEX = re.compile(r'(?:<font color="#000000">[0-9^.]+</font></a><sub>&lt;)([0-9]+)')
@@ -47,41 +63,106 @@ IDSIZEREGEX = re.compile(r'<td>(?P<size>[0-9]+) <a href="index.php\?showid=(?P<i
 ALIINFOREGEX = re.compile('<td bgcolor="#BBBBBB">n</td>\n<td bgcolor="#BBBBBB">Digits</td>\n<td bgcolor="#BBBBBB">Number</td>\n</tr><tr><td bgcolor="#DDDDDD">.{1,3}hecked</td>\n<td bgcolor="#DDDDDD">(?P<index>[0-9]+)</td>\n<td bgcolor="#DDDDDD">(?P<size>[0-9]+) <a href="index.php\\?showid=(?P<id>[0-9]+)">\\(show\\)')
 CREATEDREGEX = re.compile('([JFMASOND][a-z]{2,8}) ([0-9]{1,2}), ([0-9]{4})') # strftime('%d', strptime(month, "%B"))
 
+# The above regexes each scan the entire page, and there's several substring
+# scans on top of that. TOKENREGEX instead combines everything we need from both
+# the sequence and id pages into one alternation, so that one finditer() is one
+# pass over the page. Every alternative starts with the literal '<', which lets
+# the regex engine skip to the next '<' very quickly (alternatives with any other
+# first character lose that optimization and are some 3x slower, which is why the
+# two plain-text markers aren't tokens; see FDBPage).
+TOKENREGEX = re.compile('<(?:' + '|'.join((
+     r'font color="#00(?:0000">(?P<fact>[0-9^.]+)</font></a>(?P<factsub><sub>(?:&lt;(?P<big>[0-9]+))?)?'
+                   r'|2099">[0-9.]+</font></a><sub>&lt;(?P<comp>[0-9]+))',
+     r'td>(?:(?P<status>CF|PRP|FF|C|P|U)</td>|(?P<idsize>[0-9]+) <a href="index.php\?showid=(?P<idid>[0-9]+)">\(show\))',
+     ALIINFOREGEX.pattern.replace('(?P<', '(?P<ali')[1:],
+)) + ')')
+
 
 ################################################################################
 
+class FDBNetworkError(Exception): pass
+
 class FDBDataError(Exception): pass
 
+class FDBLayoutError(FDBDataError): pass
+
 class FDBResourceLimitReached(FDBDataError):
-     def __init__(self, msg, fdbpage=None):
+     def __init__(self, msg='the FDB is refusing requests', fdbpage=None):
           if fdbpage:
                try:
                 # pages = re.search(r'>Page requests</td>\n<td[^>]*?>([0-9,]+)</td>', page).group(1)
                 # ^ avoid repeating the entire regex 5 times with slight variations. very typo prone.
                 retmpl = r'>{}</td>\n<td[^>]*?>{}</td>'
                 pages, ids, queries, cputime, when = [
-                    re.search(retmpl.format(name, valgroup), page).group(1)
+                    re.search(retmpl.format(name, valgroup), fdbpage).group(1)
                     for name, valgroup in (
                     (r'Page requests',           r'([0-9,]+)'),
                     (r'IDs created',             r'([0-9,]+)'),
                     (r'Database queries',        r'([0-9,]+)'),
                     (r'CPU \(Wall clock time\)', r'([0-9,.]+) seconds'),
                     (r'Counting since',          r'(.*?)')                  )]
-                super().__init__(f"{pages} page reqs, {ids} new ids, {queries} db queries, {cputime}s cpu time since {when}")
+                msg = f"{pages} page reqs, {ids} new ids, {queries} db queries, {cputime}s cpu time since {when}"
                except AttributeError: # some re.search() failed
                     _logger.error('Not only is it refusing requests, but its formatting has changed!')
-          super().__init__()
+          super().__init__(msg)
+
+
+# Network errors and bad data are retried, the latter because the FDB sometimes
+# serves a page mid-update. Only network errors count towards opening the circuit.
+# Either may be replaced, e.g. with shorter delays for testing.
+circuit_breaker = CircuitBreaker(threshold=5, cooldown=60)
+retry_policy = RetryPolicy(tries=5, base_delay=2, max_delay=60, retry_on=(FDBNetworkError, FDBDataError),
+                           fatal=(FDBResourceLimitReached, FDBLayoutError), trip_on=(FDBNetworkError,),
+                           breaker=circuit_breaker)
+
+_requests = 0
+
+def request_count():
+     '''The number of requests made to the FDB by this process so far'''
+     return _requests
+
+
+def _fetch(url, **kwargs):
+     global _requests
+     _requests += 1
+     page = _blogotubes_with_fdb_useragent(FDBURL+url, **kwargs)
+     if page is None: # blogotubes has logged the details
+          raise FDBNetworkError(f"failed to get {url}")
+     return page
 
 
 ################################################################################
 
 def id_created(i):
+     '''Returns the creation date of id `i` as "YYYY-MM-DD", or None if the FDB
+     couldn't be reached or gave no date (there's nothing better for
+     process_progress to do). FDBResourceLimitReached is still raised.'''
      i = str(i)
+     if _factstore is not None:
+          created = _factstore.get(i, 'created')
+          if created:
+               return created
      #Print('Querying id', i)
-     page = _blogotubes_with_fdb_useragent('http://factordb.com/frame_moreinfo.php?id='+i)
-     if page is None:
+     try:
+          created = retry_policy.call(_id_created, i, label=f'fdb id {i}')
+     except FDBResourceLimitReached:
+          raise
+     except (FDBNetworkError, FDBDataError, CircuitOpenError) as e:
+          _logger.warning(f"fdb id {i}: no creation date: {str(e)}")
           return None
+     if _factstore is not None:
+          _factstore.put(i, 'created', created)
+     return created
+
+
+def _id_created(i):
+     page = _fetch('frame_moreinfo.php?id='+i)
+     if 'Resources used by your IP' in page:
+          _logger.error('the FDB is refusing requests')
+          raise FDBResourceLimitReached(fdbpage=page)
      date = CREATEDREGEX.search(page)
+     if not date:
+          raise FDBDataError(f'fdb id {i}: no creation date')
      year = date.group(3)
      day = date.group(2)
      if len(day) == 1: day = '0'+day
@@ -100,71 +181,295 @@ class FDBStatus(Enum):
      CompositePartiallyFactored = auto()
      CompositeFullyFactored = auto()
 
+# Once an id reaches one of these, it never changes again
+_IMMUTABLE_STATUSES = (FDBStatus.Prime, FDBStatus.CompositeFullyFactored)
+
+# In order of precedence, as in the old one-substring-scan-per-status code
+_STATUSES = (('CF', FDBStatus.CompositePartiallyFactored), ('PRP', FDBStatus.ProbablyPrime),
+             ('FF', FDBStatus.CompositeFullyFactored), ('C', FDBStatus.CompositeNoFactors),
+             ('P', FDBStatus.Prime), ('U', FDBStatus.Unknown))
+
+
+class DataTableEnd:
+     '''An incremental matcher for blogotubes(until=...): everything FDBPage reads
+     comes before the end of the first data table on the page, except for the
+     "Not all factors known" after it on sequence pages, and the id pages
+     especially have a lot more after that. Each instance is for one page.
+
+     On id pages (`sequence` False) it stops at the end of the table. On
+     sequence pages it stops only once the marker itself, or the end of the
+     body, has been read, so a page with the marker can never be mistaken for
+     one without.'''
+
+     START = 'bgcolor="#BBBBBB">Status'
+     END = '</tr></table>'
+     MARKERS = ('Not all factors known', '</body>')
+
+     def __init__(self, sequence=True):
+          self._wanted = [(self.START,), (self.END,)]
+          if sequence:
+               self._wanted.append(self.MARKERS)
+          self._carry = '' # the end of the text so far, which may hold the start of a match
+
+     def __call__(self, text):
+          '''`text` is the next piece of the page'''
+          text = self._carry + text
+          while self._wanted:
+               wanted = self._wanted[0]
+               found = [(i, len(s)) for i, s in ((text.find(s), s) for s in wanted) if i >= 0]
+               if not found:
+                    keep = max(map(len, wanted)) - 1
+                    self._carry = text[max(0, len(text)-keep):]
+                    return False
+               i, n = min(found)
+               text = text[i+n:]
+               self._wanted.pop(0)
+          return True
+
+
+class FDBPage:
+     '''Everything we use from an FDB sequence or id page, extracted in a single
+     pass with TOKENREGEX. Raises FDBLayoutError if the page has the FDB's usual
+     frame but none of the structure we know how to read, which most likely
+     means the FDB changed its html (and that retrying is pointless). Any other
+     unknown page, e.g. maintenance or a server error, raises a plain (and
+     retryable) FDBDataError. Results are identical to running the individual
+     regexes over the page.'''
+
+     FRAME = '<table width="100%" class="header">' # the FDB's menu bar, on every normal page
+
+     def __init__(self, page):
+          self.info = None # (index, size, id) from a sequence page
+          self.idsize = None # (size, id) from an id page
+          self.statuses = set()
+          self.smalls, self.bigs, self.comps = [], [], []
+
+          # COMPOSITEREGEX is a greedy match from '= <a' to the last composite
+          # on the same line; composites are rare, so emulate that by looking
+          # backwards along the line from each one
+          comp, comp_line = None, -1
+          for m in TOKENREGEX.finditer(page):
+               kind = m.lastgroup
+               if kind == 'fact': # no <sub> following
+                    fact = m.group('fact')
+                    if '.' not in fact:
+                         self.smalls.append(fact)
+               elif kind == 'factsub':
+                    big = m.group('big')
+                    if big:
+                         self.bigs.append(big)
+               elif kind == 'comp':
+                    start = m.start()
+                    line = page.rfind('\n', 0, start) + 1
+                    if page.find('= <a', line, start - 1) < 0:
+                         continue
+                    if line != comp_line and comp:
+                         self.comps.append(comp)
+                    comp, comp_line = m.group('comp'), line
+               elif kind == 'status':
+                    self.statuses.add(m.group('status'))
+               elif kind == 'idid':
+                    if not self.idsize:
+                         self.idsize = int(m.group('idsize')), int(m.group('idid'))
+               elif kind == 'aliid':
+                    if not self.info:
+                         self.info = int(m.group('aliindex')), int(m.group('alisize')), int(m.group('aliid'))
+          if comp:
+               self.comps.append(comp)
+
+          # The plain-text markers are checked only on the pages which can have them:
+          # memmem is faster than any regex, and this way most pages never need the
+          # resource limit check at all
+          self.all_factors_known = not (self.info and 'Not all factors known' in page)
+          self.resource_limit = False
+          if not (self.info or self.idsize or self.statuses or self.smalls):
+               if 'Resources used by your IP' not in page:
+                    if self.FRAME not in page:
+                         raise FDBDataError('not an FDB data page, is it down for maintenance?')
+                    raise FDBLayoutError('unrecognized page layout, has the FDB changed its html?')
+               self.resource_limit = True
+
+
+     def status(self):
+          for string, enum in _STATUSES:
+               if string in self.statuses:
+                    return enum
+          return None
 
-def query_id(fdb_id, tries=5):
-     '''Returns None on network error, raises FDBDataError on bad data, or an FDBStatus otherwise.
-     Partially factored lines get a (factors, cofactor), all other statuses have no parsing.'''
-     for i in range(tries):
-          page = _blogotubes_with_fdb_useragent('http://factordb.com/index.php?id='+str(fdb_id))
-          if page is None:
-               return None
-          if 'Resources used by your IP' in page:
-               _logger.error('the FDB is refusing requests')
-               raise FDBResourceLimitReached(fdbpage=page)
 
+     def factors(self, ident, check_size):
+          '''Returns factors-as-string, cofactor-size (base 10), error checked
+          against the given `check_size`.'''
+          return _assemble_factors(ident, self.smalls, self.bigs, self.comps, check_size)
+
+
+def _assemble_factors(ident, smalls, bigs, comps, check_size):
+     # smalls are as displayed ('2^3'), bigs and comps are digit counts (as str).
+     # Error checks against the given `check_size`, if not None.
+     # returns factors-as-string, cofactor-size (base 10)
+
+     if not smalls:
+          raise FDBDataError(f'{ident}: no smalls match')
+
+     if smalls[0][0] != '2':
+          raise FDBDataError(f'{ident}: no 2 in the smalls!')
+
+     factors = " * ".join(small for small in smalls)
+     size = 0
+     for small in smalls:
+          if '^' in small:
+               base, exp = small.split('^')
+               size += log10(int(base))*int(exp)
+          else:
+               size += log10(int(small))
+
+     if bigs:
+          for big in bigs:
+               factors += " * P"+big
+               size += int(big)
+
+     if not comps:
+          raise FDBDataError(f'{ident}: no comps match')
+
+     for comp in comps:
+          factors += ' * C'+comp
+          cofactor = int(comp)
+          size += cofactor
+
+     # each big prime, plus the composite itself, introduce up to 1.0 error in the
+     # logsize, e.g. 1.2 * 10^x vs 9.8 * 10^x, the former introduces nearly 1.0
+     # error, the latter introduces nearly 0.0 error, so allow maximum error based on
+     # the number of such primes, assuming all hit the maximum error = 1.0 per prime
+     error_bound = len(bigs) + len(comps)
+
+     if check_size is not None and not (check_size - 1 < size < check_size + error_bound):
+          raise FDBDataError(f'{ident}, size {check_size}: garbage factors found: {factors} (calcsize {size:.2f})')
 
-          status_template = "<td>{}</td>"
-          if status_template.format('CF') in page:
-               size = IDSIZEREGEX.search(page)
-               assert size.group('id') == str(fdb_id)
-               size = int(size.group('size'))
-               factors, cofactor = parse_factors(fdb_id, page, size)
-               return FDBStatus.CompositePartiallyFactored, (factors, cofactor)
+     return factors, cofactor
 
-          for string, enum in (('PRP', FDBStatus.ProbablyPrime), ('FF', FDBStatus.CompositeFullyFactored),
-                       ('C', FDBStatus.CompositeNoFactors), ('P', FDBStatus.Prime), ('U', FDBStatus.Unknown)):
 
-               if status_template.format(string) in page:
-                    return enum, None
+################################################################################
 
-     return FDBDataError(f'fdb id {fdb_id} failed to produce a valid status after {tries} tries')
+
+def query_id(fdb_id, tries=5):
+     '''Returns an (FDBStatus, data) pair, raising errors as described in the module
+     docstring. Partially factored lines get data=(factors, cofactor), all other
+     statuses have no parsing (data=None).'''
+     status = _stored_status(fdb_id)
+     if status:
+          return status, None
+     return retry_policy.call(_query_id, fdb_id, label=f'fdb id {fdb_id}', tries=tries)
+
+
+def _query_id(fdb_id):
+     html = _fetch('index.php?id='+str(fdb_id), until=DataTableEnd(sequence=False))
+     page = FDBPage(html) # An unrecognizable page raises immediately, no retries
+     if page.resource_limit:
+          _logger.error('the FDB is refusing requests')
+          raise FDBResourceLimitReached(fdbpage=html)
+
+     status = page.status()
+     if status is None:
+          raise FDBDataError(f'fdb id {fdb_id}: no valid status')
+
+     if status is FDBStatus.CompositePartiallyFactored:
+          size, id_ = page.idsize
+          if id_ != int(fdb_id):
+               raise FDBDataError(f'fdb id {fdb_id}: got the page for id {id_}??')
+          return status, page.factors(fdb_id, size)
+
+     _store_status(fdb_id, status)
+     return status, None
+
+
+def _stored_status(fdb_id):
+     if _factstore is not None:
+          status = _factstore.get(fdb_id, 'status')
+          if status:
+               return FDBStatus[status]
+     return None
+
+
+def _store_status(fdb_id, status):
+     if _factstore is not None and status in _IMMUTABLE_STATUSES:
+          _factstore.put(fdb_id, 'status', status.name)
+
+
+# The FDB also serves id statuses and factorizations as JSON, which is a fraction
+# of the bytes of index.php, and won't change when the html does. The sequence
+# pages have no such equivalent, so query_sequence always uses the html.
+
+_API_STATUSES = dict(_STATUSES)
+# The html shows factors of up to this many digits in full, and the rest as
+# P<digits> or C<digits>; the stored factor strings follow suit. It's pinned by
+# the html/api pairs in tests/fdb_pages (see test_full_digits_cutoff), which must
+# include factors of both this many digits and one more
+_FULL_DIGITS = 9
+
+def query_id_json(fdb_id, tries=5):
+     '''A drop in replacement for query_id which uses the FDB's JSON api. Same
+     return values and exceptions.'''
+     status = _stored_status(fdb_id)
+     if status:
+          return status, None
+     return retry_policy.call(_query_id_json, fdb_id, label=f'fdb id {fdb_id}', tries=tries)
+
+
+def _query_id_json(fdb_id):
+     text = _fetch('api?id='+str(fdb_id))
+     if 'Resources used by your IP' in text:
+          _logger.error('the FDB is refusing requests')
+          raise FDBResourceLimitReached(fdbpage=text)
+
+     try:
+          data = json.loads(text)
+          status = _API_STATUSES[data['status']]
+          if status is FDBStatus.CompositePartiallyFactored:
+               return status, _api_factors(fdb_id, data['factors'])
+     except (ValueError, KeyError, TypeError) as e:
+          raise FDBDataError(f'fdb id {fdb_id}: bad json: {type(e).__name__}: {str(e)}') from None
+
+     _store_status(fdb_id, status)
+     return status, None
+
+
+def _api_factors(fdb_id, api_factors):
+     '''Convert the api's [[str(factor), exponent], ...] into the (factors, cofactor)
+     which parsing the html would have produced'''
+     smalls, bigs, comps = [], [], []
+     for factor, exp in api_factors:
+          n, exp = int(factor), int(exp)
+          if len(factor) <= _FULL_DIGITS:
+               smalls.append(factor if exp == 1 else f'{factor}^{exp}')
+          elif prp(n):
+               bigs.append(str(len(factor)))
+          else:
+               comps.append(str(len(factor)))
+     # The api has no size field, and the size of `value` would only check the
+     # response against itself, so there's nothing independent to check with
+     return _assemble_factors(fdb_id, smalls, bigs, comps, None)
 
 
 ################################################################################
 
 
 def query_sequence(seq, tries=5):
-     '''Returns None on network error, raises FDBDataError if `tries` consecutive bad data,
-     or a new SequenceInfo object if successful'''
-
-     for i in reversed(range(tries)):
-          page = _blogotubes_with_fdb_useragent('http://factordb.com/sequences.php?se=1&action=last&aq='+str(seq))
-          if page is None:
-               return None
-
-          if 'Resources used by your IP' in page: # This is a "permanent"-for-rest-of-script condition, only absolute raises here
-               _logger.error(f'Seq {seq}: the FDB is refusing requests')
-               raise FDBResourceLimitReached(fdbpage=page)
-          # not past the resources limit, temporary data errors:
-          try:
-               ali = process_ali_data(seq, page)
-          except FDBDataError as e:
-               if i <= 0:
-                    _logger.warning(f"Seq {seq}: bad data after {tries} tries: {str(e)}")
-                    raise
-               else:
-                    _logger.info(str(e))
-                    _logger.info(f'Seq {seq}: retrying query ({i} tries left)')
-                    sleep(5)
-                    continue
-
-          if i < tries-1:
-               _logger.info(f'Seq {seq}: retry factors (index {ali.index}): {ali.factors}')
+     '''Returns a new SequenceInfo object, raising errors as described in the
+     module docstring'''
+     return retry_policy.call(_query_sequence, seq, label=f'Seq {seq}', tries=tries)
 
-          return ali
+
+def _query_sequence(seq):
+     html = _fetch('sequences.php?se=1&action=last&aq='+str(seq), until=DataTableEnd())
+     page = FDBPage(html) # An unrecognizable page raises immediately, no retries
+     if page.resource_limit: # This is a "permanent"-for-rest-of-script condition, only absolute raises here
+          _logger.error(f'Seq {seq}: the FDB is refusing requests')
+          raise FDBResourceLimitReached(fdbpage=html)
+     return process_ali_data(seq, page)
 
 
 def process_ali_data(seq, page):
+     '''`page` may be the raw html or an already parsed FDBPage'''
      # I can't believe it took me this long to figure out a way past the spaghetti.
      # Instead of repeating the conditional error handling code once for each error,
      # which is what a goto would typically be used for in e.g. C, just factor out
@@ -172,15 +477,17 @@ def process_ali_data(seq, page):
      # and then the monolithic conditional error handling can be just after the function --
      # the function+exceptions == traditional-acceptable goto usage for errors.
      # This is so much cleaner. Thank jeebus.
-     info = ALIINFOREGEX.search(page)
+     if not isinstance(page, FDBPage):
+          page = FDBPage(page)
 
-     if not info:
+     if not page.info:
           raise FDBDataError(f"Seq {seq}: no basic information!")
 
-     ali = SequenceInfo(seq=seq, size=int(info.group('size')), index=int(info.group('index')), id=int(info.group('id')))
+     index, size, id_ = page.info
+     ali = SequenceInfo(seq=seq, size=size, index=index, id=id_)
      ali.time = strftime(DATETIMEFMT, gmtime())
 
-     if 'Not all factors known' not in page:
+     if page.all_factors_known:
           _logger.error(f'Seq {seq}: strange. Termination?')
           ali.factors = "Reportedly terminated"
           ali.guide, ali.clas, ali.driver = 'Terminated?', -9, True
@@ -188,7 +495,7 @@ def process_ali_data(seq, page):
           return ali
 
      try:
-          factors, cofactor = parse_factors(seq, page, ali.size)
+          factors, cofactor = page.factors(seq, ali.size)
      except FDBDataError as e: # improve error message
           e.args = (f'Seq {seq}, index {ali.index}: ' + e.args[0],) + e.args[1:] # strings and tuples are both immutable... sigh
           raise
@@ -206,46 +513,4 @@ def parse_factors(ident, page, check_size):
      # Parse factors from a given number. Assumes small factors and composites.
      # Error checks against the given `size`.
      # returns factors-as-string, calculated-size (base 10)
-
-     comps = COMPOSITEREGEX.findall(page)
-     smalls = SMALLFACTREGEX.findall(page)
-     bigs = LARGEFACTREGEX.findall(page)
-
-     if not smalls:
-          raise FDBDataError(f'{ident}: no smalls match')
-
-     if smalls[0][0] != '2':
-          raise FDBDataError(f'{ident}: no 2 in the smalls!')
-
-     factors = " * ".join(small for small in smalls)
-     size = 0
-     for small in smalls:
-          if '^' in small:
-               base, exp = small.split('^')
-               size += log10(int(base))*int(exp)
-          else:
-               size += log10(int(small))
-
-     if bigs:
-          for big in bigs:
-               factors += " * P"+big
-               size += int(big)
-
-     if not comps:
-          raise FDBDataError(f'{ident}: no comps match')
-
-     for comp in comps:
-          factors += ' * C'+comp
-          cofactor = int(comp)
-          size += cofactor
-
-     # each big prime, plus the composite itself, introduce up to 1.0 error in the
-     # logsize, e.g. 1.2 * 10^x vs 9.8 * 10^x, the former introduces nearly 1.0
-     # error, the latter introduces nearly 0.0 error, so allow maximum error based on
-     # the number of such primes, assuming all hit the maximum error = 1.0 per prime
-     error_bound = len(bigs) + len(comps)
-
-     if not (check_size - 1 < size < check_size + error_bound):
-          raise FDBDataError(f'{ident}, size {check_size}: garbage factors found: {factors} (calcsize {size:.2f})')
-
-     return factors, cofactor
+     return FDBPage(page).factors(ident, check_size)
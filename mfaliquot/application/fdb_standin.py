@@ -0,0 +1,289 @@
+# This is written to Python 3.6 standards
+# indentation: 5 spaces (eccentric personal preference)
+# when making large backwards scope switches (e.g. leaving def or class blocks),
+# use two blank lines for clearer visual separation
+
+#    Copyright (C) 2014-2017 Bill Winslow
+#
+#    This module is a part of the mfaliquot package.
+#
+#    This program is libre software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+#    See the LICENSE file for more details.
+
+'''A local stand-in for factordb.com, serving recorded responses over HTTP, so
+that the fdb module can be exercised without touching the real FDB. Point the
+fdb module at it by setting fdb.FDBURL to the server's `url`.
+
+RecordedFDBServer serves only what it was given. SimulatedFDBServer also makes
+up plausible pages for any id or sequence it's asked about, and can be made to
+misbehave like the real thing: latency, server errors, garbage data, and the
+"Resources used by your IP" cutoff.'''
+
+import json, logging, threading
+from os.path import join
+from random import Random
+from time import sleep, strftime, gmtime
+from urllib.parse import urlsplit, parse_qs
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+_logger = logging.getLogger(__name__)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer): # http.server has this as of 3.7
+     daemon_threads = True
+
+
+class _StandinHandler(BaseHTTPRequestHandler):
+
+     def do_GET(self):
+          status, ctype, body = self.server.standin.respond(self.path)
+          self.send_response(status)
+          self.send_header('Content-Type', ctype)
+          self.send_header('Content-Length', str(len(body)))
+          self.end_headers()
+          self.wfile.write(body)
+
+
+     def log_message(self, fmt, *args):
+          _logger.debug(fmt % args)
+
+
+class RecordedFDBServer:
+     '''Serves recorded FDB responses from a directory. The directory holds a
+     responses.json manifest, mapping request paths (including the query string,
+     e.g. "/index.php?id=1100000000937782034") to files in the same directory.
+     Unknown paths get a 404, which blogotubes reports as a network error.
+     `directory` may be None, meaning nothing is recorded (for subclasses).'''
+
+     def __init__(self, directory, host='127.0.0.1', port=0):
+          self._directory = directory
+          self._manifest = {}
+          if directory is not None:
+               with open(join(directory, 'responses.json')) as f:
+                    self._manifest = json.load(f)
+          self._host, self._port = host, port
+          self._httpd = None
+          self.requests = [] # every path requested, in order
+
+
+     @property
+     def url(self):
+          '''The base url to substitute for 'http://factordb.com/' '''
+          if self._httpd is None:
+               raise RuntimeError("RecordedFDBServer isn't running")
+          return 'http://{}:{}/'.format(*self._httpd.server_address[:2])
+
+
+     def lookup(self, path):
+          '''Returns the recorded body for `path` as bytes, or None'''
+          name = self._manifest.get(path)
+          if name is None:
+               return None
+          with open(join(self._directory, name), 'rb') as f:
+               return f.read()
+
+
+     def respond(self, path):
+          '''Returns (http_status, content_type, body_bytes) for the request `path`'''
+          self.requests.append(path)
+          body = self.lookup(path)
+          if body is None:
+               _logger.warning(f"no recorded response for {path}")
+               return 404, 'text/plain', b'not recorded'
+          ctype = 'application/json' if body.lstrip().startswith(b'{') else 'text/html; charset=utf-8'
+          return 200, ctype, body
+
+
+     def start(self):
+          self._httpd = _ThreadingHTTPServer((self._host, self._port), _StandinHandler)
+          self._httpd.standin = self
+          self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+          self._thread.start()
+          _logger.info(f"{type(self).__name__} serving {self._directory} at {self.url}")
+
+
+     def stop(self):
+          self._httpd.shutdown()
+          self._httpd.server_close()
+          self._thread.join()
+          self._httpd = None
+
+
+     @contextmanager
+     def serving(self):
+          '''Use this to begin a `with` statement'''
+          self.start()
+          try:
+               yield self
+          finally:
+               self.stop()
+
+
+################################################################################
+# The simulator. The page layouts are copies of those saved in tests/fdb_pages,
+# cut down to what the fdb module actually reads.
+
+_HEADER = '''<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN">
+<html>
+<head>
+<title>factordb.com</title>
+<link rel="stylesheet" href="style.css" type="text/css">
+</head>
+<body>
+<table width="100%" class="header"><tr><td><a href="index.php">Search</a></td><td><a href="sequences.php">Sequences</a></td><td><a href="report.php">Report results</a></td><td><a href="login.php">Login</a></td></tr></table>
+'''
+
+_FOOTER = '''</body>
+</html>
+'''
+
+_SEQUENCE = _HEADER + '''<table border=0 width=100%><tr><td bgcolor="#BBBBBB">Status <a href="status.html" target="_blank">(?)</a></td>
+<td bgcolor="#BBBBBB">n</td>
+<td bgcolor="#BBBBBB">Digits</td>
+<td bgcolor="#BBBBBB">Number</td>
+</tr><tr><td bgcolor="#DDDDDD">Unchecked</td>
+<td bgcolor="#DDDDDD">{index}</td>
+<td bgcolor="#DDDDDD">{size} <a href="index.php?showid={id}">(show)</a></td>
+<td bgcolor="#DDDDDD">{number}</td>
+</tr></table>
+<br>Not all factors known<br>
+''' + _FOOTER
+
+_ID = _HEADER + '''<table border=0 width=100%><tr><td bgcolor="#BBBBBB">Status <a href="status.html" target="_blank">(?)</a></td>
+<td bgcolor="#BBBBBB">Digits</td>
+<td bgcolor="#BBBBBB">Number</td>
+</tr><tr><td>{status}</td>
+<td>{size} <a href="index.php?showid={id}">(show)</a></td>
+<td>{number}</td>
+</tr></table>
+''' + _FOOTER
+
+_MOREINFO = _HEADER + '''<table><tr><td>Number</td><td>{id}</td></tr>
+<tr><td>Created</td><td>{created}</td></tr></table>
+''' + _FOOTER
+
+_LIMIT = _HEADER + '''<h2>Resources used by your IP</h2>
+<table>
+<tr><td>Page requests</td>
+<td align="right">{requests:,}</td></tr>
+<tr><td>IDs created</td>
+<td align="right">0</td></tr>
+<tr><td>Database queries</td>
+<td align="right">{queries:,}</td></tr>
+<tr><td>CPU (Wall clock time)</td>
+<td align="right">{cputime:.2f} seconds</td></tr>
+<tr><td>Counting since</td>
+<td align="right">{since}</td></tr>
+</table>
+''' + _FOOTER
+
+_FACTOR = '''<a href="index.php?id={id}"><font color="#{color}">{digits}</font></a>{sub}'''
+
+def _number_html(fdb_id, size, smalls, cofactor, color):
+     '''The "N = f1 · f2 · ... · C" cell, with the 2^3-style smalls displayed in
+     full and the number and cofactor shown as ellipsized digits'''
+     factors = [_FACTOR.format(id=small.split('^')[0], color='000000', digits=small, sub='') for small in smalls]
+     factors.append(_FACTOR.format(id=fdb_id+1, color=color, digits='1234567890...89', sub=f'<sub>&lt;{cofactor}</sub>'))
+     number = _FACTOR.format(id=fdb_id, color=color, digits='1234567890...56', sub=f'<sub>&lt;{size}</sub>')
+     return number + ' = ' + ' &middot; '.join(factors)
+
+
+class SimulatedFDBServer(RecordedFDBServer):
+     '''Serves recorded responses where `directory` has them (see RecordedFDBServer),
+     and otherwise synthesizes pages which the fdb module will accept:
+
+     index.php?id=<id>: CF, "2^3 * 3 * C<size-1>", or FF with probability `ff_rate`
+     api?id=<id>: the JSON equivalent of the above
+     sequences.php?...&aq=<seq>: a new id at a higher index each time it's asked
+     frame_moreinfo.php?id=<id>: a creation date
+
+     Each request takes `latency` seconds plus up to `jitter` more. With probability
+     `error_rate` it gets an HTTP 500, and with probability `garbage_rate` a page
+     whose factors don't add up. After `limit_after` requests, everything gets the
+     resource limit page. `seed` makes the whole thing reproducible.'''
+
+     def __init__(self, directory=None, host='127.0.0.1', port=0, *, latency=0, jitter=0,
+                  error_rate=0, garbage_rate=0, ff_rate=0.1, limit_after=None, seed=None):
+          super().__init__(directory, host, port)
+          self.latency, self.jitter = latency, jitter
+          self.error_rate, self.garbage_rate, self.ff_rate = error_rate, garbage_rate, ff_rate
+          self.limit_after = limit_after
+          self._random = Random(seed)
+          self._lock = threading.Lock() # the handlers are threaded
+          self._indices = {} # seq -> last served index
+          self._next_id = 1100000002000000000
+          self._since = strftime('%Y-%m-%d %H:%M:%S', gmtime())
+
+
+     def respond(self, path):
+          with self._lock:
+               self.requests.append(path)
+               n = len(self.requests)
+               delay = self.latency + self.jitter*self._random.random()
+               error = self._random.random() < self.error_rate
+               garbage = self._random.random() < self.garbage_rate
+               ff = self._random.random() < self.ff_rate
+          if delay:
+               sleep(delay)
+
+          if self.limit_after is not None and n > self.limit_after:
+               body = _LIMIT.format(requests=n, queries=7*n, cputime=0.05*n, since=self._since)
+               return 200, 'text/html; charset=utf-8', body.encode()
+          if error:
+               return 500, 'text/plain', b'Internal Server Error'
+
+          body = self.lookup(path)
+          if body is not None:
+               ctype = 'application/json' if body.lstrip().startswith(b'{') else 'text/html; charset=utf-8'
+               return 200, ctype, body
+
+          body = self.synthesize(path, garbage, ff)
+          if body is None:
+               _logger.warning(f"can't simulate {path}")
+               return 404, 'text/plain', b'not simulated'
+          ctype = 'application/json' if body.startswith('{') else 'text/html; charset=utf-8'
+          return 200, ctype, body.encode()
+
+
+     def synthesize(self, path, garbage=False, ff=False):
+          '''Returns a made up body (str) for the request `path`, or None'''
+          url = urlsplit(path)
+          query = {key: vals[0] for key, vals in parse_qs(url.query).items()}
+          try:
+               if url.path == '/sequences.php':
+                    return self._sequence_page(int(query['aq']), garbage)
+               fdb_id = int(query['id'])
+          except (KeyError, ValueError):
+               return None
+
+          size = 100 + fdb_id % 80
+          if url.path == '/index.php':
+               status = 'FF' if ff else 'CF'
+               number = _number_html(fdb_id, size, ['2^3', '3'], size - (40 if garbage else 1), '000000' if ff else '002099')
+               return _ID.format(status=status, size=size, id=fdb_id, number=number)
+          elif url.path == '/api':
+               cofactor = '1' + '3'*(size - (40 if garbage else 3)) + '5' # certainly composite
+               factors = [['2', 3], ['3', 1], [cofactor, 1]]
+               return json.dumps({'id': str(fdb_id), 'status': 'FF' if ff else 'CF', 'factors': factors})
+          elif url.path == '/frame_moreinfo.php':
+               return _MOREINFO.format(id=fdb_id, created=strftime('%B %d, %Y', gmtime()))
+          return None
+
+
+     def _sequence_page(self, seq, garbage):
+          with self._lock:
+               index = self._indices[seq] = self._indices.get(seq, 10000 + seq % 1000) + 1
+               fdb_id = self._next_id = self._next_id + 2
+          size = 100 + seq % 80
+          number = _number_html(fdb_id, size, ['2^2', '7'], size - (40 if garbage else 1), '002099')
+          return _SEQUENCE.format(index=index, size=size, id=fdb_id, number=number)
@@ -24,7 +24,10 @@
 
 
 import re, logging
-from .. import blogotubes
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from html import unescape
+from .. import blogotubes, blogotubes_redirect
 
 
 _logger = logging.getLogger(__name__)
@@ -34,34 +37,98 @@ SEQ_REGEX = re.compile(r'(?<![0-9])[0-9]{5,7}(?![0-9])') # matches only 5-7 digi
 # Spidering/reading code
 #
 
-# This is the top level function that spiders the thread
-def spider_res_thread(last_pid):
-     wobsite = 'http://www.mersenneforum.org/showthread.php?t=11588&page='
+THREAD_URL = 'http://www.mersenneforum.org/showthread.php?t=11588&page='
+LASTPOST_URL = 'http://www.mersenneforum.org/showthread.php?t=11588&goto=lastpost'
+_PAGE_REGEX = re.compile(r'<td class="vbmenu_control" style="font-weight:normal">Page ([0-9]+)')
+_PID_REGEX = re.compile(r'[?&]p=([0-9]+)')
+
+
+def latest_pid():
+     '''The cheap probe: vBulletin redirects "goto=lastpost" to "showthread.php?p=<pid>",
+     so this returns the thread's last pid without downloading any page, or None'''
+     url = blogotubes_redirect(LASTPOST_URL)
+     match = _PID_REGEX.search(url) if url else None
+     if not match:
+          _logger.warning(f"forum_spider: couldn't find the last pid from {LASTPOST_URL} (got {url})")
+          return None
+     return int(match.group(1))
+
+
+def _page_hash(html):
+     '''A hash of just the posts of the page, since the rest (who's online etc)
+     changes from one request to the next'''
+     start, end = html.find('<!-- post #'), html.rfind('<!-- / post #')
+     return sha256(html[start:end].encode()).hexdigest()[:16]
+
+
+def _fetch_pages(pages, workers):
+     '''Returns the list of the html of the `pages` (None where it failed),
+     fetched `workers` at a time'''
+     with ThreadPoolExecutor(max_workers=workers) as pool:
+          return list(pool.map(lambda page: blogotubes(THREAD_URL+str(page)), pages))
+
 
-     html = blogotubes(wobsite+'100000') # vBulletin rounds to last page
+# This is the top level function that spiders the thread
+def spider_res_thread(cursor, workers=4):
+     '''Returns (cursor, prev_pages, reservations). `cursor` is a dict of where
+     the last run left off, {"pid": last pid processed, "page": the page it was
+     on, "hash": _page_hash of that page}, any of which may be missing; the
+     returned cursor is the same for this run.
+
+     If latest_pid() shows no new posts, or the last page is unchanged, nothing
+     more is fetched or parsed. Otherwise, if the page is known, all the pages
+     since are fetched at once (`workers` at a time); if not, or if posts have
+     since been deleted, pages are fetched one at a time backwards to the pid.
+     If the last page doesn't say which page it is, it's taken to be the known
+     page (or page 1), and the same backwards walk finds any missed posts.'''
+     last_pid, last_page = cursor.get('pid'), cursor.get('page')
+     if last_pid is not None and latest_pid() == last_pid:
+          _logger.info("no new res thread posts! (last pid unchanged)")
+          return cursor, [], []
+
+     html = blogotubes(THREAD_URL+'100000') # vBulletin rounds to last page
      if not html:
           _logger.error(f"unable to spider forum")
-          return last_pid, [], []
-     all_pages = [_parse_page(html)]
-     lowest_pid = _order_posts(all_pages[0])
+          return cursor, [], []
+     page_hash = _page_hash(html)
+     if last_pid is not None and page_hash == cursor.get('hash'):
+          _logger.info("no new res thread posts! (last page unchanged)")
+          return cursor, [], []
+     match = _PAGE_REGEX.search(html)
+     if match:
+          page_num = int(match.group(1))
+     else: # no pagenav, a one page thread or a changed layout
+          page_num = last_page or 1
+          _logger.warning(f"forum_spider: no page number on the last page, assuming page {page_num}")
+     pages = {page_num: _parse_page(html)}
+     lowest_pid = _order_posts(pages[page_num])
 
      if not last_pid: # If this is the first time running the script
           last_pid = lowest_pid # On first time run, ignore all but the last page
 
      prev_pages = []
-     while lowest_pid > last_pid: # It's probable that we missed some posts on previous page
-          page_num = re.search('<td class="vbmenu_control" style="font-weight:normal">Page ([0-9]+)', html).group(1)
-          page_num = str(int(page_num)-1)
-          _logger.info("forum_spider: looks like posts were missed, checking page {}".format(page_num))
-          prev_pages.append(page_num)
-          html = blogotubes(wobsite+page_num)
+     if lowest_pid > last_pid and last_page is not None and last_page < page_num:
+          missed = list(range(last_page, page_num))
+          _logger.info(f"forum_spider: looks like posts were missed, fetching pages {missed[0]}-{missed[-1]}")
+          for page, html in zip(missed, _fetch_pages(missed, workers)):
+               if not html:
+                    _logger.error(f"unable to spider forum (prev page {page})")
+                    return cursor, [], []
+               pages[page] = _parse_page(html)
+          prev_pages.extend(str(page) for page in reversed(missed))
+
+     first = min(pages)
+     while _order_posts(pages[first]) > last_pid and first > 1: # It's probable that we missed some posts on previous page
+          first -= 1
+          _logger.info("forum_spider: looks like posts were missed, checking page {}".format(first))
+          prev_pages.append(str(first))
+          html = blogotubes(THREAD_URL+str(first))
           if not html:
                _logger.error(f"unable to spider forum (prev page)")
-               return last_pid, [], []
-          all_pages.insert(0, _parse_page(html))
-          lowest_pid = _order_posts(all_pages[0])
+               return cursor, [], []
+          pages[first] = _parse_page(html)
 
-     all_posts = [post for page in all_pages for post in page if post[0] > last_pid]
+     all_posts = [post for page in sorted(pages) for post in pages[page] if post[0] > last_pid]
      all_res = []
      if all_posts:
           _order_posts(all_posts) # Assert order, ignore lowest pid retval
@@ -69,75 +136,113 @@ def spider_res_thread(last_pid):
                adds, drops, updates = _read_msg(msg)
                if adds or drops or updates:
                     _logger.info(f'post id {pid}: {name} adding {adds}, dropping {drops}, updating {updates}')
-               all_res.append((name, adds, drops, updates))
+               all_res.append((pid, name, adds, drops, updates))
           last_pid = all_posts[-1][0] # Highest PID processed
      else:
           _logger.info("no new res thread posts!")
 
-     return last_pid, prev_pages, all_res
+     return {'pid': last_pid, 'page': page_num, 'hash': page_hash}, prev_pages, all_res
 
 
 # This processes the parsed HTML and its add/drop commands
+# The keywords only count at the start of a word (so "unreserve" is never
+# "reserve", and "preserve" is nothing), and case doesn't matter
+_COMMAND_REGEX = re.compile(r'''(?<![a-z])(?:(?P<drop>unreserv|drop|releas)
+                                              |(?P<add>reserv|add|tak)
+                                              |(?P<update>update))
+                              |(?P<seq>{})'''.format(SEQ_REGEX.pattern), re.IGNORECASE | re.VERBOSE)
+
+
 def _read_msg(msg):
-     '''This processes the parsed HTML and its add/drop commands. Returns the two
-     such list of sequences.'''
-     add = []; addkws = ('Reserv', 'reserv', 'Add', 'add', 'Tak', 'tak')
-     drop = []; dropkws = ('Unreserv', 'unreserv', 'Drop', 'drop', 'Releas', 'releas')
-     update = []; updatekws = ('Update', 'update')
+     '''This processes the parsed HTML and its add/drop commands. Returns the three
+     such tuples of sequences: adds, drops, updates. Each line is scanned once: a
+     sequence belongs to the nearest command before it on the line, or if there is
+     none, the first one after it; lines without commands are ignored.'''
+     out = {'add': [], 'drop': [], 'update': []}
 
      for line in msg.splitlines():
-          if any(kw in line for kw in dropkws):
-               for s in SEQ_REGEX.findall(line):
-                    drop.append(int(s))
-          elif any(kw in line for kw in addkws):
-               for s in SEQ_REGEX.findall(line):
-                    add.append(int(s))
-          elif any(kw in line for kw in updatekws):
-               for s in SEQ_REGEX.findall(line):
-                    update.append(int(s))
+          command, pending = None, []
+          for m in _COMMAND_REGEX.finditer(line):
+               kind = m.lastgroup
+               if kind == 'seq':
+                    (out[command] if command else pending).append(int(m.group()))
+               else:
+                    if not command:
+                         out[kind].extend(pending)
+                    command = kind
 
-     return tuple(add), tuple(drop), tuple(update)
+     return tuple(out['add']), tuple(out['drop']), tuple(out['update'])
 
 
 # Begin the parsers, converts the various HTML into Python data structures for processing
-# Also reverse stack order
-# For each page of the thread, the parsers return a list of (post_id, author, html-replaced-post_body)
-
-# All of my previous html parsing needs have been simple enough that regexs were sufficient,
-# and a proper parser would have been overkill; this, though, is much closer to the border, and if I
-# already knew how to use any parser, I would. But the overhead is too much to start now, so...
-# thankfully there are comments in the html that are individually closed; without that,
-# this would be substantially harder and I'd probably resort to a parser.
-def _parse_msg(msg):
-     # Drop text after the last </div>
-     ind = msg.rfind('</div>')
-     msg = msg[:ind]
-     if msg.count('<div') > 1: # There are quotes in the message
-          # drop text before the second to last </div>
-          ind = msg.rfind('</div>')
-          msg = msg[ind+6:]
-     else:
-          # drop text after the first tag
-          # ^^ this comment doesn't match the code?
-          ind = msg.find('>')
-          msg = msg[ind+1:]
-     return msg.replace('<br />', '').strip()
-
-
-def _parse_post(post):
-     name = re.search(r'''alt="(.*?) is o''', post).group(1) # "is offline" or "is online"
-     msg = re.search(r'<!-- message -->(.*?)<!-- / message -->', post, re.DOTALL).group(1)
-     return name, _parse_msg(msg)
+# For each page of the thread, the parsers return a list of (post_id, author, post_text)
+
+# This used to be a handful of regexes and string slicing, relying on the html
+# comments vBulletin puts around each post and message. It was brittle with quotes
+# (only the text after the last quote was kept), so now each message's tags are
+# scanned in order, skipping the quotes properly. That's still regexes: running
+# html.parser over the page is ten times slower. See scripts/bench_forum_parse.py.
+_POST_REGEX = re.compile(r'<!-- post #([0-9]+) -->(.*?)<!-- / post #\1 -->', re.DOTALL)
+_MESSAGE_REGEX = re.compile(r'<!-- message -->(.*?)<!-- / message -->', re.DOTALL)
+_AUTHOR_REGEX = re.compile(r'<img[^>]*? alt="([^"]*) is o') # "is offline" or "is online"
+_TAG_REGEX = re.compile(r'<!--.*?-->|<(/?)([a-zA-Z][a-zA-Z0-9]*)([^>]*)>', re.DOTALL)
+_SMALLFONT_REGEX = re.compile(r'''\sclass\s*=\s*(["']?)smallfont\1(?![\w-])''')
+_BREAKS = {'br', 'div', 'p', 'pre', 'li', 'tr'}
+
+def _message_text(msg):
+     '''The text of one post's message html: the tags are removed (<br>s and
+     blocks become line breaks, blank lines are dropped), except that quotes
+     (and the "Quote:" and "Code:" labels) are skipped entirely.'''
+     out, pos = [], 0
+     skip, depth = None, 0 # the tag of the quote being skipped, and its nesting
+     for m in _TAG_REGEX.finditer(msg):
+          if not skip:
+               out.append(msg[pos:m.start()])
+          pos = m.end()
+          close, tag, attrs = m.groups()
+          if tag is None: # a comment
+               continue
+          tag = tag.lower()
+          if skip:
+               if tag == skip and not attrs.endswith('/'):
+                    depth += -1 if close else 1
+                    if not depth:
+                         skip = None
+          elif not close and (tag == 'table' or (tag == 'div' and _SMALLFONT_REGEX.search(attrs))):
+               skip, depth = tag, 1
+          elif tag in _BREAKS:
+               out.append('\n')
+     if not skip:
+          out.append(msg[pos:])
+     lines = (line.strip() for line in unescape(''.join(out)).splitlines())
+     return '\n'.join(line for line in lines if line)
+
+
+def _read_post(pid, post):
+     author, message = _AUTHOR_REGEX.search(post), _MESSAGE_REGEX.search(post)
+     if not author:
+          raise ValueError(f"post {pid} has no author, has the forum changed its html?")
+     return int(pid), unescape(author.group(1)), _message_text(message.group(1)) if message else ''
+
+
+def iter_posts(chunks):
+     '''Yields the (pid, author, text) of each post as soon as it's complete, from
+     an iterable of pieces of a page'''
+     buf = ''
+     for chunk in chunks:
+          buf += chunk
+          end = 0
+          for m in _POST_REGEX.finditer(buf):
+               yield _read_post(*m.groups())
+               end = m.end()
+          start = buf.find('<!-- post #', end)
+          # keep only what may yet become a post
+          buf = buf[start:] if start >= 0 else buf[max(end, len(buf) - len('<!-- post #')):]
 
 
 def _parse_page(page):
      '''returns a list of (pid, name, msg)s'''
-     out = []
-     posts = re.findall(r'<!-- post #([0-9]{6,7}) -->(.*?)<!-- / post #\1 -->', page, re.DOTALL)
-     for post in posts:
-          #name, msg = parse_post(post[1])
-          out.append(  (int(post[0]),) + _parse_post(post[1])  )
-     return out
+     return list(iter_posts((page,)))
 
 
 # End parsers, one tiny helper function for spider_forum()
@@ -24,10 +24,14 @@
 # It delegates heavily to forum_xaction for such
 
 from .forum_xaction import spider_res_thread, SEQ_REGEX
+from .reshistory import ReservationHistory
+from .website import atomic_write
 from .sequence import DATETIMEFMT
-from .. import blogotubes
+from .. import blogotubes_conditional, NOT_MODIFIED
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
 from time import strftime, gmtime
-import logging, re
+import logging, re, json
 
 _logger = logging.getLogger(__name__)
 
@@ -36,94 +40,181 @@ class ReservationsSpider: # name is of debatable good-ness
      '''A class to manage the statefulness of spidering the MersenneForum res
      thread. Delegates the primary spidering logic to the module level functions.'''
 
-     def __init__(self, seqinfo, config):
+     def __init__(self, seqinfo, config, history=None):
           '''`seqinfo` should be a SequencesManager instance. It is assumed to
-          already have acquired its lock.'''
+          already have acquired its lock. `history` is the ReservationHistory of
+          the config's historyfile, if the caller already has one (there must
+          only be one per file).'''
           self.seqinfo = seqinfo
           self.pidfile = config['pidfile']
           self.mass_reses = config['mass_reservations']
+          self.workers = config.get('spider_workers', 4) # pages of the res thread (or mass res files) to fetch at once
+          self.mass_cache = config.get('mass_cache') # None to always fetch and diff the mass res files in full
+          historyfile = config.get('historyfile') # None for no reservation history, see reshistory.py
+          if history is None and historyfile:
+               history = ReservationHistory(historyfile)
+          self.history = history
 
 
-     def spider_all_apply_all(self):
+     def _read_cursor(self):
+          '''Returns the spider_res_thread cursor dict. The pidfile used to hold
+          only the pid.'''
           try:
                with open(self.pidfile, 'r') as f:
-                    last_pid = int(f.read())
+                    cursor = json.load(f)
           except FileNotFoundError:
-               last_pid = None
+               return {}
+          if isinstance(cursor, int):
+               return {'pid': cursor}
+          return cursor
+
 
-          last_pid, *other = update_apply_all_res(self.seqinfo, last_pid, self.mass_reses)
+     def _read_mass_cache(self):
+          if not self.mass_cache:
+               return None
+          try:
+               with open(self.mass_cache, 'r') as f:
+                    return json.load(f)
+          except FileNotFoundError:
+               return {}
 
-          if last_pid is not None:
-               with open(self.pidfile, 'w') as f:
-                    f.write(str(last_pid) + '\n')
 
+     def spider_all_apply_all(self):
+          '''Apply all reservations to the seqinfo. Call save_state() once the
+          seqinfo has been written.'''
+          if self.history:
+               self.history.seed(strftime(DATETIMEFMT, gmtime()), self.seqinfo)
+          mass_cache = self._read_mass_cache()
+          cursor, *other = update_apply_all_res(self.seqinfo, self._read_cursor(), self.mass_reses, self.workers, mass_cache, self.history)
+          self._state = cursor, mass_cache
           return other[1:] # other[0] == prev_pages
 
 
+     def save_state(self):
+          '''Save where the spidering left off, and the reservation history, which
+          must only be done after the reservations found are safely written: else
+          they'd never be retried, and the history would record what never was'''
+          cursor, mass_cache = self._state
+          if cursor.get('pid') is not None:
+               atomic_write(self.pidfile, (json.dumps(cursor) + '\n').encode())
+          if mass_cache is not None:
+               atomic_write(self.mass_cache, (json.dumps(mass_cache) + '\n').encode())
+          if self.history:
+               self.history.flush()
+
+
 ################################################################################
 
 
-# First the standalone func that processes mass text file reservations
-def parse_mass_reservation(reservee, url):
+# First the standalone funcs that fetch and process mass text file reservations
+def fetch_mass_reservations(mass_reses, mass_cache, workers=4):
+     '''Fetches every reservee's file at once, `workers` at a time, each conditional
+     on the validators in its `mass_cache` entry (if any, and for the same url).
+     Returns {reservee: (txt, validators)}, txt being as from blogotubes_conditional'''
+     def fetch(reservee):
+          cached = mass_cache.get(reservee) or {}
+          validators = cached.get('validators') if cached.get('url') == mass_reses[reservee] and 'seqs' in cached else None
+          return blogotubes_conditional(mass_reses[reservee], validators)
+     with ThreadPoolExecutor(max_workers=workers) as pool:
+          return dict(zip(mass_reses, pool.map(fetch, mass_reses)))
+
+
+def parse_mass_reservation(reservee, txt):
      '''Parses a '\n' separated list of sequences, to be reserved to the given
      name. Returns (current_entries, duplicate_seqs, unknown_lines)'''
-     txt = blogotubes(url)
-     if not txt:
-          _logger.error(f"unable to get mass reservation file for {reservee}")
-          return None, None, None
      current, dups, unknowns = set(), [], []
      for line in txt.splitlines():
           if SEQ_REGEX.match(line):
                seq = int(line)
                if seq in current:
-                    _logger.error("mass reservation: mass res-er {} listed a duplicate for {}".format(name, seq))
+                    _logger.error("mass reservation: mass res-er {} listed a duplicate for {}".format(reservee, seq))
                     dups.append(seq)
                else:
                     current.add(seq)
           elif not re.match(r'^[0-9]+$', line): # don't remember what purpose this line serves, ignoring any number-shaped thing that isn't a 5-7 digit sequence
-               _logger.error("mass reservation: unknown line from {}: '{}'".format(name, line))
+               _logger.error("mass reservation: unknown line from {}: '{}'".format(reservee, line))
                unknowns.append(line)
      return current, dups, unknowns
 
 
-def update_apply_all_res(seqinfo, last_pid, mass_reses):
+def update_apply_all_res(seqinfo, cursor, mass_reses, workers=4, mass_cache=None, history=None):
      '''Searches all known reservations, returning compiled reses to be applied,
-     as well as various results from subordinate functions'''
+     as well as various results from subordinate functions. `cursor` and
+     `workers` are passed to spider_res_thread.
+
+     Each mass res file is the reservee's complete list, applied with
+     SequencesManager.apply_reservation_snapshot: first its drops, then the res
+     thread's reservations, then its adds. That's always diffed against the
+     table, so anything rejected or changed since is retried or restored.
+     `mass_cache`, if given, is a dict updated in place with the last fetch of
+     each file, so that one unchanged since (as far as the server or a hash of
+     it says) needn't be downloaded or parsed again.
+
+     `history`, if given, is a ReservationHistory to record every change in (the
+     caller should flush it).'''
 
      now = strftime(DATETIMEFMT, gmtime())
 
-     last_pid, prev_pages, thread_res = spider_res_thread(last_pid)
+     cursor, prev_pages, thread_res = spider_res_thread(cursor, workers)
+
+     if mass_cache is None:
+          mass_cache = {}
+     fetched = fetch_mass_reservations(mass_reses, mass_cache, workers)
 
-     mass_adds = []
-     mass_reses_out = []
+     mass_adds, mass_reses_out = [], []
      for reservee, url in mass_reses.items():
-          current, dups, unknowns = parse_mass_reservation(reservee, url)
-          if current is None or dups is None or unknowns is None:
+          txt, validators = fetched[reservee]
+          entry = mass_cache.get(reservee) or {}
+          if entry.get('url') != url:
+               entry = {}
+          if txt is NOT_MODIFIED and 'seqs' not in entry: # never asked for
+               _logger.error(f"mass reservation file for {reservee} not modified, but there's no copy of it")
+               _logger.info(f"skipping reservations from {reservee}")
+               continue
+          elif txt is NOT_MODIFIED:
+               _logger.info(f"mass reservations for {reservee} unchanged (server says)")
+               entry = dict(entry, validators=validators)
+          elif txt is None:
+               _logger.error(f"unable to get mass reservation file for {reservee}")
                _logger.info(f"skipping reservations from {reservee}")
                continue
-          old = set(ali.seq for ali in seqinfo.values() if ali.res == reservee)
-          drops = old - current
-          adds = current - old
-          if adds or drops:
-               _logger.info(f"mass reservee {reservee}: add {len(adds)} seqs, drop {len(drops)}")
           else:
-               _logger.info(f"no res changes for {reservee}")
-          dropres = seqinfo.unreserve_seqs(reservee, drops)
-          mass_adds.append((reservee, adds))
+               digest = sha256(txt.encode()).hexdigest()
+               if entry.get('sha256') == digest and 'seqs' in entry:
+                    _logger.info(f"mass reservations for {reservee} unchanged")
+                    entry = dict(entry, validators=validators)
+               else:
+                    current, dups, unknowns = parse_mass_reservation(reservee, txt)
+                    entry = {'url': url, 'validators': validators, 'sha256': digest, 'seqs': sorted(current),
+                             'dups': dups, 'unknowns': unknowns}
+          mass_cache[reservee] = entry
+
+          current, dups, unknowns = set(entry['seqs']), entry.get('dups', []), entry.get('unknowns', [])
+          dropres = seqinfo.apply_reservation_snapshot(reservee, current, add=False)[1]
+          mass_adds.append((reservee, current))
           mass_reses_out.append([reservee, dups, unknowns, dropres])
+          if history:
+               history.record(now, 'mass', None, reservee, 'drop', dropres[0])
 
      out = []
-     for name, adds, drops, updates in thread_res:
+     for pid, name, adds, drops, updates in thread_res:
           addres = seqinfo.reserve_seqs(name, adds)
           dropres = seqinfo.unreserve_seqs(name, drops)
           updateres = seqinfo.update_seqs(name, updates)
           out.append((name, addres, dropres, updateres))
+          if history:
+               history.record(now, 'thread', pid, name, 'add', addres[0])
+               history.record(now, 'thread', pid, name, 'drop', dropres[0])
+               history.record(now, 'thread', pid, name, 'update', updateres[0])
 
-     for name_adds, lst in zip(mass_adds, mass_reses_out):
-          lst.append(seqinfo.reserve_seqs(*name_adds))
+     for (reservee, current), lst in zip(mass_adds, mass_reses_out):
+          addres = seqinfo.apply_reservation_snapshot(reservee, current, drop=False)[0]
+          lst.append(addres)
+          if history:
+               history.record(now, 'mass', None, reservee, 'add', addres[0])
 
      seqinfo.resdatetime = now
 
-     return last_pid, prev_pages, out, mass_reses_out # What a mess of data
+     return cursor, prev_pages, out, mass_reses_out # What a mess of data
      # mass_reses_out = list-of [name, dups, unknowns, dropres, addres]
 
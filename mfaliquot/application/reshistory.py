@@ -0,0 +1,246 @@
+# This is written to Python 3.6 standards
+# indentation: 5 spaces (eccentric personal preference)
+# when making large backwards scope switches (e.g. leaving def or class blocks),
+# use two blank lines for clearer visual separation
+
+#    Copyright (C) 2014-2017 Bill Winslow
+#
+#    This module is a part of the mfaliquot package.
+#
+#    This program is libre software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+#    See the LICENSE file for more details.
+
+'''The reservation history: every reservation change that was actually made,
+from the res thread, a mass reservation file or the command line, appended to
+a log, one JSON list per line:
+
+[time, source, post id or null, name, "add"/"drop"/"update", [seqs]]
+
+The times are DATETIMEFMT strings, which sort as they compare. The log is only
+ever appended to, so a crash can at worst leave one truncated line at the end,
+which is ignored. A new log is seeded with the res column as it was then, as
+"add"s from the source "seed", so replaying it from the start gives the res
+column as of any time since, so it can be audited or rebuilt without
+re-spidering anything.
+
+For single sequences there's an index, kept in the log's file + ".index": for
+each seq, the [time, holder] of each change of its holder ('' once dropped),
+and how many bytes of the log it covers. It's brought up to date with whatever
+has been appended since, so it's only ever rebuilt if lost.'''
+
+import json, logging
+from bisect import bisect_right
+from collections import defaultdict
+from os import fsync
+from time import strftime, gmtime
+from .sequence import DATETIMEFMT
+from .website import atomic_write
+
+_logger = logging.getLogger(__name__)
+
+
+class ReservationHistory:
+     '''The log and its index. The `file` constructor argument is immutable for
+     the lifetime of the object. Events are recorded in memory and written with
+     flush().'''
+
+     SOURCES = ('thread', 'mass', 'cli', 'seed')
+     OPS = ('add', 'drop', 'update')
+
+     def __init__(self, file):
+          self._file = file
+          self._indexfile = file + '.index'
+          self._index = None # seq -> [[time, holder], ...], loaded on first use
+          self._indexed = 0 # bytes of the log covered by the index
+          self._pending = []
+
+     @property
+     def file(self):
+          return self._file
+
+
+     def record(self, time, source, pid, name, op, seqs):
+          '''Record that `name`'s `seqs` were added, dropped or updated (`op`)'''
+          if source not in self.SOURCES:
+               raise ValueError(f"unknown reservation source {source!r}")
+          if op not in self.OPS:
+               raise ValueError(f"unknown reservation op {op!r}")
+          if seqs:
+               self._pending.append([time, source, pid, name, op, sorted(seqs)])
+
+
+     def seed(self, time, seqinfo):
+          '''If the log is empty, start it with every reservation in `seqinfo` (as
+          of `time`), written at once, else replaying the log would miss every
+          reservation made before it. Returns the count of reservations seeded.'''
+          if self.start() is not None:
+               return 0
+          held = defaultdict(list)
+          for ali in seqinfo.values():
+               if ali.res:
+                    held[ali.res].append(ali.seq)
+          pending, self._pending = self._pending, []
+          for name in sorted(held):
+               self.record(time, 'seed', None, name, 'add', held[name])
+          self.flush()
+          self._pending = pending
+          count = sum(map(len, held.values()))
+          if count:
+               _logger.info(f"seeded {self._file} with {count} reservations")
+          return count
+
+
+     def start(self):
+          '''The time of the first event in the log, or None if there are none'''
+          for offset, event in self.events():
+               return event[0]
+          return None
+
+
+     def flush(self):
+          '''Append the recorded events to the log, and bring the index (if it's
+          been used) up to date. Returns the count of events written.'''
+          if not self._pending:
+               return 0
+          lines = [json.dumps(event, ensure_ascii=False) for event in self._pending]
+          with open(self._file, 'ab+') as f:
+               if f.tell(): # don't append to a line truncated by a crash
+                    f.seek(-1, 2)
+                    if f.read(1) != b'\n':
+                         lines.insert(0, '')
+               f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+               f.flush()
+               fsync(f.fileno())
+          count, self._pending = len(self._pending), []
+          _logger.debug(f"appended {count} reservation events to {self._file}")
+          if self._index is not None:
+               self._catch_up()
+          return count
+
+
+     def events(self, offset=0):
+          '''Lazily yields (offset, event) for each valid event in the log from
+          byte `offset`, where offset is that of the end of the event'''
+          try:
+               f = open(self._file, 'rb')
+          except FileNotFoundError:
+               return
+          with f:
+               f.seek(offset)
+               for line in f:
+                    offset += len(line)
+                    if not line.endswith(b'\n'): # truncated by a crash, or being written
+                         return
+                    try:
+                         time, source, pid, name, op, seqs = event = json.loads(line)
+                         if op not in self.OPS:
+                              raise ValueError(op)
+                    except ValueError:
+                         _logger.warning(f"{self._file}: ignoring malformed event {line[:80]!r}")
+                         continue
+                    yield offset, event
+
+
+     def holders(self, until=None):
+          '''One pass over the log: returns {seq: name} of every seq reserved as
+          of `until` (a DATETIMEFMT string, None for now)'''
+          out = {}
+          for offset, (time, source, pid, name, op, seqs) in self.events():
+               if until is not None and time > until:
+                    break
+               if op == 'add':
+                    out.update(dict.fromkeys(seqs, name))
+               elif op == 'drop':
+                    for seq in seqs:
+                         out.pop(seq, None)
+          return out
+
+
+     def who_held(self, seq, time=None):
+          '''Returns who held `seq` at `time` (None for now) from the index, or ''
+          if nobody did (as far as the history goes)'''
+          if self._index is None:
+               self._load_index()
+          timeline = self._index.get(seq)
+          if not timeline:
+               return ''
+          if time is None:
+               return timeline[-1][1]
+          i = bisect_right([t for t, name in timeline], time)
+          return timeline[i-1][1] if i else ''
+
+
+     def _load_index(self):
+          try:
+               with open(self._indexfile, 'r') as f:
+                    data = json.load(f)
+               index = {int(seq): timeline for seq, timeline in data['seqs'].items()}
+               indexed = data['size']
+          except (FileNotFoundError, ValueError, KeyError):
+               index, indexed = {}, 0
+          try:
+               with open(self._file, 'rb') as f:
+                    size = f.seek(0, 2)
+          except FileNotFoundError:
+               size = 0
+          if indexed > size: # the log was replaced
+               _logger.warning(f"{self._indexfile} is ahead of {self._file}, rebuilding it")
+               index, indexed = {}, 0
+          self._index, self._indexed = defaultdict(list, index), indexed
+          self._catch_up()
+
+
+     def _catch_up(self):
+          count = 0
+          for offset, (time, source, pid, name, op, seqs) in self.events(self._indexed):
+               self._indexed = offset
+               if op == 'update':
+                    continue
+               holder = name if op == 'add' else ''
+               for seq in seqs:
+                    self._index[seq].append([time, holder])
+               count += 1
+          if count:
+               data = {'size': self._indexed, 'seqs': self._index}
+               atomic_write(self._indexfile, json.dumps(data, separators=(',', ':')).encode())
+               _logger.info(f"indexed {count} new reservation events from {self._file}")
+
+
+def rebuild_res(seqinfo, history, until=None):
+     '''Make the res column of `seqinfo` (a SequencesManager, with its lock)
+     exactly as `history` says it was as of `until` (None for now). The changes
+     are recorded in `history`, which the caller should flush once `seqinfo` is
+     written. Returns the {name: (addres, dropres)} of the
+     apply_reservation_snapshot of each name.
+     Raises ValueError if the history doesn't go back as far as `until`.'''
+     start = history.start()
+     if start is None or (until is not None and until < start):
+          raise ValueError(f"{history.file} only starts at {start}, can't rebuild as of {until or 'now'}")
+     target = defaultdict(set)
+     for seq, name in history.holders(until).items():
+          target[name].add(seq)
+     current = defaultdict(set)
+     for ali in seqinfo.values():
+          if ali.res:
+               current[ali.res].add(ali.seq)
+
+     # First every name only drops, so that the adds never find the seq taken
+     names = current.keys() | target.keys()
+     dropres = {name: seqinfo.apply_reservation_snapshot(name, target[name], add=False)[1] for name in names}
+     out = {name: (seqinfo.apply_reservation_snapshot(name, target[name], drop=False)[0], dropres[name]) for name in names}
+
+     # The rebuild is itself a change, which the log must know of to stay in step
+     now = strftime(DATETIMEFMT, gmtime())
+     for name in sorted(names):
+          history.record(now, 'cli', None, name, 'drop', out[name][1][0])
+     for name in sorted(names):
+          history.record(now, 'cli', None, name, 'add', out[name][0][0])
+     return out
@@ -0,0 +1,155 @@
+# This is written to Python 3.6 standards
+# indentation: 5 spaces (eccentric personal preference)
+# when making large backwards scope switches (e.g. leaving def or class blocks),
+# use two blank lines for clearer visual separation
+
+#    Copyright (C) 2014-2017 Bill Winslow
+#
+#    This module is a part of the mfaliquot package.
+#
+#    This program is libre software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+#    See the LICENSE file for more details.
+
+'''Retrying flaky remote calls. A RetryPolicy retries the errors it's told are
+transient, with exponentially growing, randomly jittered delays, and re-raises
+everything else at once. A CircuitBreaker shared between policies stops all
+calls for a while once the remote end has failed too many times in a row, then
+lets a single probe call through to see if it's back (the "half open" state).'''
+
+import logging
+from random import random
+from time import monotonic
+from .. import network_sleep
+
+_logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception): pass
+
+
+class CircuitBreaker:
+     '''Opens after `threshold` consecutive failures, refusing calls for
+     `cooldown` seconds, after which it's half open: the next call is a probe,
+     whose success closes the circuit and whose failure reopens it.'''
+
+     CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half open'
+
+     def __init__(self, threshold=5, cooldown=60, clock=monotonic):
+          self.threshold = threshold
+          self.cooldown = cooldown
+          self._clock = clock
+          self._failures = 0
+          self._opened = None # clock() when opened, None when closed
+
+     @property
+     def state(self):
+          if self._opened is None:
+               return self.CLOSED
+          if self._clock() - self._opened < self.cooldown:
+               return self.OPEN
+          return self.HALF_OPEN
+
+
+     def remaining(self):
+          '''Seconds until an open circuit goes half open'''
+          if self._opened is None:
+               return 0
+          return max(0, self.cooldown - (self._clock() - self._opened))
+
+
+     def before_call(self):
+          if self.state == self.OPEN:
+               raise CircuitOpenError(f"circuit open after {self._failures} consecutive failures, {self.remaining():.0f}s to go")
+
+
+     def succeeded(self):
+          if self._opened is not None:
+               _logger.info("circuit closed, the probe call succeeded")
+          self._failures = 0
+          self._opened = None
+
+
+     def failed(self):
+          self._failures += 1
+          if self._opened is not None: # a failed probe
+               _logger.warning("probe call failed, circuit reopened")
+               self._opened = self._clock()
+          elif self._failures >= self.threshold:
+               _logger.error(f"{self._failures} consecutive failures, opening circuit for {self.cooldown}s")
+               self._opened = self._clock()
+
+
+class RetryPolicy:
+     '''Calls a function up to `tries` times. Exceptions in `retry_on` are retried
+     after a delay of base_delay*2**n seconds (capped at max_delay), scaled down by
+     up to the `jitter` fraction at random so that retries don't synchronize.
+     Exceptions in `fatal` are re-raised at once even if they are also in
+     `retry_on`, and anything else propagates untouched. Only the exceptions in
+     `trip_on` count as failures for the `breaker`: bad data for one item says
+     nothing about the health of the server. If the breaker is open, the policy
+     waits it out, using up a try, and then probes.'''
+
+     def __init__(self, tries=5, base_delay=2, max_delay=60, jitter=0.5, retry_on=(), fatal=(),
+                  trip_on=(), breaker=None, sleep=network_sleep):
+          self.tries = tries
+          self.base_delay = base_delay
+          self.max_delay = max_delay
+          self.jitter = jitter
+          self.retry_on = tuple(retry_on)
+          self.fatal = tuple(fatal)
+          self.trip_on = tuple(trip_on)
+          self.breaker = breaker
+          self._sleep = sleep
+
+
+     def delay(self, attempt):
+          '''The delay after the `attempt`-th (zero-based) failure'''
+          return min(self.max_delay, self.base_delay * 2**attempt) * (1 - self.jitter*random())
+
+
+     def call(self, func, *args, label=None, tries=None):
+          '''Returns func(*args), or raises the last error once out of tries.
+          `label` prefixes the log messages.'''
+          tries = self.tries if tries is None else tries
+          label = label or func.__name__
+          for attempt in range(tries):
+               left = tries - attempt - 1
+               if self.breaker:
+                    try:
+                         self.breaker.before_call()
+                    except CircuitOpenError as e:
+                         if not left:
+                              raise
+                         _logger.info(f"{label}: {str(e)}, waiting ({left} tries left)")
+                         self._sleep(self.breaker.remaining())
+                         continue
+
+               try:
+                    out = func(*args)
+               except self.fatal:
+                    raise
+               except self.retry_on as e:
+                    if self.breaker:
+                         if isinstance(e, self.trip_on):
+                              self.breaker.failed()
+                         else: # the server did answer
+                              self.breaker.succeeded()
+                    if not left:
+                         _logger.warning(f"{label}: giving up after {tries} tries: {type(e).__name__}: {str(e)}")
+                         raise
+                    delay = self.delay(attempt)
+                    _logger.info(f"{label}: {type(e).__name__}: {str(e)}, retrying in {delay:.1f}s ({left} tries left)")
+                    self._sleep(delay)
+                    continue
+
+               if self.breaker:
+                    self.breaker.succeeded()
+               return out
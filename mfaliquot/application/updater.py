@@ -21,13 +21,88 @@
 '''This is the module that contains the AllSeqUpdater class, which contains the
 primary logic to interface with the FDB to actually update SequencesManager instances'''
 
-from time import sleep
 from subprocess import Popen
+from multiprocessing import get_context
+from time import monotonic
+from .. import network_sleep
 from . import fdb
+from .factstore import FDBFactStore
 from .sequence import SequenceInfo
+from .website import ArtifactWriter, load_template
 import logging, signal, json
 _logger = logging.getLogger(__name__)
 
+# Selected by the 'fdb_transport' config key, sequence pages are always html
+_QUERY_ID = {'html': fdb.query_id, 'json': fdb.query_id_json}
+
+
+class _BackgroundFinalizer:
+     '''Runs a function in a forked child process, so the parent may carry on (and
+     release the lock) at once. Submissions made while the previous child is
+     still running are coalesced: only the latest is kept, and it runs at the next
+     submit() or finish() after the previous child is done, which may be long
+     after (e.g. in the middle of the next daemon cycle). So the arguments must
+     be a snapshot of whatever the function needs, never a live SequencesManager.
+
+     The child logs through copies of the parent's handlers. Buffering handlers
+     (e.g. BufferingSMTPHandler) are emptied when it starts, so that it reports
+     only its own records, and all handlers are flushed and closed when it ends,
+     since a forked child exits without the usual atexit cleanup.'''
+
+     def __init__(self):
+          self._context = get_context('fork')
+          self._child = None
+          self._pending = None
+
+
+     def submit(self, func, *args):
+          self._pending = func, args
+          if self._child is not None and self._child.is_alive():
+               _logger.info("Previous finalization still running, coalescing this one into the next")
+               return
+          if self._child is not None:
+               self._child.join()
+               self._reap()
+          self._start_pending()
+
+
+     def _reap(self):
+          if self._child.exitcode:
+               _logger.error(f"Background finalization process {self._child.pid} failed with exit code {self._child.exitcode}")
+          self._child = None
+
+
+     def _start_pending(self):
+          func, args = self._pending
+          self._pending = None
+          self._child = self._context.Process(target=self._run, args=(func,)+args, name='finalize')
+          self._child.start()
+          _logger.info(f"Finalizing in background process {self._child.pid}")
+
+
+     @staticmethod
+     def _run(func, *args):
+          # in the child
+          for handler in logging.getLogger().handlers:
+               if isinstance(getattr(handler, 'buffer', None), list):
+                    handler.buffer = []
+          try:
+               func(*args)
+          except BaseException:
+               _logger.exception("Background finalization failed")
+               raise SystemExit(1)
+          finally:
+               logging.shutdown()
+
+
+     def finish(self):
+          '''Wait for the running child, then run any coalesced submission'''
+          while self._child is not None:
+               self._child.join()
+               self._reap()
+               if self._pending:
+                    self._start_pending()
+
 
 class AllSeqUpdater:
      '''A class to manage the state of updating a batch of sequences from the FDB.
@@ -46,9 +121,27 @@ class AllSeqUpdater:
           self._mergefile     = config['mergefile']
           self._mergescript   = config['mergescript']
           self._batchsize     = config['batchsize']
+          self._time_budget   = config.get('time_budget') # seconds for the primary loop, or None
+          self._request_budget = config.get('request_budget') # FDB requests for the primary loop, or None
           self._broken        = {int(seq): stuff for seq, stuff in config['broken'].items()}
+          self._factstore     = config.get('factstore')
+          self._fdb_transport = config.get('fdb_transport', 'html')
+          self._query_delay   = config.get('query_delay', 1) # seconds between sequences, be nice to the FDB
+          self._checkpoint_seqs    = config.get('checkpoint_seqs') # journal progress every this many seqs...
+          self._checkpoint_seconds = config.get('checkpoint_seconds') # ...or seconds, None for never
+          self._async_finalize = config.get('async_finalize', False) # stats and html in a child process
+          self._finalizer = _BackgroundFinalizer() if self._async_finalize else None
+          self._artifacts     = ArtifactWriter(config.get('manifest')) # no manifest: compare with the file on disk
+
+          if self._fdb_transport not in _QUERY_ID:
+               raise ValueError(f"unknown fdb_transport {self._fdb_transport!r} (must be one of {', '.join(_QUERY_ID)})")
+          self._query_id = _QUERY_ID[self._fdb_transport]
+
+          if self._factstore:
+               fdb.set_fact_store(FDBFactStore(self._factstore))
 
           self.quitting = False
+          self.interrupted = False # by a signal, unlike quitting this stays set
 
      # excessive? probably. but I qualify it as "better explicit than implicit",
      # and there's *no* reason this data should change post-initialization
@@ -63,14 +156,22 @@ class AllSeqUpdater:
      mergefile     = property(lambda self: self._mergefile)
      mergescript   = property(lambda self: self._mergescript)
      batchsize     = property(lambda self: self._batchsize)
+     time_budget   = property(lambda self: self._time_budget)
+     request_budget = property(lambda self: self._request_budget)
      broken        = property(lambda self: self._broken)
+     factstore     = property(lambda self: self._factstore)
+     fdb_transport = property(lambda self: self._fdb_transport)
+     query_delay   = property(lambda self: self._query_delay)
+     checkpoint_seqs    = property(lambda self: self._checkpoint_seqs)
+     checkpoint_seconds = property(lambda self: self._checkpoint_seconds)
+     async_finalize     = property(lambda self: self._async_finalize)
 
 
      def _install_handlers(self):
           def handler(sig, frame):
                _logger.error("Recieved signal {}, now quitting".format(sig))
                nonlocal self
-               self.quitting = True
+               self.quitting = self.interrupted = True
           self._oldsigtermhandler = signal.signal(signal.SIGTERM, handler)
           self._oldsiginthandler  = signal.signal(signal.SIGINT,  handler)
 
@@ -119,9 +220,17 @@ class AllSeqUpdater:
           return news
 
 
-     def create_stats_write_html(self):
+     def stats_snapshot(self):
+          '''Everything create_stats_write_html needs from the seqinfo'''
+          return self.seqinfo.resdatetime, self.seqinfo.calc_common_stats()
+
+
+     def create_stats_write_html(self, snapshot=None):
           # Now get all the stats (i.e. count all the instances of stuff)
           # It's a bit long, tedious and ugly, but I don't think there's anything for it
+          if snapshot is None:
+               snapshot = self.stats_snapshot()
+          resdatetime, common_stats = snapshot
 
           # Create broken sequences HTML
           if self.broken:
@@ -136,25 +245,22 @@ class AllSeqUpdater:
                borken_html = ''
                unborken_html = 'none, at the moment'
 
-          # Read in webpage templates
-          with open(self.maintemplate, 'r') as f:
-               html = f.read()
-          with open(self.statstemplate, 'r') as f:
-               stats = f.read()
+          # Read in webpage templates (cached between calls, e.g. in daemon mode)
+          html = load_template(self.maintemplate)
+          stats = load_template(self.statstemplate)
 
-          html = html.format(self.seqinfo.resdatetime, unborken_html, borken_html) # Imbue the template with the reservation time and broken sequences
+          html = html.format(resdatetime, unborken_html, borken_html) # Imbue the template with the reservation time and broken sequences
 
-          sizetable, cofactable, guidetable, progtable, lentable, updatedtable, totinc, avginc, totprog, progcent = self.seqinfo.calc_common_stats()
+          sizetable, cofactable, guidetable, progtable, lentable, updatedtable, totinc, avginc, totprog, progcent = common_stats
 
           stats = stats.format(totinc=totinc, avginc=avginc, totprog=totprog, progcent=progcent)
 
+          statsjson = json.dumps({"aSizes": sizetable, "aCofacts": cofactable, "aGuides": guidetable, "aProgress": progtable, "aLens": lentable, "aUpdated": updatedtable}).replace('],', '],\n')+'\n'
+
           # Write the statsdata and webpages
-          with open(self.mainhtml, 'w') as f:
-               f.write(html)
-          with open(self.statshtml, 'w') as f:
-               f.write(stats)
-          with open(self.statsjson, 'w') as f:
-               f.write(json.dumps({"aSizes": sizetable, "aCofacts": cofactable, "aGuides": guidetable, "aProgress": progtable, "aLens": lentable, "aUpdated": updatedtable}).replace('],', '],\n')+'\n')
+          self._artifacts.write(self.mainhtml, html, hashed=False)
+          self._artifacts.write(self.statshtml, stats, hashed=False)
+          self._artifacts.write(self.statsjson, statsjson, compress=True)
 
 
      ###########################################################################
@@ -166,7 +272,7 @@ class AllSeqUpdater:
           if not old or not old.is_minimally_valid() or not old.id:
                return self.query_sequence(old)
 
-          retval = self._fdb_error_handler_wrapper(fdb.query_id, old.seq, old.id)
+          retval = self._fdb_error_handler_wrapper(self._query_id, old.seq, old.id)
           if retval is None: # the wrapper has logged it and set self.quitting as necessary
                return old, False
           else:
@@ -178,17 +284,19 @@ class AllSeqUpdater:
 
           elif status is fdb.FDBStatus.CompositePartiallyFactored: # no progress since last update
                factors, cofactor = data
-               if factors != old.factors:
+               partial = factors != old.factors
+               if partial:
                     #_logger.debug(f'Seq {old.seq} index {old.index}, partial progress: parsed {factors!r}, stored {old.factors!r}')
                     old.factors = factors
                     old.cofactor = cofactor
-                    old.process_no_progress(partial=True) # Implicit assumption: partial progress won't ever change guide/class
-               else:
-                    old.process_no_progress()
+               # Implicit assumption: partial progress won't ever change guide/class
+               if self._fdb_error_handler_wrapper(self._process_no_progress, old.seq, old, partial) is None:
+                    return old, False
 
           elif status is fdb.FDBStatus.Prime:
                _logger.error(f"seq {old.seq}: got a prime id value?? termination?")
-               old.process_no_progress()
+               if self._fdb_error_handler_wrapper(self._process_no_progress, old.seq, old) is None:
+                    return old, False
 
           else:
                _logger.error(f"problem: crazy status for most recent id of {old.seq} ({status})")
@@ -209,27 +317,53 @@ class AllSeqUpdater:
                return old, False
 
           broken_index = self.broken[old.seq][0] if old.seq in self.broken else None
-          ali.process_progress(old, broken_index)
+          if self._fdb_error_handler_wrapper(self._process_progress, seq, ali, old, broken_index) is None:
+               return old, False
 
           return ali, True
 
 
+     # These may query the FDB (for id_created), so they go through
+     # _fdb_error_handler_wrapper too, and return the ali for it
+
+     @staticmethod
+     def _process_no_progress(ali, partial=False):
+          ali.process_no_progress(partial)
+          return ali
+
+
+     @staticmethod
+     def _process_progress(ali, old, broken_index):
+          ali.process_progress(old, broken_index)
+          return ali
+
+
      def _fdb_error_handler_wrapper(self, func, seq, *args, **kwargs):
           '''Calling the functions in the `fdb` module basically always looks the same:
-          catch errors, log them, and return (aliobj, False). Factor that out here.'''
+          catch errors, log them, and return (aliobj, False). Factor that out here.
+          The fdb module has already retried whatever was worth retrying, so one
+          seq failing only stops the loop if the FDB itself is unusable.'''
           try:
                out = func(*args, **kwargs)
           except fdb.FDBResourceLimitReached as e:
                _logger.error(str(e))
                self.quitting = True
                return None
+          except fdb.FDBLayoutError as e: # no point in trying any other seqs either
+               _logger.error(f"Seq {seq}: {str(e)}")
+               self.quitting = True
+               return None
+          except fdb.CircuitOpenError as e: # the FDB has been unreachable for a while
+               _logger.error(f"Seq {seq}: the FDB is unreachable: {str(e)}")
+               self.quitting = True
+               return None
+          except fdb.FDBNetworkError as e:
+               _logger.warning(f"Seq {seq}: {str(e)}, skipping")
+               return None
           except fdb.FDBDataError as e: # wish these fell through like C switch statements
                _logger.warning(str(e))
                _logger.info(f"Skipping sequence {seq}")
                return None
-          if out is None:
-               self.quitting = True
-               return None
 
           return out
 
@@ -248,6 +382,9 @@ class AllSeqUpdater:
           if special:
                self.add_new_seqs(special)
                seqs_todo = special
+          elif self.time_budget or self.request_budget:
+               _logger.info(f"Budget: {self.time_budget or 'unlimited'} seconds, {self.request_budget or 'unlimited'} requests, at most {self.batchsize} sequences")
+               return self._budgeted_todo() # lazy, so can't be logged here
           else:
                seqs_todo = tuple(self.seqinfo.pop_n_todo(self.batchsize))
 
@@ -255,8 +392,40 @@ class AllSeqUpdater:
           return seqs_todo
 
 
+     def _budgeted_todo(self):
+          '''Lazily pop seqs for as long as the average cost of the seqs done so far
+          projects that the next one will finish within the time and request budgets'''
+          start, requests = monotonic(), fdb.request_count()
+          pulled = set()
+          for seq in self.seqinfo.pop_n_todo(min(self.batchsize, len(self.seqinfo))):
+               if seq in pulled:
+                    # Already updated and pushed back, and now the most urgent
+                    # seq left, so there's nothing left worth doing this run
+                    self.seqinfo.unpop(seq)
+                    _logger.info(f"Seq {seq} came up again, ending the batch")
+                    return
+
+               done = len(pulled)
+               if done:
+                    elapsed, used = monotonic() - start, fdb.request_count() - requests
+                    if self.time_budget and elapsed + elapsed/done > self.time_budget:
+                         msg = f"{elapsed:.0f} of {self.time_budget} seconds used"
+                    elif self.request_budget and used + used/done > self.request_budget:
+                         msg = f"{used} of {self.request_budget} requests used"
+                    else:
+                         msg = None
+                    if msg:
+                         self.seqinfo.unpop(seq)
+                         _logger.info(f"Budget reached after {done} sequences: {msg}")
+                         return
+
+               pulled.add(seq)
+               yield seq
+
+
      def primary_update_loop(self, seqs_todo):
           count, terminated = 0, []
+          since, last_checkpoint = 0, monotonic()
           for seq in seqs_todo:
                old = self.seqinfo[seq]
                ali, update_successful = self.update(old)
@@ -267,10 +436,17 @@ class AllSeqUpdater:
                if 'terminated' in ali.factors:
                     terminated.append(ali.seq)
 
+               # Don't waste FDB requests if we get killed before the final write
+               since += 1
+               if ((self.checkpoint_seqs and since >= self.checkpoint_seqs) or
+                   (self.checkpoint_seconds and monotonic() - last_checkpoint >= self.checkpoint_seconds)):
+                    self.seqinfo.checkpoint()
+                    since, last_checkpoint = 0, monotonic()
+
                if self.quitting:
                     break
 
-               sleep(1)
+               network_sleep(self.query_delay)
 
           return count, terminated
 
@@ -300,8 +476,25 @@ class AllSeqUpdater:
 
 
           _logger.info(f'Currently have {len(self.seqinfo)} sequences on file. Creating statistics...')
-          self.create_stats_write_html()
-          _logger.info('Statistics written')
+          if self._finalizer:
+               # The counting is quick, it's the formatting and writing that's slow
+               self._finalizer.submit(self._background_stats, self.stats_snapshot())
+          else:
+               self.create_stats_write_html()
+               _logger.info('Statistics written')
+
+
+     def _background_stats(self, snapshot):
+          self.create_stats_write_html(snapshot)
+          _logger.info('Statistics written (in background)')
+
+
+     def finish_finalization(self):
+          '''Wait for any background finalization to complete. Only needed by
+          long running callers, since multiprocessing joins children at exit
+          anyways (but without running a coalesced finalization).'''
+          if self._finalizer:
+               self._finalizer.finish()
 
 
      def do_all_updates(self, seqinfo, special=None):
@@ -312,15 +505,18 @@ class AllSeqUpdater:
           self.quitting = False
 
           seqs_todo = self.preloop_initialize(special)
-          n = len(seqs_todo)
+          try:
+               n = len(seqs_todo)
+          except TypeError: # budgeted
+               n = None
 
-          _logger.info(f'Updater init complete, starting FDB queries on {n} sequences')
+          _logger.info(f'Updater init complete, starting FDB queries on {n if n is not None else "a budget of"} sequences')
 
           self._install_handlers()
           count, terminated = self.primary_update_loop(seqs_todo)
           self._reset_handlers()
 
-          msg = f'Primary loop {{}}, successfully updated {count} of {n} sequences, finalizing...'
+          msg = f'Primary loop {{}}, successfully updated {count} of {n if n is not None else "the budgeted"} sequences, finalizing...'
           if self.quitting:
                _logger.error(msg.format('aborted'))
           else:
@@ -0,0 +1,391 @@
+# This is written to Python 3.6 standards
+# indentation: 5 spaces (eccentric personal preference)
+# when making large backwards scope switches (e.g. leaving def or class blocks),
+# use two blank lines for clearer visual separation
+
+#    Copyright (C) 2014-2017 Bill Winslow
+#
+#    This module is a part of the mfaliquot package.
+#
+#    This program is libre software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+#    See the LICENSE file for more details.
+
+'''Writing the generated website files ("artifacts"). An ArtifactWriter hashes
+each file's content and skips the write entirely if it's unchanged. Otherwise
+it replaces the file atomically, optionally also writes a copy under a content
+addressed name (e.g. statistics.3f2a9c1b04d7.json, which may be cached forever),
+and records the hash, size, ETag and Last-Modified time in a JSON manifest in
+the same directory, for the web server's benefit. The big files can also get
+maximally compressed .gz siblings, made only when the content changes.
+
+This module also cuts the main table into pre-sorted pages, see write_shards,
+precomputes its filters as bitsets, see write_facets, and keeps a small
+document per sequence, see write_details.
+
+Several processes may write artifacts at once (e.g. allseq.py and its
+background finalization), so the manifest is only modified under a flock.'''
+
+import fcntl, hashlib, json, logging
+from base64 import b64encode
+from io import BytesIO
+from gzip import GzipFile
+from time import perf_counter
+from contextlib import contextmanager
+from email.utils import formatdate
+from os import listdir, makedirs, remove as rm, replace, stat
+from os.path import basename, dirname, exists, isdir, join, relpath, splitext
+from .sequence import SequenceInfo
+
+_logger = logging.getLogger(__name__)
+
+
+# Templates are re-read only when they change on disk
+_templates = {}
+
+def load_template(file):
+     mtime = stat(file).st_mtime_ns
+     cached = _templates.get(file)
+     if cached is None or cached[0] != mtime:
+          with open(file, 'r') as f:
+               cached = _templates[file] = mtime, f.read()
+     return cached[1]
+
+
+def atomic_write(file, data):
+     '''Write the bytes `data` to a temporary file and rename it over `file`, so
+     that readers (i.e. the web server) never see a half written file'''
+     tmp = file + '.tmp'
+     with open(tmp, 'wb') as f:
+          f.write(data)
+     replace(tmp, file)
+
+
+class ArtifactWriter:
+     '''Writes files in the directory of the `manifest` file, which is immutable
+     for the lifetime of the object. Keeps the `keep` most recent hashed copies
+     of each file, so that a client that loaded a page just before an update can
+     still fetch the data it references. With no `manifest`, a file is compared
+     with what's on disk instead (which costs a read, but saves the write and any
+     compression), and no hashed copies are made.'''
+
+     def __init__(self, manifest=None, keep=2):
+          self._manifest = manifest
+          self._directory = dirname(manifest) if manifest else None
+          self._keep = keep
+
+     @property
+     def manifest(self):
+          return self._manifest
+
+
+     @contextmanager
+     def _locked_manifest(self):
+          with open(self._manifest + '.lock', 'a') as lock:
+               fcntl.flock(lock, fcntl.LOCK_EX)
+               try:
+                    try:
+                         with open(self._manifest, 'r') as f:
+                              manifest = json.load(f)
+                    except (FileNotFoundError, ValueError):
+                         manifest = {}
+                    yield manifest
+                    atomic_write(self._manifest, (json.dumps(manifest, indent=1, sort_keys=True) + '\n').encode())
+               finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+     def read_manifest(self):
+          try:
+               with open(self._manifest, 'r') as f:
+                    return json.load(f)
+          except FileNotFoundError:
+               return {}
+
+
+     def write(self, file, content, hashed=True, compress=False):
+          '''Write the str `content` to `file` (utf-8), unless it already has
+          exactly that content. With `compress`, also write `file`.gz (and the
+          same for the hashed copy) for servers that can send it as is, e.g.
+          nginx's gzip_static. Returns whether the file was written.'''
+          return self.write_many([(file, content)], hashed, compress) == 1
+
+
+     def write_many(self, items, hashed=True, compress=False):
+          '''Like write() for each (file, content) in `items`, but reading and
+          writing the manifest only once. Returns the count of files written.'''
+          count = 0
+          if not self._manifest:
+               for file, content in items:
+                    data = content.encode('utf-8')
+                    if self._on_disk(file, data, compress):
+                         _logger.debug(f"{basename(file)} unchanged, not rewritten")
+                         continue
+                    atomic_write(file, data)
+                    if compress:
+                         self._write_gzip(file, data)
+                    count += 1
+               return count
+          with self._locked_manifest() as manifest:
+               for file, content in items:
+                    count += self._write_one(manifest, file, content.encode('utf-8'), hashed, compress)
+          return count
+
+
+     def _write_one(self, manifest, file, data, hashed, compress):
+          digest = hashlib.sha256(data).hexdigest()
+          key = relpath(file, self._directory)
+          entry = manifest.get(key)
+          if entry and entry['sha256'] == digest and exists(file) and (not compress or exists(file + '.gz')):
+               _logger.debug(f"{key} unchanged, not rewritten")
+               return False
+
+          atomic_write(file, data)
+          new = {'sha256': digest, 'size': len(data), 'etag': f'"{digest[:16]}"',
+                 'last_modified': formatdate(stat(file).st_mtime, usegmt=True)}
+          if compress:
+               gzdata = self._write_gzip(file, data)
+               new['gzip_size'] = len(gzdata)
+          if hashed:
+               stem, ext = splitext(file)
+               copy = f'{stem}.{digest[:12]}{ext}'
+               atomic_write(copy, data)
+               if compress:
+                    atomic_write(copy + '.gz', gzdata)
+               new['hashed'] = relpath(copy, self._directory)
+               new['previous'] = self._expire_copies(entry, new['hashed'])
+          manifest[key] = new
+          _logger.debug(f"wrote {key} ({len(data)} bytes)")
+          return True
+
+
+     @staticmethod
+     def _on_disk(file, data, compress):
+          '''Whether `file` already holds `data`, and if `compress`, has a .gz
+          written after it (as _write_gzip always is)'''
+          try:
+               if compress and stat(file + '.gz').st_mtime_ns < stat(file).st_mtime_ns:
+                    return False
+               with open(file, 'rb') as f:
+                    return f.read() == data
+          except FileNotFoundError:
+               return False
+
+
+     @staticmethod
+     def _write_gzip(file, data):
+          '''Compress at the maximum level, and with a zero timestamp so that the
+          same content always gives the same .gz. Returns the compressed bytes.'''
+          t0 = perf_counter()
+          buf = BytesIO()
+          with GzipFile(filename='', mode='wb', fileobj=buf, compresslevel=9, mtime=0) as f:
+               f.write(data)
+          gzdata = buf.getvalue()
+          atomic_write(file + '.gz', gzdata)
+          _logger.info(f"gzipped {basename(file)}: {len(data)} -> {len(gzdata)} bytes "
+                       f"({100*len(gzdata)/max(len(data), 1):.1f}%) in {perf_counter()-t0:.3f}s")
+          return gzdata
+
+
+     def _expire_copies(self, entry, current):
+          '''Returns the list of hashed copies still kept, other than the current'''
+          if not entry or 'hashed' not in entry:
+               return []
+          older = [entry['hashed']] + entry.get('previous', [])
+          older = [name for name in older if name != current]
+          for name in older[self._keep-1:]:
+               for path in (name, name + '.gz'):
+                    try:
+                         rm(join(self._directory, path))
+                    except FileNotFoundError:
+                         pass
+          return older[:self._keep-1]
+
+
+################################################################################
+# Pre-sorted, paginated copies ("shards") of the main table, so that the page can
+# fetch just the rows on screen for the common sort orders. Each sort order is
+# split into pages of `pagesize` rows: <directory>/<name>.<page>.json, holding
+# {"aaData": [rows]} in ascending order, ties by ascending seq. Descending is the
+# same pages backwards, so ties are then by descending seq, which the template's
+# sort of the full table matches.
+# index.json lists the table size, page size, generation and which column index
+# each name sorts.
+
+SHARD_COLUMNS = {'seq': 0, 'index': 1, 'size': 2, 'progress': 9, 'priority': 11}
+
+
+def _progress_order(rows):
+     # Mirrors the template's 'special' sort of the progress column: ascending is
+     # the index counts first, largest first, then the dates, latest first
+     # (None, for seqs never updated, goes last)
+     return sorted(rows, key=lambda row: (isinstance(row[9], int), '' if row[9] is None else row[9]), reverse=True)
+
+
+def write_shards(writer, directory, rows, pagesize=500, **info):
+     '''Write the shards of `rows` (the main table) with the ArtifactWriter
+     `writer`. `info` (e.g. generation) is added to index.json. Returns the
+     count of files written.'''
+     makedirs(directory, exist_ok=True)
+     rows = sorted(rows, key=lambda row: row[0])
+     encode = json.JSONEncoder(ensure_ascii=False).encode
+     encoded = {row[0]: encode(row) for row in rows} # once, not once per order
+     pages, count = [], 0
+     for name, col in SHARD_COLUMNS.items():
+          if name == 'progress':
+               ordered = _progress_order(rows)
+          elif col == 0:
+               ordered = rows
+          else:
+               ordered = sorted(rows, key=lambda row: (row[col] is not None, row[col]))
+          npages = 0
+          for npages, i in enumerate(range(0, len(ordered), pagesize), 1):
+               content = '{"aaData": [' + ',\n'.join(encoded[row[0]] for row in ordered[i:i+pagesize]) + ']}\n'
+               pages.append((join(directory, f'{name}.{npages-1}.json'), content))
+          while exists(join(directory, f'{name}.{npages}.json')): # the table shrank
+               rm(join(directory, f'{name}.{npages}.json'))
+               npages += 1
+     count += writer.write_many(pages, hashed=False)
+
+     # Only now that the pages are in place
+     index = dict(info, total=len(rows), pagesize=pagesize, columns={col: name for name, col in SHARD_COLUMNS.items()})
+     count += writer.write(join(directory, 'index.json'), json.dumps(index, ensure_ascii=False, sort_keys=True) + '\n', hashed=False)
+     _logger.debug(f"wrote {count} of {len(pages)+1} shard files in {directory}")
+     return count
+
+
+################################################################################
+# Precomputed filters ("facets") for the main table. Each is a bitset over the
+# rows sorted by seq, bit i (byte i//8, bit i%8, least significant first) set
+# if row i has the property, sent as base64. The page ANDs together those of
+# the filters in use, instead of testing every row.
+
+def _has_three(row): # as the template has always done it
+     return '* 3 *' in row[7] or '* 3^' in row[7]
+
+FACETS = {'three': _has_three,
+          'driver': lambda row: bool(row[13]),
+          'reserved': lambda row: bool(row[8]),
+          'downdriver': lambda row: row[4] == 'Downdriver!'}
+# and the buckets, class:<klass> and size:<size rounded down to a multiple of 10>
+
+
+def _bitset(flags):
+     bits = bytearray((len(flags) + 7) // 8)
+     for i, flag in enumerate(flags):
+          if flag:
+               bits[i >> 3] |= 1 << (i & 7)
+     return b64encode(bits).decode('ascii')
+
+
+def compute_facets(rows):
+     '''Returns {facet name: base64 bitset} for the `rows` (in any order)'''
+     rows = sorted(rows, key=lambda row: row[0])
+     facets = {name: _bitset([test(row) for row in rows]) for name, test in FACETS.items()}
+     for prefix, bucket in (('class', lambda row: row[5]), ('size', lambda row: None if row[2] is None else row[2]//10*10)):
+          buckets = [bucket(row) for row in rows]
+          for value in set(buckets) - {None}:
+               facets[f'{prefix}:{value}'] = _bitset([b == value for b in buckets])
+     return facets
+
+
+def write_facets(writer, file, rows, **info):
+     '''Write the facets of `rows` to `file` with the ArtifactWriter `writer`.
+     `info` (e.g. generation) is added to the output.'''
+     facets = dict(info, count=len(rows), facets=compute_facets(rows))
+     return writer.write(file, json.dumps(facets, sort_keys=True).replace('",', '",\n') + '\n', hashed=False, compress=True)
+
+
+################################################################################
+# Per sequence detail documents, so that people needn't go to the FDB for the
+# basics: <directory>/<seq//1000>/<seq>.json, which keeps every directory to a
+# few hundred files even with 10^5+ sequences. Each has the SequenceInfo fields
+# by name, links to the FDB and the elf file, and the last DETAIL_HISTORY
+# [time, index, size] of when the index was seen to change. Only the seqs touched
+# by a write are regenerated. The "generation" file in the directory is the
+# generation the documents are current as of, and if that's not the previous one
+# (e.g. on the first run) they're all regenerated.
+
+DETAIL_HISTORY = 20
+_FIELDS = sorted(SequenceInfo._map, key=lambda field: SequenceInfo._map[field][0])
+
+
+def detail_file(directory, seq):
+     return join(directory, str(seq // 1000), f'{seq}.json')
+
+
+def _detail(row, old):
+     doc = dict(zip(_FIELDS, row))
+     seq = doc['seq']
+     doc['fdb'] = f'http://factordb.com/sequences.php?se=1&aq={seq}&action=last20'
+     doc['elf'] = f'http://factordb.com/elf.php?seq={seq}&type=1'
+     history = old.get('history', []) if old else []
+     if not history or history[-1][1] != doc['index']:
+          history.append([doc['time'], doc['index'], doc['size']])
+     doc['history'] = history[-DETAIL_HISTORY:]
+     return doc
+
+
+def _prune_details(directory, data):
+     # Delete the documents of seqs no longer in `data`, which a full regeneration
+     # would otherwise never see (e.g. drops while the documents weren't kept)
+     count = 0
+     for sub in (listdir(directory) if exists(directory) else ()):
+          if not sub.isdigit() or not isdir(join(directory, sub)):
+               continue
+          for name in listdir(join(directory, sub)):
+               seq, ext = splitext(name)
+               if ext == '.json' and seq.isdigit() and int(seq) not in data:
+                    rm(join(directory, sub, name))
+                    count += 1
+     if count:
+          _logger.info(f"deleted {count} detail documents of dropped seqs in {directory}")
+
+
+def write_details(directory, data, touched, generation, since=None):
+     '''Regenerate the detail documents of the `touched` seqs, given the dict
+     `data` of seq -> row after `generation`. A touched seq not in `data` was
+     dropped, and so is its document. `since` is the generation the seqs were
+     touched since, by default the one before (or with none touched, this one).
+     Returns the count of seqs regenerated.'''
+     marker = join(directory, 'generation')
+     try:
+          with open(marker, 'r') as f:
+               current = int(f.read())
+     except (FileNotFoundError, ValueError):
+          current = None
+     if since is None:
+          since = generation - 1 if touched else generation
+     full = current != since
+     seqs = list(data) if full else touched
+     if full:
+          _logger.info(f"regenerating all {len(seqs)} detail documents in {directory}")
+          _prune_details(directory, data)
+
+     made = set()
+     for seq in seqs:
+          file = detail_file(directory, seq)
+          if seq not in data:
+               if exists(file):
+                    rm(file)
+               continue
+          try:
+               with open(file, 'r') as f:
+                    old = json.load(f)
+          except (FileNotFoundError, ValueError):
+               old = None
+          if dirname(file) not in made:
+               makedirs(dirname(file), exist_ok=True)
+               made.add(dirname(file))
+          atomic_write(file, (json.dumps(_detail(data[seq], old), ensure_ascii=False) + '\n').encode('utf-8'))
+
+     makedirs(directory, exist_ok=True)
+     atomic_write(marker, f'{generation}\n'.encode())
+     return len(seqs)
@@ -23,6 +23,14 @@
 
 # The main executable script to drive the primary Aliquot sequences data table.
 # Queries information from the FDB and stores the data in a large json table.
+#
+# Usage: "allseq.py" runs one budgeted batch (e.g. from cron), "allseq.py <seq>..."
+# updates just those seqs, and "allseq.py --daemon" runs forever in small cycles,
+# keeping the data in memory and only re-reading AllSeq.json when some other
+# script (reservations.py, update_priorities.py...) has changed it. The daemon
+# takes the lock only for the duration of each cycle, and between full writes
+# (every allseq_daemon.full_write_minutes) only appends the cycle's changes to
+# the journal, which every reader of AllSeq.json replays.
 
 
 ################################################################################
@@ -30,8 +38,6 @@
 
 CONFIGFILE = 'mfaliquot.config.json'
 SCRIPTNAME = 'allseq'
-SLEEPMINUTES = 30 # TODO
-LOOPING = False
 
 #
 ################################################################################
@@ -41,13 +47,13 @@ LOOPING = False
 # imports and global initialization
 
 import sys
-from time import sleep
+from time import sleep, monotonic
 
 from _import_hack import add_path_relative_to_script
 add_path_relative_to_script('..')
 # this should be removed when proper pip installation is supported
 from mfaliquot import config_boilerplate
-from mfaliquot.application import SequencesManager
+from mfaliquot.application import SequencesManager, LockError
 from mfaliquot.application.updater import AllSeqUpdater
 
 CONFIG, LOGGER = config_boilerplate(CONFIGFILE, SCRIPTNAME)
@@ -58,28 +64,76 @@ CONFIG, LOGGER = config_boilerplate(CONFIGFILE, SCRIPTNAME)
 ################################################################################
 #
 
-def inner_main(updater, seqinfo, special=None):
+def inner_main(updater, seqinfo, special=None, cached=False, checkpoint=False):
      LOGGER.info('Initializing')
      block = 0 if special else CONFIG['blockminutes']
 
-     with seqinfo.acquire_lock(block_minutes=block):
+     with seqinfo.acquire_lock(block_minutes=block, cached=cached, checkpoint=checkpoint):
           quitting = updater.do_all_updates(seqinfo, special)
 
      LOGGER.info('allseq.py update loop complete')
      return quitting
 
 
+def daemon_main(seqinfo):
+     conf = CONFIG['allseq_daemon']
+     full_write = conf.get('full_write_minutes', 30)*60 # between cycles only the journal is written, if there is one
+     max_pause = conf.get('max_error_pause_minutes', 240)*60 # repeated failures back off up to this
+     # Each cycle is budgeted separately from a regular run
+     upconf = dict(CONFIG['AllSeqUpdater'], time_budget=conf['cycle_seconds'], request_budget=conf['cycle_requests'])
+     updater = AllSeqUpdater(upconf)
+     LOGGER.info(f"Daemon mode: cycles of {conf['cycle_seconds']}s and {conf['cycle_requests']} requests, pausing {conf['pause_seconds']}s between")
+
+     last_full, failures = None, 0
+     while True:
+          start = monotonic()
+          full = last_full is None or start - last_full >= full_write
+          try:
+               quitting = inner_main(updater, seqinfo, cached=True, checkpoint=not full)
+          except LockError as e: # someone else is taking their time, try again next cycle
+               LOGGER.error(f"{str(e)}, skipping this cycle")
+               quitting = False
+          except Exception as e: # whatever it is, the next cycle may well go better
+               failures += 1
+               LOGGER.exception(f"Cycle failed ({failures} in a row): {type(e).__name__}: {str(e)}", exc_info=e)
+          else:
+               failures = 0
+               if full:
+                    last_full = start
+          if updater.interrupted:
+               break
+
+          pause = conf['pause_seconds']
+          if failures:
+               pause = min(conf['error_pause_minutes']*60 * 2**(failures-1), max_pause)
+               LOGGER.error(f"Pausing for {pause/60:.0f} minutes")
+          elif quitting: # resource limit, FDB down, etc.
+               pause = conf['error_pause_minutes']*60
+               LOGGER.error(f"Cycle aborted, pausing for {conf['error_pause_minutes']} minutes")
+          LOGGER.info(f"Cycle took {monotonic() - start:.0f}s, sleeping {pause}s")
+          sleep(pause)
+
+     # Leave AllSeq.json itself current, not just the journal
+     if last_full != start:
+          with seqinfo.acquire_lock(block_minutes=CONFIG['blockminutes'], cached=True):
+               pass
+     updater.finish_finalization()
+
+
 def main():
-     global LOOPING
+     args = sys.argv[1:]
+     if args == ['--daemon']:
+          seqinfo = SequencesManager(CONFIG)
+          daemon_main(seqinfo)
+          return
 
      try:
-          special = [int(arg) for arg in sys.argv[1:]]
+          special = [int(arg) for arg in args]
      except ValueError:
-          print('Error: Args are sequences to be run')
+          print('Error: Args are sequences to be run, or --daemon')
           sys.exit(-1)
 
      if special:
-          LOOPING = False
           # de-duplicate while preserving order
           seen = set()
           seen_add = seen.add # more efficient, tho gain is negligible for small specials
@@ -89,17 +143,8 @@ def main():
 
      seqinfo = SequencesManager(CONFIG)
      updater = AllSeqUpdater(CONFIG['AllSeqUpdater'])
-
-     # This means you can start it once and leave it, but by setting LOOPING = False you can make it one-and-done
-     # This would be a good place for a do...while syntax
-     while True:
-          quitting = inner_main(updater, seqinfo, special)
-
-          if LOOPING and not quitting:
-               LOGGER.info('Sleeping.')
-               sleep(SLEEPMINUTES*60)
-          else:
-               break
+     inner_main(updater, seqinfo, special)
+     updater.finish_finalization() # the lock is already released
 
 
 if __name__ == '__main__':
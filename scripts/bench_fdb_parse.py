@@ -0,0 +1,96 @@
+#! /usr/bin/env python3
+
+# This is written to Python 3.6 standards
+# indentation: 5 spaces (eccentric personal preference)
+# when making large backwards scope switches (e.g. leaving def or class blocks),
+# use two blank lines for clearer visual separation
+
+#    Copyright (C) 2014-2017 Bill Winslow
+#
+#    This module is a part of the mfaliquot package.
+#
+#    This program is libre software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+#    See the LICENSE file for more details.
+
+# Check the single pass fdb.FDBPage parser against the original one-regex-per-
+# field parsing over a corpus of saved FDB pages, and time both. Usage:
+# bench_fdb_parse.py [<corpus_dir> [<repetitions>]]
+# The corpus defaults to the pages saved with the tests. Any page in the corpus
+# which the two parsers disagree on is printed, and makes the exit code nonzero.
+
+from sys import argv, exit
+from os import listdir
+from os.path import join, realpath, dirname
+from time import perf_counter
+
+from _import_hack import add_path_relative_to_script
+add_path_relative_to_script('..')
+# this should be removed when proper pip installation is supported
+from mfaliquot.application import fdb
+
+
+def reference_parse(page):
+     '''The parsing as it was done before FDBPage, one scan per field'''
+     info = fdb.ALIINFOREGEX.search(page)
+     idsize = fdb.IDSIZEREGEX.search(page)
+     return (
+          (int(info.group('index')), int(info.group('size')), int(info.group('id'))) if info else None,
+          (int(idsize.group('size')), int(idsize.group('id'))) if idsize else None,
+          {s for s in ('CF', 'PRP', 'FF', 'C', 'P', 'U') if f'<td>{s}</td>' in page},
+          fdb.SMALLFACTREGEX.findall(page),
+          fdb.LARGEFACTREGEX.findall(page),
+          fdb.COMPOSITEREGEX.findall(page),
+          not (info and 'Not all factors known' in page),
+          'Resources used by your IP' in page
+     )
+
+
+def fdbpage_parse(page):
+     p = fdb.FDBPage(page)
+     return p.info, p.idsize, p.statuses, p.smalls, p.bigs, p.comps, p.all_factors_known, p.resource_limit
+
+
+def time_it(func, pages, reps):
+     start = perf_counter()
+     for i in range(reps):
+          for page in pages:
+               func(page)
+     return perf_counter() - start
+
+
+def main():
+     corpus = argv[1] if len(argv) > 1 else join(dirname(realpath(__file__)), '..', 'tests', 'fdb_pages')
+     reps = int(argv[2]) if len(argv) > 2 else 1000
+
+     names = sorted(name for name in listdir(corpus) if name.endswith('.html'))
+     pages = []
+     for name in names:
+          with open(join(corpus, name)) as f:
+               pages.append(f.read())
+
+     bad = 0
+     for name, page in zip(names, pages):
+          ref, new = reference_parse(page), fdbpage_parse(page)
+          if ref != new:
+               bad += 1
+               print(f"MISMATCH {name}:\n     regexes: {ref}\n     FDBPage: {new}")
+
+     nbytes = sum(len(page) for page in pages)
+     print(f"{len(pages)} pages, {nbytes} bytes, {reps} reps, {bad} mismatches")
+     for label, func in (('regexes', reference_parse), ('FDBPage', fdbpage_parse)):
+          t = time_it(func, pages, reps)
+          print(f"{label:>8}: {t/(reps*len(pages))*1e6:8.2f} us/page {nbytes*reps/t/1e6:8.2f} MB/s")
+
+     exit(1 if bad else 0)
+
+
+if __name__ == '__main__':
+     main()
@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+
+# This is written to Python 3.6 standards
+# indentation: 5 spaces (eccentric personal preference)
+# when making large backwards scope switches (e.g. leaving def or class blocks),
+# use two blank lines for clearer visual separation
+
+#    Copyright (C) 2014-2017 Bill Winslow
+#
+#    This module is a part of the mfaliquot package.
+#
+#    This program is libre software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+#    See the LICENSE file for more details.
+
+# Check forum_xaction._parse_page (the per-message tag scan) against the original
+# regex and string slicing parser over a corpus of saved res thread pages, and
+# time both. Usage: bench_forum_parse.py [<corpus_dir> [<repetitions>]]
+# The corpus defaults to the pages saved with the tests. The two are compared
+# after normalizing the old one's output the way the new one's is (tags dropped,
+# entities decoded, blank lines removed); any page they disagree on is printed,
+# and makes the exit code nonzero. (They disagree by design on posts with text
+# before a quote, which the old parser dropped.)
+
+import re
+from sys import argv, exit
+from os import listdir
+from os.path import join, realpath, dirname
+from html import unescape
+from time import perf_counter
+
+from _import_hack import add_path_relative_to_script
+add_path_relative_to_script('..')
+# this should be removed when proper pip installation is supported
+from mfaliquot.application import forum_xaction
+
+
+def _reference_msg(msg):
+     ind = msg.rfind('</div>')
+     msg = msg[:ind]
+     if msg.count('<div') > 1: # There are quotes in the message
+          ind = msg.rfind('</div>')
+          msg = msg[ind+6:]
+     else:
+          ind = msg.find('>')
+          msg = msg[ind+1:]
+     return msg.replace('<br />', '').strip()
+
+
+def reference_parse(page):
+     '''The parsing as it was done before the quotes were skipped properly'''
+     out = []
+     for pid, post in re.findall(r'<!-- post #([0-9]{6,7}) -->(.*?)<!-- / post #\1 -->', page, re.DOTALL):
+          name = re.search(r'''alt="(.*?) is o''', post).group(1)
+          msg = re.search(r'<!-- message -->(.*?)<!-- / message -->', post, re.DOTALL).group(1)
+          out.append((int(pid), name, _reference_msg(msg)))
+     return out
+
+
+def normalize(posts):
+     out = []
+     for pid, name, msg in posts:
+          lines = (line.strip() for line in unescape(re.sub(r'<[^>]*>', '', msg)).splitlines())
+          out.append((pid, unescape(name), '\n'.join(line for line in lines if line)))
+     return out
+
+
+def time_it(func, pages, reps):
+     start = perf_counter()
+     for i in range(reps):
+          for page in pages:
+               func(page)
+     return perf_counter() - start
+
+
+def main():
+     corpus = argv[1] if len(argv) > 1 else join(dirname(realpath(__file__)), '..', 'tests', 'forum_pages')
+     reps = int(argv[2]) if len(argv) > 2 else 200
+
+     names = sorted(name for name in listdir(corpus) if name.endswith('.html'))
+     pages = []
+     for name in names:
+          with open(join(corpus, name), encoding='latin-1') as f:
+               pages.append(f.read())
+
+     bad = 0
+     for name, page in zip(names, pages):
+          ref, new = normalize(reference_parse(page)), forum_xaction._parse_page(page)
+          for r, n in zip(ref, new):
+               if r != n:
+                    print(f"MISMATCH {name}:\n      regexes: {r}\n     parser: {n}")
+          if ref != new:
+               bad += 1
+
+     nbytes = sum(len(page) for page in pages)
+     nposts = sum(len(reference_parse(page)) for page in pages)
+     print(f"{len(pages)} pages, {nposts} posts, {nbytes} bytes, {reps} reps, {bad} mismatches")
+     for label, func in (('regexes', reference_parse), ('parser', forum_xaction._parse_page)):
+          t = time_it(func, pages, reps)
+          print(f"{label:>8}: {t/(reps*len(pages))*1e6:8.2f} us/page {nbytes*reps/t/1e6:8.2f} MB/s")
+
+     exit(1 if bad else 0)
+
+
+if __name__ == '__main__':
+     main()
@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+
+# This is written to Python 3.6 standards
+# indentation: 5 spaces (eccentric personal preference)
+# when making large backwards scope switches (e.g. leaving def or class blocks),
+# use two blank lines for clearer visual separation
+
+#    Copyright (C) 2014-2017 Bill Winslow
+#
+#    This module is a part of the mfaliquot package.
+#
+#    This program is libre software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+#    See the LICENSE file for more details.
+
+# Check forum_xaction._read_msg against the regression corpus of reservation
+# commands (tests/forum_pages/commands.json: [message, adds, drops, updates]),
+# and compare it, on the corpus and every post of the saved thread pages, to the
+# original keyword-tuples classifier, timing both. Usage:
+# bench_res_commands.py [<corpus_dir> [<repetitions>]]
+# Where the two classifiers differ it's printed; any corpus entry the current one
+# gets wrong makes the exit code nonzero.
+
+import json
+from sys import argv, exit
+from os import listdir
+from os.path import join, realpath, dirname
+from time import perf_counter
+
+from _import_hack import add_path_relative_to_script
+add_path_relative_to_script('..')
+# this should be removed when proper pip installation is supported
+from mfaliquot.application.forum_xaction import _read_msg, _parse_page, SEQ_REGEX
+
+
+def reference_read_msg(msg):
+     '''The classifying as it was done before _COMMAND_REGEX'''
+     add = []; addkws = ('Reserv', 'reserv', 'Add', 'add', 'Tak', 'tak')
+     drop = []; dropkws = ('Unreserv', 'unreserv', 'Drop', 'drop', 'Releas', 'releas')
+     update = []; updatekws = ('Update', 'update')
+     for line in msg.splitlines():
+          if any(kw in line for kw in dropkws):
+               drop.extend(int(s) for s in SEQ_REGEX.findall(line))
+          elif any(kw in line for kw in addkws):
+               add.extend(int(s) for s in SEQ_REGEX.findall(line))
+          elif any(kw in line for kw in updatekws):
+               update.extend(int(s) for s in SEQ_REGEX.findall(line))
+     return tuple(add), tuple(drop), tuple(update)
+
+
+def time_it(func, msgs, reps):
+     start = perf_counter()
+     for i in range(reps):
+          for msg in msgs:
+               func(msg)
+     return perf_counter() - start
+
+
+def main():
+     corpus = argv[1] if len(argv) > 1 else join(dirname(realpath(__file__)), '..', 'tests', 'forum_pages')
+     reps = int(argv[2]) if len(argv) > 2 else 2000
+
+     with open(join(corpus, 'commands.json')) as f:
+          commands = json.load(f)
+     msgs = [msg for msg, *expected in commands]
+     for name in sorted(name for name in listdir(corpus) if name.endswith('.html')):
+          with open(join(corpus, name), encoding='latin-1') as f:
+               msgs.extend(msg for pid, author, msg in _parse_page(f.read()))
+
+     bad = 0
+     for msg, *expected in commands:
+          if _read_msg(msg) != tuple(map(tuple, expected)):
+               bad += 1
+               print(f"WRONG {msg!r}:\n     expected: {expected}\n          got: {_read_msg(msg)}")
+     differ = 0
+     for msg in msgs:
+          ref, new = reference_read_msg(msg), _read_msg(msg)
+          if ref != new:
+               differ += 1
+               print(f"differ {msg!r}:\n     keywords: {ref}\n        regex: {new}")
+
+     nbytes = sum(len(msg) for msg in msgs)
+     print(f"{len(msgs)} messages, {nbytes} bytes, {reps} reps, {differ} differences, {bad} wrong")
+     for label, func in (('keywords', reference_read_msg), ('regex', _read_msg)):
+          t = time_it(func, msgs, reps)
+          print(f"{label:>8}: {t/(reps*len(msgs))*1e6:8.2f} us/msg {nbytes*reps/t/1e6:8.2f} MB/s")
+
+     exit(1 if bad else 0)
+
+
+if __name__ == '__main__':
+     main()
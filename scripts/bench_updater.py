@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+
+# This is written to Python 3.6 standards
+# indentation: 5 spaces (eccentric personal preference)
+# when making large backwards scope switches (e.g. leaving def or class blocks),
+# use two blank lines for clearer visual separation
+
+#    Copyright (C) 2014-2017 Bill Winslow
+#
+#    This module is a part of the mfaliquot package.
+#
+#    This program is libre software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+#    See the LICENSE file for more details.
+
+# Run AllSeqUpdater.do_all_updates against a simulated FDB (see fdb_standin.py)
+# on a scratch copy of AllSeq.json, for each combination of batch size and
+# concurrency (the number of updater processes contending for the one lock, as
+# when cron starts allseq.py while the last run is still going). Reports
+# sequences updated per second, FDB requests per sequence, and how long the lock
+# was waited on and held. Run with --help for the knobs. Nothing touches the
+# network or the live website files.
+
+import argparse, logging
+from os.path import join, realpath, dirname
+from shutil import copy
+from tempfile import TemporaryDirectory
+from multiprocessing import Process, Queue
+from time import perf_counter
+
+from _import_hack import add_path_relative_to_script
+add_path_relative_to_script('..')
+# this should be removed when proper pip installation is supported
+from mfaliquot.application import SequencesManager, fdb
+from mfaliquot.application.updater import AllSeqUpdater
+from mfaliquot.application.fdb_standin import SimulatedFDBServer
+
+ROOT = realpath(join(dirname(realpath(__file__)), '..'))
+
+
+def make_config(tmpdir, args):
+     '''The same shape as mfaliquot.config.json, with every output in `tmpdir`'''
+     config = {'jsonfile': join(tmpdir, 'AllSeq.json'),
+               'lockfile': join(tmpdir, 'AllSeq.json.lock'),
+               'journalfile': join(tmpdir, 'AllSeq.json.journal'),
+               'txtfile':  join(tmpdir, 'AllSeq.txt')}
+     config['AllSeqUpdater'] = {
+          'mainhtml':  join(tmpdir, 'AllSeq.html'),
+          'statshtml': join(tmpdir, 'statistics.html'),
+          'statsjson': join(tmpdir, 'statistics.json'),
+          'maintemplate':  join(ROOT, 'website', 'templates', 'template.html'),
+          'statstemplate': join(ROOT, 'website', 'templates', 'statstemplate.html'),
+          'dropfile':  join(tmpdir, 'allseq.drops.txt'),
+          'termfile':  join(tmpdir, 'allseq.terms.txt'),
+          'mergefile': join(tmpdir, 'allseq.merges.txt'),
+          'termscript':  'true',
+          'mergescript': 'true',
+          'fdb_transport': args.transport,
+          'query_delay': args.delay,
+          'checkpoint_seqs': args.checkpoint,
+          'async_finalize': args.async_finalize,
+          'batchsize': None, # filled in per run
+          'time_budget': args.time_budget,
+          'request_budget': args.request_budget,
+          'broken': {}
+     }
+     return config
+
+
+def worker(config, results):
+     '''One allseq.py run: lock, update a batch, finalize, unlock'''
+     seqinfo = SequencesManager(config)
+     updater = AllSeqUpdater(config['AllSeqUpdater'])
+
+     t0 = perf_counter()
+     with seqinfo.acquire_lock(block_minutes=60):
+          t1 = perf_counter()
+          before = {seq: ali.time for seq, ali in seqinfo.items()}
+          quitting = updater.do_all_updates(seqinfo)
+     t2 = perf_counter()
+     updater.finish_finalization()
+
+     updated = sum(1 for seq, ali in seqinfo.items() if ali.time != before.get(seq))
+     results.put({'wait': t1 - t0, 'hold': t2 - t1, 'updated': updated, 'quitting': quitting})
+
+
+def run(server, config, concurrency):
+     nreqs = len(server.requests)
+     results = Queue()
+     procs = [Process(target=worker, args=(config, results)) for i in range(concurrency)]
+
+     start = perf_counter()
+     for proc in procs:
+          proc.start()
+     stats = [results.get() for proc in procs]
+     for proc in procs:
+          proc.join()
+     wall = perf_counter() - start
+
+     updated = sum(s['updated'] for s in stats)
+     reqs = len(server.requests) - nreqs
+     holds = [s['hold'] for s in stats]
+     waits = [s['wait'] for s in stats]
+     return {'wall': wall, 'updated': updated, 'requests': reqs,
+             'seqs/sec': updated/wall if wall else 0,
+             'requests/seq': reqs/updated if updated else float('inf'),
+             'hold mean': sum(holds)/len(holds), 'hold max': max(holds),
+             'wait mean': sum(waits)/len(waits), 'aborted': sum(1 for s in stats if s['quitting'])}
+
+
+def parse_args():
+     intlist = lambda s: [int(x) for x in s.split(',')]
+     parser = argparse.ArgumentParser(description="Benchmark AllSeqUpdater against a simulated FDB")
+     parser.add_argument('--data', default=join(ROOT, 'website', 'generated', 'AllSeq.json'), help="AllSeq.json to start each run from (copied, never modified)")
+     parser.add_argument('--batch', type=intlist, default=[10, 50], help="comma separated batch sizes")
+     parser.add_argument('--concurrency', type=intlist, default=[1, 2], help="comma separated updater process counts")
+     parser.add_argument('--delay', type=float, default=0, help="the updater's query_delay, seconds (allseq.py uses 1)")
+     parser.add_argument('--time-budget', type=float, default=None, help="the updater's time_budget, seconds (the batch size is then a maximum)")
+     parser.add_argument('--request-budget', type=int, default=None, help="the updater's request_budget")
+     parser.add_argument('--checkpoint', type=int, default=10, help="the updater's checkpoint_seqs, 0 for none")
+     parser.add_argument('--async-finalize', action='store_true', help="write stats and html in a child process, after the lock is released")
+     parser.add_argument('--transport', default='html', choices=('html', 'json'))
+     parser.add_argument('--latency', type=float, default=0.05, help="simulated FDB latency, seconds")
+     parser.add_argument('--jitter', type=float, default=0.05, help="random extra latency, up to this many seconds")
+     parser.add_argument('--error-rate', type=float, default=0, help="probability of an HTTP 500")
+     parser.add_argument('--garbage-rate', type=float, default=0, help="probability of a page with bad factors")
+     parser.add_argument('--ff-rate', type=float, default=0.1, help="probability an id has since been fully factored")
+     parser.add_argument('--limit-after', type=int, default=None, help="serve the resource limit page after this many requests per run")
+     parser.add_argument('--recorded', default=None, help="directory of recorded responses to serve where possible")
+     parser.add_argument('--seed', type=int, default=None)
+     return parser.parse_args()
+
+
+def main():
+     args = parse_args()
+     logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(name)s: %(message)s')
+
+     server = SimulatedFDBServer(args.recorded, latency=args.latency, jitter=args.jitter,
+                                 error_rate=args.error_rate, garbage_rate=args.garbage_rate,
+                                 ff_rate=args.ff_rate, seed=args.seed)
+     header = f"{'batch':>6} {'procs':>5} {'updated':>7} {'wall s':>7} {'seqs/s':>7} {'req/seq':>7} {'hold s':>7} {'maxhold':>7} {'wait s':>7} {'aborted':>7}"
+     print(header)
+     with server.serving():
+          fdb.FDBURL = server.url
+          for batch in args.batch:
+               for concurrency in args.concurrency:
+                    with TemporaryDirectory() as tmpdir:
+                         config = make_config(tmpdir, args)
+                         config['AllSeqUpdater']['batchsize'] = batch
+                         copy(args.data, config['jsonfile'])
+                         server.limit_after = None if args.limit_after is None else len(server.requests) + args.limit_after
+                         r = run(server, config, concurrency)
+                    print(f"{batch:>6} {concurrency:>5} {r['updated']:>7} {r['wall']:>7.2f} {r['seqs/sec']:>7.2f} {r['requests/seq']:>7.2f} "
+                          f"{r['hold mean']:>7.2f} {r['hold max']:>7.2f} {r['wait mean']:>7.2f} {r['aborted']:>7}")
+
+
+if __name__ == '__main__':
+     main()
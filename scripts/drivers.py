@@ -33,10 +33,12 @@ add_path_relative_to_script('..')
 from mfaliquot.theory import numtheory as nt
 from mfaliquot.theory import aliquot as aq
 from mfaliquot.application import SequencesManager
+from mfaliquot.application.factstore import FDBFactStore
 from mfaliquot import blogotubes, InterpolatedJSONConfig
 
 CONFIG = InterpolatedJSONConfig()
 CONFIG.read_file('mfaliquot.config.json')
+FACTS = FDBFactStore(CONFIG['AllSeqUpdater']['factstore'])
 
 
 # TODO: clean up this mess, ideally move some of it to mfaliquot.application.fdb
@@ -63,9 +65,13 @@ def get_data():
 
 
 def get_num(id):
+     num = FACTS.get(id, 'value')
+     if num:
+          return num
      page = blogotubes('http://factordb.com/index.php?showid='+id)
      num = largedigits.search(page).group(1)
      num = re.sub(r'[^0-9]', '', num)
+     FACTS.put(id, 'value', num)
      return num
 
 def get_id_info(id):
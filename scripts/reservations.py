@@ -42,18 +42,30 @@ add_path_relative_to_script('..')
 
 from mfaliquot import config_boilerplate
 from mfaliquot.application.reservations import ReservationsSpider
+from mfaliquot.application.reshistory import ReservationHistory, rebuild_res
+from mfaliquot.application.sequence import DATETIMEFMT
 from mfaliquot.application import SequencesManager
+from time import strftime, gmtime
 from mfaliquot.application.updater import AllSeqUpdater
 
 CONFIG, LOGGER = config_boilerplate(CONFIGFILE, SCRIPTNAME)
 
 
+historyfile = CONFIG['ReservationsSpider'].get('historyfile')
+HISTORY = ReservationHistory(historyfile) if historyfile else None # the one for this file, shared with the spider
+
+def record_cli(name, op, seqs):
+     if HISTORY: # flushed by main() once the table is written
+          HISTORY.record(strftime(DATETIMEFMT, gmtime()), 'cli', None, name, op, seqs)
+
+
 def do_spider(seqinfo):
 
-     spider = ReservationsSpider(seqinfo, CONFIG['ReservationsSpider'])
+     spider = ReservationsSpider(seqinfo, CONFIG['ReservationsSpider'], HISTORY)
      thread_out, mass_out = spider.spider_all_apply_all()
      LOGGER.info("Saving reservation changes to file")
      seqinfo.write() # "Atomic"
+     spider.save_state()
      # prepare a list of all res-changed seqs: manual drops, manual updates, mass drops.
      # Overflows get priority 0 (slight race condition with update_priorities.py)
      # TODO: maybe factor this out into the class?
@@ -87,6 +99,7 @@ def inner_main(seqinfo, err):
           else:
                LOGGER.info("Add {} seqs".format(len(argv[3:])))
                out = seqinfo.reserve_seqs(argv[2], [int(seq.replace(',','')) for seq in argv[3:]])
+               record_cli(argv[2], 'add', out[0])
 
      elif argv[1] == 'drop':
 
@@ -95,18 +108,41 @@ def inner_main(seqinfo, err):
           else:
                LOGGER.info("Drop {} seqs".format(len(argv[3:])))
                out = seqinfo.unreserve_seqs(argv[2], [int(seq.replace(',','')) for seq in argv[3:]])
+               record_cli(argv[2], 'drop', out[0])
 
      elif argv[1] == 'spider':
 
           do_spider(seqinfo)
 
+     elif argv[1] == 'history':
+
+          if len(argv[2:]) < 1 or not HISTORY:
+               print("Error: {} history <seq> [<time>] (and the historyfile must be configured)".format(argv[0]))
+          else:
+               time = ' '.join(argv[3:]) or None
+               print(HISTORY.who_held(int(argv[2]), time) or 'nobody')
+
+     elif argv[1] == 'rebuild':
+
+          if not HISTORY:
+               print("Error: the historyfile must be configured to rebuild from it")
+          else:
+               time = ' '.join(argv[2:]) or None
+               LOGGER.info(f"Rebuilding reservations from {HISTORY.file} as of {time or 'now'}")
+               try:
+                    out = rebuild_res(seqinfo, HISTORY, time)
+               except ValueError as e:
+                    print(f"Error: {str(e)}")
+                    return
+               LOGGER.info(f"Rebuilt: added {sum(len(a[0]) for a, d in out.values())}, dropped {sum(len(d[0]) for a, d in out.values())}")
+
      else:
           print(err)
           exit(-1)
 
 
 def main():
-     err = "Error: commands are 'add', 'drop', or 'spider'"
+     err = "Error: commands are 'add', 'drop', 'spider', 'history', or 'rebuild'"
      if len(argv) < 2:
           print(err)
           exit(-1)
@@ -114,7 +150,11 @@ def main():
      s = SequencesManager(CONFIG)
 
      with s.acquire_lock(block_minutes=CONFIG['blockminutes']): # reads and inits
+          if HISTORY:
+               HISTORY.seed(strftime(DATETIMEFMT, gmtime()), s)
           inner_main(s, err)
+     if HISTORY: # only now that the changes are written
+          HISTORY.flush()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,59 @@
+#! /usr/bin/env python3
+
+# This is written to Python 3.6 standards
+# indentation: 5 spaces (eccentric personal preference)
+# when making large backwards scope switches (e.g. leaving def or class blocks),
+# use two blank lines for clearer visual separation
+
+#    Copyright (C) 2014-2017 Bill Winslow
+#
+#    This module is a part of the mfaliquot package.
+#
+#    This program is libre software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+#    See the LICENSE file for more details.
+
+
+# Bulk load the local store of immutable FDB facts from other fact files,
+# e.g. ones copied from another installation. Usage: warm_factstore.py <file>...
+
+CONFIGFILE = 'mfaliquot.config.json'
+SCRIPTNAME = 'warm_factstore'
+
+################################################################################
+
+from sys import argv, exit
+
+from _import_hack import add_path_relative_to_script
+add_path_relative_to_script('..')
+# this should be removed when proper pip installation is supported
+
+from mfaliquot import config_boilerplate
+from mfaliquot.application.factstore import FDBFactStore
+
+CONFIG, LOGGER = config_boilerplate(CONFIGFILE, SCRIPTNAME)
+
+
+def main():
+     if len(argv) < 2:
+          print(f"Error: {argv[0]} <factfile> [<factfile>...]")
+          exit(-1)
+
+     store = FDBFactStore(CONFIG['AllSeqUpdater']['factstore'])
+     for file in argv[1:]:
+          store.bulk_load(file)
+     LOGGER.info(f"{store.file} now has {len(store)} facts")
+
+
+if __name__ == '__main__':
+     try:
+          main()
+     except BaseException as e:
+          LOGGER.exception(f"warm_factstore.py interrupted by {type(e).__name__}: {str(e)}", exc_info=e)
@@ -24,13 +24,22 @@ from os.path import realpath, join, dirname, exists
 import sys
 sys.path.insert(0, realpath(join(dirname(sys.argv[0]), '..')))
 
+import mfaliquot
 from mfaliquot.application import reservations as R
+from mfaliquot.application.forum_xaction import spider_res_thread, THREAD_URL, LASTPOST_URL, iter_posts, _parse_page, _read_msg
 from mfaliquot.application import SequencesManager, LockError
 from mfaliquot.application.sequence import SequenceInfo
-from os import remove as rm
+from mfaliquot.application.reshistory import ReservationHistory, rebuild_res
+from mfaliquot.application.website import ArtifactWriter, write_shards, compute_facets
+from os import listdir, makedirs, remove as rm, stat
 from shutil import copy2 as cp
 from os.path import exists, realpath, join, dirname
-import unittest
+from tempfile import TemporaryDirectory
+from base64 import b64decode
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from threading import Thread
+import gzip, json, unittest
 
 
 class TestCaseWithFilesEqual(unittest.TestCase):
@@ -124,6 +133,604 @@ class TestSequencesManagerLocking(TestCaseWithFilesEqual):
           self.assertFalse(seqinfo._have_lock)
 
 
+class TestSequencesManagerCached(unittest.TestCase):
+
+     def setUp(self):
+          self.tmpdir = TemporaryDirectory()
+          file = join(self.tmpdir.name, 'AllSeq.json')
+          self.config = {'jsonfile': file, 'txtfile': join(self.tmpdir.name, 'AllSeq.txt'), 'lockfile': file + '.lock',
+                         'journalfile': file + '.journal'}
+          data = [SequenceInfo(seq=seq, index=100, size=120, factors='2^2 * 7 * C118', priority=seq/1000,
+                               time='2018-04-28 01:48:46', id=seq*10) for seq in (276, 552, 564, 660)]
+          with open(file, 'w') as f:
+               json.dump({'aaData': data}, f)
+
+
+     def tearDown(self):
+          self.tmpdir.cleanup()
+
+
+     def test_cached_reread(self):
+          seqinfo = SequencesManager(self.config)
+          with seqinfo.acquire_lock():
+               self.assertEqual(list(seqinfo.pop_n_todo(1)), [276])
+               seqinfo[276].res = 'me'
+               seqinfo.push_new_info(seqinfo[276])
+          data = seqinfo._data
+
+          with seqinfo.acquire_lock(cached=True): # nothing else wrote it
+               self.assertIs(seqinfo._data, data)
+
+          other = SequencesManager(self.config)
+          with other.acquire_lock():
+               self.assertEqual(other[276].res, 'me')
+               other[552].res = 'you'
+
+          with seqinfo.acquire_lock(cached=True):
+               self.assertIsNot(seqinfo._data, data)
+               self.assertEqual(seqinfo[552].res, 'you')
+
+
+     def test_checkpoint_replay(self):
+          seqinfo = SequencesManager(self.config)
+          seqinfo.lock_read_init()
+          seqinfo[276].res = 'me'
+          seqinfo.push_new_info(seqinfo[276])
+          seqinfo.drop([552])
+          self.assertEqual(seqinfo.checkpoint(), 2)
+          self.assertEqual(seqinfo.checkpoint(), 0) # nothing new
+          with open(self.config['journalfile'], 'a') as f:
+               f.write('["push", [564, 10') # and then we crash
+          rm(self.config['lockfile'])
+
+          other = SequencesManager(self.config)
+          with other.acquire_lock():
+               self.assertEqual(other[276].res, 'me')
+               self.assertNotIn(552, other)
+               self.assertEqual(len(other), 3)
+          self.assertFalse(exists(self.config['journalfile']))
+          with open(self.config['jsonfile']) as f:
+               self.assertEqual(len(json.load(f)['aaData']), 3)
+
+
+     def test_checkpoint_unlock(self):
+          seqinfo = SequencesManager(self.config)
+          with seqinfo.acquire_lock():
+               pass
+          mtime = stat(self.config['jsonfile']).st_mtime_ns
+          data = seqinfo._data
+          with seqinfo.acquire_lock(cached=True, checkpoint=True):
+               seqinfo[276].res = 'me'
+               seqinfo.push_new_info(seqinfo[276])
+          self.assertEqual(stat(self.config['jsonfile']).st_mtime_ns, mtime) # only journaled
+          self.assertTrue(exists(self.config['journalfile']))
+
+          with seqinfo.acquire_lock(cached=True, checkpoint=True): # its own journal isn't a change
+               self.assertIs(seqinfo._data, data)
+
+          other = SequencesManager(self.config)
+          with other.acquire_lock(): # replays the journal, and folds it into the file
+               self.assertEqual(other[276].res, 'me')
+               other[552].res = 'you'
+          self.assertFalse(exists(self.config['journalfile']))
+
+          with seqinfo.acquire_lock(cached=True, checkpoint=True):
+               self.assertIsNot(seqinfo._data, data)
+               self.assertEqual((seqinfo[276].res, seqinfo[552].res), ('me', 'you'))
+
+
+     def test_derived_after_unlock(self):
+          shards = self.config['sharddir'] = join(self.tmpdir.name, 'shards')
+          facets = self.config['facetfile'] = join(self.tmpdir.name, 'facets.json')
+          details = self.config['detaildir'] = join(self.tmpdir.name, 'seq')
+          seqinfo = SequencesManager(self.config)
+          with seqinfo.acquire_lock():
+               seqinfo.drop([660])
+               seqinfo.write()
+               seqinfo.drop([564])
+               seqinfo.write() # two writes, one generation of documents
+               self.assertFalse(exists(join(shards, 'index.json')) or exists(facets) or exists(details)) # not under the lock
+          with open(join(shards, 'index.json')) as f:
+               self.assertEqual(json.load(f)['total'], 2)
+          with open(facets) as f:
+               self.assertEqual(json.load(f)['count'], 2)
+          self.assertEqual(sorted(listdir(join(details, '0'))), ['276.json', '552.json'])
+          with seqinfo.acquire_lock(cached=True):
+               seqinfo.reserve_seqs('me', [276])
+          with open(join(details, '0', '276.json')) as f:
+               self.assertEqual(json.load(f)['res'], 'me')
+
+          seqinfo.lock_read_init()
+          seqinfo.drop([276])
+          seqinfo.write()
+          seqinfo._unlock()
+          other = SequencesManager(self.config)
+          with other.acquire_lock():
+               other.drop([552])
+          seqinfo.write_derived() # too late, the other's are newer
+          with open(join(shards, 'index.json')) as f:
+               self.assertEqual(json.load(f)['total'], 0)
+          with open(facets) as f:
+               self.assertEqual(json.load(f)['count'], 0)
+          self.assertEqual(listdir(join(details, '0')), [])
+
+
+     def test_unpop(self):
+          seqinfo = SequencesManager(self.config)
+          with seqinfo.acquire_lock():
+               self.assertEqual(list(seqinfo.pop_n_todo(1)), [276])
+               seqinfo.unpop(276)
+               self.assertEqual(seqinfo.checkpoint(), 0) # nothing changed
+               self.assertEqual(list(seqinfo.pop_n_todo(2)), [276, 552])
+
+
+     def test_columnar_format(self):
+          seqinfo = SequencesManager(self.config)
+          with seqinfo.acquire_lock():
+               seqinfo.reserve_seqs('me', [552])
+               rows = sorted(list(ali) for ali in seqinfo.values())
+
+          self.config['json_format'] = 'columns'
+          with SequencesManager(self.config).acquire_lock(): # reads rows, writes columns
+               pass
+          with open(self.config['jsonfile']) as f:
+               data = json.load(f)
+          self.assertEqual(data['format'], 'columns')
+          self.assertListEqual(data['columns']['seq'], [276, 276, 12, 96])
+          self.assertListEqual(data['columns']['res']['dict'], ['', 'me'])
+
+          seqinfo = SequencesManager(self.config)
+          seqinfo.readonly_init()
+          self.assertListEqual(sorted(list(ali) for ali in seqinfo.values()), rows)
+
+
+     def test_details(self):
+          details = self.config['detaildir'] = join(self.tmpdir.name, 'seq')
+          seqinfo = SequencesManager(self.config)
+          with seqinfo.acquire_lock(): # nothing changed, but there are no documents yet
+               pass
+          self.assertTrue(exists(join(details, '0', '276.json')))
+          mtime = stat(join(details, '0', '552.json')).st_mtime_ns
+
+          with seqinfo.acquire_lock():
+               ali = seqinfo[276]
+               ali.index, ali.time = 101, '2018-05-01 00:00:00'
+               seqinfo.push_new_info(ali)
+               seqinfo.drop([660])
+          with open(join(details, '0', '276.json')) as f:
+               doc = json.load(f)
+          self.assertEqual((doc['seq'], doc['index'], doc['factors']), (276, 101, '2^2 * 7 * C118'))
+          self.assertListEqual(doc['history'], [['2018-04-28 01:48:46', 100, 120], ['2018-05-01 00:00:00', 101, 120]])
+          self.assertFalse(exists(join(details, '0', '660.json')))
+          self.assertEqual(stat(join(details, '0', '552.json')).st_mtime_ns, mtime) # not regenerated
+
+          makedirs(join(details, '1'))
+          with open(join(details, '1', '1002.json'), 'w') as f:
+               f.write('{}') # left over from a seq dropped while the documents weren't kept
+          rm(join(details, 'generation'))
+          with seqinfo.acquire_lock(): # a full regeneration
+               pass
+          self.assertFalse(exists(join(details, '1', '1002.json')))
+          self.assertTrue(exists(join(details, '0', '552.json')))
+
+
+     def test_delta_feed(self):
+          self.config.update(deltafile=join(self.tmpdir.name, 'AllSeq.delta.json'), delta_generations=2)
+          seqinfo = SequencesManager(self.config)
+          for changed in ([276], [], [552], [564]):
+               with seqinfo.acquire_lock():
+                    for seq in changed:
+                         seqinfo.reserve_seqs('me', [seq])
+          seqinfo.lock_read_init()
+          seqinfo.drop([660])
+          seqinfo.write_unlock()
+
+          with open(self.config['deltafile']) as f:
+               delta = json.load(f)
+          with open(self.config['jsonfile']) as f:
+               self.assertEqual(json.load(f)['generation'], 4)
+          self.assertEqual(delta['generation'], 4)
+          self.assertListEqual(delta['changes'], [[3, [564]], [4, [660]]])
+          self.assertListEqual([row[0] for row in delta['aaData']], [564])
+
+
+class TestArtifactWriter(unittest.TestCase):
+
+     def setUp(self):
+          self.tmpdir = TemporaryDirectory()
+          self.writer = ArtifactWriter(join(self.tmpdir.name, 'manifest.json'))
+          self.file = join(self.tmpdir.name, 'statistics.json')
+
+
+     def tearDown(self):
+          self.tmpdir.cleanup()
+
+
+     def test_skip_unchanged(self):
+          self.assertTrue(self.writer.write(self.file, '{"a": 1}\n'))
+          mtime = stat(self.file).st_mtime_ns
+          self.assertFalse(self.writer.write(self.file, '{"a": 1}\n'))
+          self.assertEqual(stat(self.file).st_mtime_ns, mtime)
+
+          entry = self.writer.read_manifest()['statistics.json']
+          self.assertEqual(entry['size'], 9)
+          self.assertTrue(entry['etag'].startswith('"'))
+          with open(join(self.tmpdir.name, entry['hashed'])) as f:
+               self.assertEqual(f.read(), '{"a": 1}\n')
+
+
+     def test_gzip_sibling(self):
+          self.assertTrue(self.writer.write(self.file, '[1, 2, 3]\n'*100, compress=True))
+          with gzip.open(self.file + '.gz', 'rt') as f:
+               self.assertEqual(f.read(), '[1, 2, 3]\n'*100)
+          with open(self.file + '.gz', 'rb') as f:
+               first = f.read()
+          entry = self.writer.read_manifest()['statistics.json']
+          self.assertEqual(entry['gzip_size'], len(first))
+          self.assertTrue(exists(join(self.tmpdir.name, entry['hashed'] + '.gz')))
+
+          rm(self.file + '.gz')
+          self.assertTrue(self.writer.write(self.file, '[1, 2, 3]\n'*100, compress=True))
+          with open(self.file + '.gz', 'rb') as f:
+               self.assertEqual(f.read(), first) # reproducible
+
+
+     def test_no_manifest(self):
+          writer = ArtifactWriter()
+          self.assertTrue(writer.write(self.file, '[1, 2, 3]\n'*100, compress=True))
+          mtimes = stat(self.file).st_mtime_ns, stat(self.file + '.gz').st_mtime_ns
+          self.assertFalse(writer.write(self.file, '[1, 2, 3]\n'*100, compress=True))
+          self.assertEqual((stat(self.file).st_mtime_ns, stat(self.file + '.gz').st_mtime_ns), mtimes)
+          self.assertFalse(exists(join(self.tmpdir.name, 'manifest.json')))
+
+          rm(self.file + '.gz')
+          self.assertTrue(writer.write(self.file, '[1, 2, 3]\n'*100, compress=True))
+          self.assertTrue(writer.write(self.file, '[4]\n', compress=True))
+          with gzip.open(self.file + '.gz', 'rt') as f:
+               self.assertEqual(f.read(), '[4]\n')
+
+
+     def test_shards(self):
+          rows = [SequenceInfo(seq=seq, index=seq%7, size=100+seq%5, progress=p, priority=seq/100)
+                  for seq, p in ((276, 3), (552, '2018-04-07'), (564, None), (660, 10), (966, '2018-05-01'))]
+          shards = join(self.tmpdir.name, 'shards')
+          self.assertEqual(write_shards(self.writer, shards, rows, pagesize=2, generation=7), 5*3 + 1)
+          with open(join(shards, 'index.json')) as f:
+               index = json.load(f)
+          self.assertEqual((index['total'], index['pagesize'], index['generation']), (5, 2, 7))
+          self.assertEqual(index['columns']['9'], 'progress')
+          pages = []
+          for page in range(3):
+               with open(join(shards, f'progress.{page}.json')) as f:
+                    pages.extend(row[0] for row in json.load(f)['aaData'])
+          self.assertListEqual(pages, [660, 276, 966, 552, 564])
+
+          self.assertLess(write_shards(self.writer, shards, rows[:4], pagesize=2, generation=8), 5*2 + 1) # some pages unchanged
+          self.assertFalse(exists(join(shards, 'seq.2.json')))
+
+
+     def test_facets(self):
+          rows = [SequenceInfo(seq=seq, size=size, klass=klass, factors=factors, res=res, guide=guide, driver=driver)
+                  for seq, size, klass, factors, res, guide, driver in (
+                       (9, 123, 2, '2^3 * 3 * 5 * C120', '', '2^3 * 3 * 5', True),
+                       (1, 101, 2, '2^2 * 7 * C99', 'me', '2^2 * 7', True),
+                       (5, 109, 0, '2 * 3^2 * C107', '', 'Downdriver!', False))]
+          facets = compute_facets(rows)
+          bits = lambda name: b64decode(facets[name])[0]
+          # the rows sorted by seq are 1, 5, 9
+          self.assertEqual(bits('three'), 0b110)
+          self.assertEqual(bits('driver'), 0b101)
+          self.assertEqual(bits('reserved'), 0b001)
+          self.assertEqual(bits('downdriver'), 0b010)
+          self.assertEqual((bits('class:2'), bits('class:0')), (0b101, 0b010))
+          self.assertEqual((bits('size:100'), bits('size:120')), (0b011, 0b100))
+          self.assertNotIn('size:110', facets)
+
+
+     def test_hashed_copies_expire(self):
+          hashed = []
+          for i in range(4):
+               self.writer.write(self.file, f'{i}\n')
+               hashed.append(self.writer.read_manifest()['statistics.json']['hashed'])
+          self.assertEqual(len(set(hashed)), 4)
+          kept = [exists(join(self.tmpdir.name, name)) for name in hashed]
+          self.assertListEqual(kept, [False, False, True, True])
+          self.assertEqual(self.writer.read_manifest()['statistics.json']['previous'], hashed[2:3])
+
+
+def forum_page(page, pages, posts):
+     '''A minimal vBulletin res thread page, `posts` being (pid, name, msg)s'''
+     out = [f'<td class="vbmenu_control" style="font-weight:normal">Page {page} of {pages}</td>']
+     for pid, name, msg in posts:
+          out.append(f'<!-- post #{pid} --><img alt="{name} is offline" />'
+                     f'<!-- message --><div id="post_message_{pid}">{msg}<br />\n</div><!-- / message --><!-- / post #{pid} -->')
+     return '\n'.join(out)
+
+
+class TestResThreadSpider(unittest.TestCase):
+
+     def setUp(self):
+          self.tmpdir = TemporaryDirectory()
+          # 5 pages of 3 posts each, pids 1000000, 1000001, ...
+          self.posts = [(1000000 + i, f'user{i}', f'Reserving {100000 + i}') for i in range(15)]
+          self.pages = {page: forum_page(page, 5, self.posts[3*page-3:3*page]) for page in range(1, 6)}
+
+
+     def tearDown(self):
+          mfaliquot.set_tape(None)
+          self.tmpdir.cleanup()
+
+
+     def replay(self, *pages, lastpost=None):
+          '''Serves the last page, then `pages`, from a tape, and redirects the
+          last post probe to `lastpost`'''
+          file = join(self.tmpdir.name, 'tape.gz')
+          records = [('GET', THREAD_URL + str(page), self.pages[5 if page == 100000 else page]) for page in (100000,) + pages]
+          if lastpost:
+               records.append(('REDIRECT', LASTPOST_URL, f'http://www.mersenneforum.org/showthread.php?p={lastpost}#post{lastpost}'))
+          with gzip.open(file, 'wt', encoding='utf-8') as f:
+               for method, url, response in records:
+                    f.write(json.dumps({'url': url, 'method': method, 'hdrs': {}, 'response': response, 'latency': 0}) + '\n')
+          mfaliquot.set_tape(mfaliquot.BlogotubesTape(file, 'replay'))
+
+
+     def test_known_page(self):
+          self.replay(2, 3, 4, lastpost=1000014)
+          cursor, prev_pages, res = spider_res_thread({'pid': 1000004, 'page': 2}, workers=3)
+          self.assertEqual((cursor['pid'], cursor['page']), (1000014, 5))
+          self.assertListEqual(prev_pages, ['4', '3', '2'])
+          self.assertListEqual([name for pid, name, adds, drops, updates in res], [f'user{i}' for i in range(5, 15)])
+          self.assertEqual(res[0][0], 1000005)
+          self.assertEqual(list(res[0][2]), [100005])
+
+
+     def test_unknown_page(self):
+          self.replay(4, 3) # and the probe fails
+          cursor, prev_pages, res = spider_res_thread({'pid': 1000007})
+          self.assertEqual((cursor['pid'], cursor['page']), (1000014, 5))
+          self.assertListEqual(prev_pages, ['4', '3'])
+          self.assertEqual(len(res), 7)
+
+
+     def test_no_pagenav(self):
+          self.pages[5] = self.pages[5].split('\n', 1)[1]
+          self.replay(4, 3)
+          cursor, prev_pages, res = spider_res_thread({'pid': 1000007, 'page': 5})
+          self.assertEqual((cursor['pid'], cursor['page']), (1000014, 5))
+          self.assertListEqual(prev_pages, ['4', '3'])
+          self.assertEqual(len(res), 7)
+
+
+     def test_up_to_date(self):
+          self.replay(lastpost=1000014)
+          cursor = {'pid': 1000014, 'page': 5, 'hash': 'abc'}
+          self.assertEqual(spider_res_thread(cursor), (cursor, [], []))
+          self.assertIsNotNone(mfaliquot.blogotubes(THREAD_URL + '100000')) # never fetched
+
+          self.replay() # the probe fails, but the page is unchanged
+          cursor = spider_res_thread({'pid': 1000010})[0]
+          self.replay()
+          self.assertEqual(spider_res_thread(cursor), (cursor, [], []))
+
+
+class TestThreadPageParser(unittest.TestCase):
+
+     QUOTE = ('<div style="margin:20px; margin-top:5px; "><div class="smallfont" style="margin-bottom:2px">Quote:</div>'
+              '<table cellpadding="6" cellspacing="0" border="0" width="100%"><tr><td class="alt2" style="border:1px inset">'
+              '<div>Originally Posted by <strong>RichD</strong></div><div style="font-style:italic">Reserving 100001</div>'
+              '</td></tr></table></div>')
+
+
+     def test_quotes(self):
+          page = forum_page(1, 1, [(1000000, 'Dubslow', f'Dropping 100002<br />\n{self.QUOTE}Taking 100003 &amp; <b>100004</b>')])
+          self.assertListEqual(_parse_page(page), [(1000000, 'Dubslow', 'Dropping 100002\nTaking 100003 & 100004')])
+
+
+     def test_code(self):
+          code = '<div style="margin:20px; margin-top:5px"><div class="smallfont" style="margin-bottom:2px">Code:</div><pre class="alt2" dir="ltr">100005\n100006</pre></div>'
+          page = forum_page(1, 1, [(1000000, 'R.D. Silverman', f'Reserving{code}')])
+          self.assertListEqual(_parse_page(page), [(1000000, 'R.D. Silverman', 'Reserving\n100005\n100006')])
+
+
+     def test_saved_pages(self):
+          with open(join(dirname(realpath(__file__)), 'forum_pages', 'page_quotes.html'), encoding='latin-1') as f:
+               page = f.read()
+          posts = _parse_page(page)
+          self.assertEqual(len(posts), 10)
+          self.assertListEqual(posts, sorted(posts))
+          self.assertFalse(any('Originally Posted by' in msg or 'Quote:' in msg for pid, name, msg in posts))
+          # streaming
+          chunks = [page[i:i+1000] for i in range(0, len(page), 1000)]
+          self.assertListEqual(list(iter_posts(chunks)), posts)
+
+
+class TestReadMsg(unittest.TestCase):
+
+     def test_corpus(self):
+          with open(join(dirname(realpath(__file__)), 'forum_pages', 'commands.json')) as f:
+               commands = json.load(f)
+          for msg, *expected in commands:
+               self.assertEqual(_read_msg(msg), tuple(map(tuple, expected)), msg)
+
+
+class TestMassReservations(unittest.TestCase):
+
+     URL = 'http://yafu.myfirewall.org/yafu/download/ali/ali.txt.all'
+
+     def setUp(self):
+          self.tmpdir = TemporaryDirectory()
+          file = join(self.tmpdir.name, 'AllSeq.json')
+          self.config = {'jsonfile': file, 'txtfile': join(self.tmpdir.name, 'AllSeq.txt'), 'lockfile': file + '.lock'}
+          with open(file, 'w') as f:
+               json.dump({'aaData': [SequenceInfo(seq=seq, index=100, size=120) for seq in range(10000, 10010)]}, f)
+
+
+     def tearDown(self):
+          mfaliquot.set_tape(None)
+          self.tmpdir.cleanup()
+
+
+     def test_conditional_get(self):
+          with open(join(self.tmpdir.name, 'ali.txt'), 'w') as f:
+               f.write('10000\n10001\n')
+          handler = partial(SimpleHTTPRequestHandler, directory=self.tmpdir.name)
+          handler.log_message = lambda *args: None
+          with ThreadingHTTPServer(('127.0.0.1', 0), handler) as server:
+               Thread(target=server.serve_forever, daemon=True).start()
+               try:
+                    url = f'http://127.0.0.1:{server.server_address[1]}/ali.txt'
+                    txt, validators = mfaliquot.blogotubes_conditional(url)
+                    self.assertEqual(txt, '10000\n10001\n')
+                    self.assertTrue(validators['last_modified'])
+                    self.assertIs(mfaliquot.blogotubes_conditional(url, validators)[0], mfaliquot.NOT_MODIFIED)
+               finally:
+                    server.shutdown()
+
+
+     def test_snapshot(self):
+          seqinfo = SequencesManager(self.config)
+          with seqinfo.acquire_lock():
+               seqinfo.reserve_seqs('RichD', [10005])
+               addres, dropres = seqinfo.apply_reservation_snapshot('yafu@home', [10000, 10001, 10005, 99999])
+               self.assertEqual(addres, ([10000, 10001], [99999], [], [(10005, 'RichD')]))
+               self.assertEqual(dropres, ([], [], [], []))
+
+               seqinfo.unreserve_seqs('RichD', [10005])
+               seqinfo.drop([10001])
+               seqinfo[10002].res = 'yafu@home' # behind the index's back
+               addres, dropres = seqinfo.apply_reservation_snapshot('yafu@home', [10002, 10005])
+               self.assertEqual(addres, ([10005], [], [10002], []))
+               self.assertEqual(dropres, ([10000], [], [], []))
+               self.assertEqual(seqinfo._reserved_by('yafu@home'), {10002, 10005})
+               self.assertListEqual([seq for seq, ali in sorted(seqinfo.items()) if ali.res], [10002, 10005])
+
+               ali = seqinfo[10005]
+               ali.res = '' # cleared behind the index's back, and pushed as is
+               seqinfo.push_new_info(ali)
+               addres, dropres = seqinfo.apply_reservation_snapshot('yafu@home', [10002, 10005])
+               self.assertEqual(addres, ([10005], [], [], []))
+               self.assertEqual(seqinfo[10005].res, 'yafu@home')
+
+
+     def test_cache(self):
+          responses = [{'status': 200, 'body': '10000\n10001\n', 'validators': {'etag': '"a"'}},
+                       {'status': 304, 'body': None, 'validators': {'etag': '"a"'}},
+                       {'status': 200, 'body': '10000\n10001\n', 'validators': {}}, # no validators, but same hash
+                       {'status': 200, 'body': '10001\n10002\n', 'validators': {'etag': '"b"'}}]
+          file = join(self.tmpdir.name, 'tape.gz')
+          with gzip.open(file, 'wt', encoding='utf-8') as f:
+               for response in responses:
+                    for method, url, resp in (('REDIRECT', LASTPOST_URL, 'http://www.mersenneforum.org/showthread.php?p=1000014'),
+                                              ('CONDITIONAL', self.URL, response)):
+                         f.write(json.dumps({'url': url, 'method': method, 'hdrs': {}, 'response': resp, 'latency': 0}) + '\n')
+          mfaliquot.set_tape(mfaliquot.BlogotubesTape(file, 'replay'))
+
+          seqinfo = SequencesManager(self.config)
+          cache = {}
+          with seqinfo.acquire_lock():
+               run = lambda: R.update_apply_all_res(seqinfo, {'pid': 1000014}, {'yafu@home': self.URL}, 2, cache)[3]
+               mass_out = run()
+               self.assertListEqual(sorted(mass_out[0][4][0]), [10000, 10001])
+               seqinfo.unreserve_seqs('yafu@home', [10000]) # changed in the table since
+               mass_out = run() # 304
+               self.assertListEqual(mass_out[0][4][0], [10000]) # restored all the same
+               mass_out = run() # hash
+               self.assertListEqual(mass_out[0][3][0] + mass_out[0][4][0], [])
+               mass_out = run()
+               self.assertListEqual(mass_out[0][3][0], [10000])
+               self.assertListEqual(mass_out[0][4][0], [10002])
+               self.assertListEqual([seq for seq, ali in sorted(seqinfo.items()) if ali.res == 'yafu@home'], [10001, 10002])
+          self.assertEqual(cache['yafu@home']['validators'], {'etag': '"b"'})
+
+
+class TestReservationHistory(unittest.TestCase):
+
+     def setUp(self):
+          self.tmpdir = TemporaryDirectory()
+          self.file = join(self.tmpdir.name, 'reservations.history')
+          history = ReservationHistory(self.file)
+          history.record('2018-04-01 00:00:00', 'thread', 1000000, 'RichD', 'add', [10000, 10001])
+          history.record('2018-04-02 00:00:00', 'mass', None, 'yafu@home', 'add', [10002])
+          history.record('2018-04-03 00:00:00', 'thread', 1000005, 'RichD', 'drop', [10001])
+          history.record('2018-04-03 00:00:00', 'thread', 1000005, 'RichD', 'update', [10000])
+          history.record('2018-04-04 00:00:00', 'cli', None, 'Dubslow', 'add', [10001])
+          history.record('2018-04-04 00:00:00', 'cli', None, 'Dubslow', 'add', []) # nothing
+          self.assertEqual(history.flush(), 4 + 1)
+
+
+     def tearDown(self):
+          self.tmpdir.cleanup()
+
+
+     def test_holders(self):
+          history = ReservationHistory(self.file)
+          self.assertEqual(history.holders(), {10000: 'RichD', 10001: 'Dubslow', 10002: 'yafu@home'})
+          self.assertEqual(history.holders('2018-04-03 12:00:00'), {10000: 'RichD', 10002: 'yafu@home'})
+          self.assertEqual(history.holders('2018-01-01 00:00:00'), {})
+
+
+     def test_who_held(self):
+          history = ReservationHistory(self.file)
+          self.assertEqual(history.who_held(10001), 'Dubslow')
+          self.assertEqual(history.who_held(10001, '2018-04-02 00:00:00'), 'RichD')
+          self.assertEqual(history.who_held(10001, '2018-04-03 12:00:00'), '')
+          self.assertEqual(history.who_held(10001, '2018-03-01 00:00:00'), '')
+          self.assertEqual(history.who_held(99999), '')
+          self.assertTrue(exists(self.file + '.index'))
+
+          with open(self.file, 'a') as f: # another process's appends, one truncated
+               f.write(json.dumps(['2018-04-05 00:00:00', 'cli', None, 'Dubslow', 'drop', [10001]]) + '\n["2018-04-05')
+          history = ReservationHistory(self.file)
+          self.assertEqual(history.who_held(10001), '') # from the saved index, caught up
+          history.record('2018-04-06 00:00:00', 'cli', None, 'EdH', 'add', [10001])
+          history.flush()
+          self.assertEqual(history.who_held(10001), 'EdH')
+          self.assertEqual(ReservationHistory(self.file).holders()[10001], 'EdH')
+
+
+     def test_rebuild_res(self):
+          file = join(self.tmpdir.name, 'AllSeq.json')
+          config = {'jsonfile': file, 'txtfile': join(self.tmpdir.name, 'AllSeq.txt'), 'lockfile': file + '.lock'}
+          with open(file, 'w') as f:
+               json.dump({'aaData': [SequenceInfo(seq=seq, index=100, size=120, res=res) for seq, res in
+                                     ((10000, ''), (10001, 'RichD'), (10002, 'bogus'), (10003, 'bogus'))]}, f)
+          seqinfo = SequencesManager(config)
+          with seqinfo.acquire_lock():
+               out = rebuild_res(seqinfo, ReservationHistory(self.file))
+               self.assertEqual(out['bogus'][1][0], [10002, 10003])
+               self.assertEqual(out['RichD'][1][0], [10001])
+               self.assertEqual(out['RichD'][0][0], [10000])
+               self.assertEqual({seq: ali.res for seq, ali in seqinfo.items()},
+                                {10000: 'RichD', 10001: 'Dubslow', 10002: 'yafu@home', 10003: ''})
+               self.assertRaises(ValueError, rebuild_res, seqinfo, ReservationHistory(self.file), '2018-03-01 00:00:00')
+
+               history = ReservationHistory(self.file)
+               rebuild_res(seqinfo, history, '2018-04-02 00:00:00')
+               self.assertEqual(history.flush(), 2) # Dubslow's drop, RichD's add
+               self.assertEqual(history.holders(), {seq: ali.res for seq, ali in seqinfo.items() if ali.res})
+               self.assertEqual(history.who_held(10001), 'RichD')
+
+
+     def test_seed(self):
+          file = join(self.tmpdir.name, 'AllSeq.json')
+          config = {'jsonfile': file, 'txtfile': join(self.tmpdir.name, 'AllSeq.txt'), 'lockfile': file + '.lock'}
+          with open(file, 'w') as f:
+               json.dump({'aaData': [SequenceInfo(seq=seq, index=100, size=120, res=res) for seq, res in
+                                     ((10000, ''), (10001, 'RichD'), (10002, 'bogus'))]}, f)
+          seqinfo = SequencesManager(config)
+          with seqinfo.acquire_lock():
+               history = ReservationHistory(join(self.tmpdir.name, 'new.history'))
+               self.assertEqual(history.seed('2018-05-01 00:00:00', seqinfo), 2)
+               self.assertEqual(history.seed('2018-05-01 00:00:00', seqinfo), 0) # only once
+               seqinfo.unreserve_seqs('bogus', [10002])
+               history.record('2018-05-02 00:00:00', 'cli', None, 'bogus', 'drop', [10002])
+               history.flush()
+               self.assertEqual(history.holders(), {10001: 'RichD'})
+               self.assertEqual(history.holders('2018-05-01 12:00:00'), {10001: 'RichD', 10002: 'bogus'})
+               rebuild_res(seqinfo, history, '2018-05-01 12:00:00') # nothing lost from before the log
+               self.assertEqual(seqinfo[10002].res, 'bogus')
+
+
 #class ReservationsTest(unittest.TestCase):
 #
 #     def test_AliquotReservations(self):
@@ -0,0 +1,345 @@
+#! /usr/bin/env python3
+
+# This is written to Python 3.6 standards
+# indentation: 5 spaces (eccentric personal preference)
+# when making large backwards scope switches (e.g. leaving def or class blocks),
+# use two blank lines for clearer visual separation
+
+#    Copyright (C) 2014-2017 Bill Winslow
+#
+#    This module is a part of the mfaliquot package.
+#
+#    This program is libre software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+#    See the LICENSE file for more details.
+
+from os.path import realpath, join, dirname
+import sys
+sys.path.insert(0, realpath(join(dirname(__file__), '..')))
+
+import mfaliquot
+from mfaliquot.application import fdb
+from mfaliquot.application.factstore import FDBFactStore
+from mfaliquot.application.fdb_standin import RecordedFDBServer, SimulatedFDBServer
+from mfaliquot.application.retry import RetryPolicy, CircuitBreaker, CircuitOpenError
+from copy import copy
+from tempfile import TemporaryDirectory
+import json, unittest
+
+PAGES = join(dirname(realpath(__file__)), 'fdb_pages')
+
+def read_page(name):
+     with open(join(PAGES, name)) as f:
+          return f.read()
+
+
+def setUpModule():
+     # No waiting around between retries, and a circuit that never stays open
+     global _policy
+     _policy = fdb.retry_policy
+     fdb.retry_policy = copy(_policy)
+     fdb.retry_policy.base_delay = 0
+     fdb.retry_policy.breaker = CircuitBreaker(cooldown=0)
+
+
+def tearDownModule():
+     fdb.retry_policy = _policy
+
+
+class TestFDBFactStore(unittest.TestCase):
+
+     def setUp(self):
+          self.tmpdir = TemporaryDirectory()
+          self.file = join(self.tmpdir.name, 'facts.txt')
+
+
+     def tearDown(self):
+          fdb.set_fact_store(None)
+          self.tmpdir.cleanup()
+
+
+     def test_put_get_persist(self):
+          store = FDBFactStore(self.file)
+          self.assertIsNone(store.get(1100000000937782034, 'created'))
+
+          store.put(1100000000937782034, 'created', '2017-06-24')
+          store.put('1100000000937782034', 'created', '2017-06-24') # no-op
+          store.put(12345, 'value', '1234567890123')
+          store.put(12345, 'value', '9') # immutable, ignored
+
+          with open(self.file) as f:
+               self.assertEqual(len(f.readlines()), 2)
+
+          with open(self.file, 'a') as f:
+               f.write('6789 value 12345') # truncated by a crash, mid value
+
+          store = FDBFactStore(self.file)
+          self.assertEqual(len(store), 2)
+          self.assertIsNone(store.get(6789, 'value'))
+          self.assertEqual(store.get('1100000000937782034', 'created'), '2017-06-24')
+          self.assertEqual(store.get(12345, 'value'), '1234567890123')
+          self.assertRaises(ValueError, store.put, 1, 'colour', 'blue')
+
+          store.put(6789, 'value', '1234567') # not glued onto the truncated line
+          store = FDBFactStore(self.file)
+          self.assertEqual(store.get(6789, 'value'), '1234567')
+
+
+     def test_bulk_load(self):
+          other = join(self.tmpdir.name, 'other.txt')
+          with open(other, 'w') as f:
+               f.write('1 created 2011-03-17\n2 status CompositeFullyFactored\n')
+          store = FDBFactStore(self.file)
+          store.put(1, 'created', '2011-03-17')
+          self.assertEqual(store.bulk_load(other), 1)
+          self.assertEqual(len(FDBFactStore(self.file)), 2)
+
+
+     def test_consulted_before_network(self):
+          store = FDBFactStore(self.file)
+          store.put(2, 'status', 'CompositeFullyFactored')
+          store.put(3, 'created', '2012-01-01')
+          fdb.set_fact_store(store)
+          # Neither of these may touch the network
+          self.assertEqual(fdb.query_id(2), (fdb.FDBStatus.CompositeFullyFactored, None))
+          self.assertEqual(fdb.id_created(3), '2012-01-01')
+
+
+class TestFDBPage(unittest.TestCase):
+
+     def test_sequence_pages(self):
+          ali = fdb.process_ali_data(276, read_page('seq_276.html'))
+          self.assertEqual((ali.index, ali.size, ali.id), (2140, 215, 1100000000836416512))
+          self.assertEqual((ali.factors, ali.cofactor), ('2^2 * 7 * P25 * C188', 188))
+
+          ali = fdb.process_ali_data(1152420, read_page('seq_1152420.html'))
+          self.assertEqual((ali.factors, ali.cofactor), ('2^3 * 3^3 * 5 * 101 * C136', 136))
+
+          ali = fdb.process_ali_data(4170, read_page('seq_terminated.html'))
+          self.assertEqual(ali.factors, 'Reportedly terminated')
+
+
+     def test_id_pages(self):
+          page = fdb.FDBPage(read_page('id_cf.html'))
+          self.assertIs(page.status(), fdb.FDBStatus.CompositePartiallyFactored)
+          self.assertEqual(page.idsize, (143, 1100000000937782034))
+          self.assertEqual(page.factors(1100000000937782034, 143), ('2^3 * 3 * C141', 141))
+
+          self.assertIs(fdb.FDBPage(read_page('id_ff.html')).status(), fdb.FDBStatus.CompositeFullyFactored)
+          self.assertIs(fdb.FDBPage(read_page('id_prp.html')).status(), fdb.FDBStatus.ProbablyPrime)
+          self.assertRaises(fdb.FDBDataError, fdb.parse_factors, 1, read_page('id_cf.html'), 180)
+
+
+     def test_data_table_end(self):
+          attrs = lambda p: (p.info, p.idsize, p.statuses, p.smalls, p.bigs, p.comps, p.all_factors_known)
+          for name in ('seq_276.html', 'seq_1152420.html', 'seq_terminated.html', 'id_cf.html', 'id_ff.html', 'id_prp.html'):
+               page = read_page(name) + '<p>' + 'x'*10000 + '</p>'
+               for chunk in (1, 7, 100, 4096):
+                    until, n = fdb.DataTableEnd(sequence=name.startswith('seq')), 0
+                    while n < len(page) and not until(page[n:n+chunk]):
+                         n += chunk
+                    n += chunk
+                    self.assertLess(n, len(page) - 10000 + chunk, name)
+                    self.assertEqual(attrs(fdb.FDBPage(page[:n])), attrs(fdb.FDBPage(page)), name)
+          self.assertFalse(fdb.DataTableEnd()(read_page('limit.html')))
+
+          # However far after the table the marker is, it's read
+          page = read_page('seq_1152420.html').replace('</table>\n<br>Not all', '</table>\n' + ' '*5000 + '<br>Not all')
+          until, n = fdb.DataTableEnd(), 0
+          while not until(page[n:n+100]):
+               n += 100
+          self.assertFalse(fdb.FDBPage(page[:n+100]).all_factors_known)
+          # and without it or the end of the body, nothing stops
+          until = fdb.DataTableEnd()
+          self.assertFalse(until(page.split('<br>Not all')[0] + ' '*5000))
+
+
+     def test_limit_and_layout(self):
+          self.assertTrue(fdb.FDBPage(read_page('limit.html')).resource_limit)
+          with self.assertRaises(fdb.FDBDataError) as cm:
+               fdb.FDBPage('<html><body>Under maintenance</body></html>')
+          self.assertNotIsInstance(cm.exception, fdb.FDBLayoutError)
+          page = read_page('seq_276.html')
+          self.assertRaises(fdb.FDBLayoutError, fdb.FDBPage, page[:page.index('</tr></table>')+13])
+
+
+class TestFDBTransports(unittest.TestCase):
+
+     @classmethod
+     def setUpClass(klass):
+          klass.server = RecordedFDBServer(PAGES)
+          klass.server.start()
+          klass.oldurl, fdb.FDBURL = fdb.FDBURL, klass.server.url
+
+
+     @classmethod
+     def tearDownClass(klass):
+          fdb.FDBURL = klass.oldurl
+          klass.server.stop()
+
+
+     def test_json_matches_html(self):
+          for fdb_id in (1100000000937782034, 1100000001067346576, 1100000000707012310):
+               self.assertEqual(fdb.query_id_json(fdb_id), fdb.query_id(fdb_id))
+          self.assertEqual(fdb.query_id_json(1100000000937782034)[1], ('2^3 * 3 * C141', 141))
+          self.assertIn('/api?id=1100000000937782034', self.server.requests)
+
+
+     def test_full_digits_cutoff(self):
+          # The html shows a factor in full only up to some number of digits, which
+          # _api_factors must agree with. Every html/api pair recorded for an id
+          # bounds it, and between them they must pin it exactly
+          with open(join(PAGES, 'responses.json')) as f:
+               manifest = json.load(f)
+          longest_full, shortest_cut = 0, float('inf')
+          for path, name in manifest.items():
+               if not (path.startswith('/api?id=') and name.endswith('.json')):
+                    continue
+               fdb_id = int(path.split('=')[1])
+               self.assertEqual(fdb.query_id_json(fdb_id), fdb.query_id(fdb_id), name)
+               shown = {small.split('^')[0] for small in fdb.FDBPage(read_page(manifest['/index.php?id='+str(fdb_id)])).smalls}
+               for factor, exp in json.loads(read_page(name))['factors']:
+                    if factor in shown:
+                         longest_full = max(longest_full, len(factor))
+                    else:
+                         shortest_cut = min(shortest_cut, len(factor))
+          self.assertEqual((longest_full, shortest_cut), (fdb._FULL_DIGITS, fdb._FULL_DIGITS + 1))
+
+
+     def test_sequence(self):
+          ali = fdb.query_sequence(276)
+          self.assertEqual((ali.seq, ali.index, ali.factors), (276, 2140, '2^2 * 7 * P25 * C188'))
+
+
+class TestBlogotubesTape(unittest.TestCase):
+
+     def setUp(self):
+          self.tmpdir = TemporaryDirectory()
+          self.file = join(self.tmpdir.name, 'tape.gz')
+
+
+     def tearDown(self):
+          mfaliquot.set_tape(None)
+          self.tmpdir.cleanup()
+
+
+     def test_record_replay(self):
+          mfaliquot.set_tape(mfaliquot.BlogotubesTape(self.file, 'record'))
+          with RecordedFDBServer(PAGES).serving() as server:
+               oldurl, fdb.FDBURL = fdb.FDBURL, server.url
+               try:
+                    self.assertEqual(fdb.query_sequence(276).factors, '2^2 * 7 * P25 * C188')
+                    self.assertRaises(fdb.FDBNetworkError, fdb.query_id, 12345, tries=1) # 404, recorded as None
+               finally:
+                    fdb.FDBURL = oldurl
+               url = server.url
+
+          # The server is gone, so the tape must supply everything
+          mfaliquot.set_tape(mfaliquot.BlogotubesTape(self.file, 'replay'))
+          oldurl, fdb.FDBURL = fdb.FDBURL, url
+          try:
+               self.assertEqual(fdb.query_sequence(276).factors, '2^2 * 7 * P25 * C188')
+               self.assertRaises(fdb.FDBNetworkError, fdb.query_id, 12345, tries=1)
+               self.assertRaises(fdb.FDBNetworkError, fdb.query_sequence, 276, tries=1) # only recorded once
+          finally:
+               fdb.FDBURL = oldurl
+
+
+class TestSimulatedFDB(unittest.TestCase):
+
+     def test_simulated_pages(self):
+          server = SimulatedFDBServer(PAGES, ff_rate=0, seed=42)
+          with server.serving():
+               oldurl, fdb.FDBURL = fdb.FDBURL, server.url
+               try:
+                    # recorded where possible, synthesized otherwise
+                    self.assertEqual(fdb.query_sequence(276).index, 2140)
+                    first, second = fdb.query_sequence(1318440), fdb.query_sequence(1318440)
+                    self.assertEqual(second.index, first.index + 1)
+                    status, (factors, cofactor) = fdb.query_id(second.id)
+                    self.assertEqual(fdb.query_id_json(second.id), (status, (factors, cofactor)))
+                    self.assertRegex(fdb.id_created(second.id), r'^\d{4}-\d{2}-\d{2}$')
+
+                    server.garbage_rate = 1
+                    self.assertRaises(fdb.FDBDataError, fdb.query_id, second.id)
+                    server.garbage_rate, server.limit_after = 0, len(server.requests)
+                    self.assertRaises(fdb.FDBResourceLimitReached, fdb.query_sequence, 276)
+                    count = len(server.requests)
+                    self.assertRaises(fdb.FDBResourceLimitReached, fdb.id_created, second.id)
+                    self.assertEqual(len(server.requests), count + 1) # not retried
+               finally:
+                    fdb.FDBURL = oldurl
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+     def setUp(self):
+          self.now = 0
+          self.breaker = CircuitBreaker(threshold=3, cooldown=10, clock=lambda: self.now)
+          self.policy = RetryPolicy(tries=3, base_delay=0, retry_on=(OSError, ValueError), fatal=(FileNotFoundError,),
+                                    trip_on=(OSError,), breaker=self.breaker, sleep=lambda seconds: None)
+          self.calls = []
+
+
+     def flaky(self, *errors):
+          errors = list(errors)
+          def func(arg):
+               self.calls.append(arg)
+               if errors:
+                    raise errors.pop(0)
+               return arg
+          return func
+
+
+     def test_retries(self):
+          self.assertEqual(self.policy.call(self.flaky(OSError(), ValueError()), 'x'), 'x')
+          self.assertEqual(len(self.calls), 3)
+          self.assertRaises(ValueError, self.policy.call, self.flaky(*[ValueError()]*3), 'y')
+          self.assertRaises(FileNotFoundError, self.policy.call, self.flaky(FileNotFoundError()), 'z')
+          self.assertRaises(KeyError, self.policy.call, self.flaky(KeyError()), 'z')
+          self.assertEqual(self.calls.count('z'), 2) # neither was retried
+          self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED) # ValueErrors don't count
+
+
+     def test_circuit_breaker(self):
+          self.assertRaises(OSError, self.policy.call, self.flaky(*[OSError()]*3), 'a')
+          self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+          self.calls.clear()
+          # waiting doesn't advance this clock, so every try is used up waiting
+          self.assertRaises(CircuitOpenError, self.policy.call, self.flaky(), 'b')
+          self.assertEqual(self.calls, [])
+
+          self.now += 10
+          self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+          self.assertRaises(CircuitOpenError, self.policy.call, self.flaky(OSError()), 'c')
+          self.assertEqual(self.calls, ['c']) # the failed probe reopened it
+          self.now += 10
+          self.assertEqual(self.policy.call(self.flaky(), 'd'), 'd')
+          self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+
+     def test_fdb_errors(self):
+          server = SimulatedFDBServer(error_rate=1, ff_rate=0)
+          with server.serving():
+               oldurl, fdb.FDBURL = fdb.FDBURL, server.url
+               try:
+                    self.assertRaises(fdb.FDBNetworkError, fdb.query_id, 1100000002000000001)
+                    self.assertEqual(len(server.requests), fdb.retry_policy.tries)
+                    server.error_rate, server.garbage_rate = 0, 1
+                    self.assertRaises(fdb.FDBDataError, fdb.query_id, 1100000002000000001, tries=2)
+                    server.limit_after = 0
+                    self.assertRaises(fdb.FDBResourceLimitReached, fdb.query_sequence, 276)
+                    self.assertEqual(len(server.requests), fdb.retry_policy.tries + 3)
+               finally:
+                    fdb.FDBURL = oldurl
+
+
+if __name__ == '__main__':
+     unittest.main()